@@ -1,7 +1,12 @@
+import datetime
+import importlib.util
+import itertools
+import re
 import time
 import traceback
 import json
-from django.http import HttpResponseRedirect
+import uuid
+from django.http import HttpResponse, HttpResponseRedirect, Http404, JsonResponse
 from django.urls import reverse
 from django.contrib import admin
 from django.conf import settings
@@ -13,12 +18,26 @@ from django.core.exceptions import PermissionDenied
 from django.utils.translation import gettext_lazy as _
 from query_inspector import query_debugger, trace
 
-from .app_settings import QUERY_DEFAULT_LIMIT
+from .aggregation import aggregation_store
+from .background import BackgroundJob, list_jobs, submit_query
+from .capture import slow_query_log
+from .app_settings import QUERY_DEFAULT_LIMIT, QUERY_PREVIEW_MAX_ROWS, QUERY_CACHE_MAX_ROWS
 from .models import Query
-from .sql import perform_query
+from .profiler import build_profile, format_collapsed, render_profile_as_html
+from .recordset import Recordset
+from .result_cache import execute_stored_query, get_cached_result, invalidate_query_results
+from .sql import cancel_query, perform_query
 from .sql import reload_stock_queries
 from .views import normalized_export_filename
 from .views import export_any_dataset
+from .views import stream_any_dataset
+
+
+_cancel_token_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _xlsx_available():
+    return importlib.util.find_spec('xlsxwriter') is not None
 
 
 @admin.register(Query)
@@ -32,7 +51,7 @@ class QueryAdmin(admin.ModelAdmin):
 
     fieldsets = (
         (None, {
-            'fields': ('title', 'slug', 'sql', 'default_parameters', 'notes', )
+            'fields': ('title', 'slug', 'sql', 'default_parameters', 'timeout', 'cache_ttl', 'notes', )
         }),
     )
 
@@ -60,7 +79,7 @@ class QueryAdmin(admin.ModelAdmin):
 
     def get_readonly_fields(self, request, obj=None):
         if obj is not None and obj.stock:
-            return ['sql', 'slug', 'title', 'notes', 'default_parameters', ]
+            return ['sql', 'slug', 'title', 'notes', 'default_parameters', 'timeout', 'cache_ttl', ]
         return []
 
     def get_prepopulated_fields(self, request, obj=None):
@@ -73,7 +92,11 @@ class QueryAdmin(admin.ModelAdmin):
         info = self.model._meta.app_label, self.model._meta.model_name
         my_urls = [
             path('reload_stock_queries/', self.admin_site.admin_view(self.reload_stock_queries), name='%s_%s_reload_stock_queries' % info),
+            path('endpoint_stats/', self.admin_site.admin_view(self.endpoint_stats), name='%s_%s_endpoint_stats' % info),
+            path('endpoint_profile/', self.admin_site.admin_view(self.endpoint_profile), name='%s_%s_endpoint_profile' % info),
             path('<int:object_id>/preview/', self.admin_site.admin_view(self.preview), name='%s_%s_preview' % info),
+            path('<int:object_id>/jobs/<str:job_id>/', self.admin_site.admin_view(self.job), name='%s_%s_job' % info),
+            path('<int:object_id>/cancel/', self.admin_site.admin_view(self.cancel), name='%s_%s_cancel' % info),
             path('<int:object_id>/duplicate/', self.admin_site.admin_view(self.duplicate), name='%s_%s_duplicate' % info),
         ]
         return my_urls + urls
@@ -90,6 +113,74 @@ class QueryAdmin(admin.ModelAdmin):
                 messages.warning(request, traceback.format_exc())
         return HttpResponseRedirect(next)
 
+    def endpoint_stats(self, request):
+        """
+        Per-endpoint query statistics collected by QueryCountMiddleware
+        in this server process
+        """
+        if not request.user.is_superuser:
+            raise PermissionDenied
+
+        if request.method == 'POST':
+            aggregation_store.reset()
+            slow_query_log.clear()
+            messages.info(request, _('Endpoint statistics have been reset'))
+            return HttpResponseRedirect(request.path)
+
+        order_by = request.GET.get('o', 'db_time')
+        if order_by not in ['db_time', 'requests', 'queries', 'avg_queries', 'avg_db_time', 'p95_db_time', ]:
+            order_by = 'db_time'
+        rows = aggregation_store.snapshot(order_by=order_by)
+        top_fingerprints = []
+        for row in rows:
+            fingerprints = aggregation_store.top_fingerprints(row['endpoint'])
+            if fingerprints is not None:
+                top_fingerprints.append((row['endpoint'], fingerprints))
+        profiles = []
+        for row in rows:
+            counters = aggregation_store.profile(row['endpoint'])
+            if counters is not None:
+                profile = build_profile(*counters, name=row['endpoint'])
+                profiles.append((row['endpoint'], render_profile_as_html(profile)))
+
+        opts = self.model._meta
+        return render(
+            request,
+            'admin/query_inspector/query/endpoint_stats.html', {
+                'admin_site': self.admin_site,
+                'title': _('Endpoint statistics'),
+                'opts': opts,
+                'app_label': opts.app_label,
+                'has_view_permission': self.has_view_permission(request),
+                'rows': rows,
+                'order_by': order_by,
+                'top_fingerprints': top_fingerprints,
+                'profiles': profiles,
+                # (a copy, as other threads keep appending to the log)
+                'slow_queries': list(slow_query_log)[::-1],
+            }
+        )
+
+    def endpoint_profile(self, request):
+        """
+        Downloads the query profile of an endpoint as collapsed stacks,
+        to be rendered with a flamegraph tool
+        """
+        if not request.user.is_superuser:
+            raise PermissionDenied
+
+        endpoint = request.GET.get('endpoint', '')
+        counters = aggregation_store.profile(endpoint)
+        if counters is None:
+            raise Http404
+        weight = 'count' if request.GET.get('weight') == 'count' else 'time'
+        response = HttpResponse(
+            format_collapsed(*counters, weight=weight, name=endpoint),
+            content_type='text/plain; charset=utf-8',
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s"' % normalized_export_filename(endpoint, 'folded')
+        return response
+
     def duplicate(self, request, object_id):
         info = self.model._meta.app_label, self.model._meta.model_name
         viewname = 'admin:%s_%s_change' % info
@@ -105,6 +196,81 @@ class QueryAdmin(admin.ModelAdmin):
             next = reverse(viewname, args=(obj.pk, ))
         return HttpResponseRedirect(next)
 
+    def cancel(self, request, object_id):
+        """
+        Cancels the query started by the preview form with the given token
+        """
+        obj = self.model.objects.get(id=object_id)
+        if request.method != 'POST' or not obj.can_execute(request):
+            raise PermissionDenied
+
+        token = request.POST.get('cancel_token', '')
+        if not _cancel_token_re.match(token):
+            raise Http404
+        return JsonResponse({'cancelled': cancel_query(token)})
+
+    def job(self, request, object_id, job_id):
+        """
+        Status, results and downloads of a query executed in the background
+        """
+        obj = self.model.objects.get(id=object_id)
+        if not obj.can_execute(request):
+            raise PermissionDenied
+        job = BackgroundJob.load(job_id)
+        if job is None or job.query_id != obj.id:
+            raise Http404
+
+        if request.method == 'POST':
+            if 'btn-cancel' in request.POST:
+                job.cancel()
+                messages.info(request, _('Query has been cancelled'))
+                return HttpResponseRedirect(request.path)
+            elif 'btn-delete' in request.POST:
+                job.delete()
+                info = self.model._meta.app_label, self.model._meta.model_name
+                return HttpResponseRedirect(reverse('admin:%s_%s_preview' % info, args=(obj.id, )))
+
+        file_format = request.GET.get('format', '')
+        if job.status == 'done' and file_format in ['csv', 'jsonl', ]:
+            filename = normalized_export_filename(obj.slug, file_format)
+            return stream_any_dataset(request, job.iter_rows(), filename=filename, columns=job.columns)
+        elif job.status == 'done' and file_format == 'xlsx':
+            filename = normalized_export_filename(obj.slug, file_format)
+            return export_any_dataset(request, "*", queryset=job.read_rows(), filename=filename)
+
+        # Results are paged through QUERY_PREVIEW_MAX_ROWS rows at a time
+        recordset = []
+        page = num_pages = 0
+        if job.status == 'done':
+            num_pages = max(1, (job.rows + QUERY_PREVIEW_MAX_ROWS - 1) // QUERY_PREVIEW_MAX_ROWS)
+            try:
+                page = min(max(1, int(request.GET.get('page', 1))), num_pages)
+            except ValueError:
+                page = 1
+            recordset = job.read_rows(offset=(page - 1) * QUERY_PREVIEW_MAX_ROWS, limit=QUERY_PREVIEW_MAX_ROWS)
+
+        opts = self.model._meta
+        return render(
+            request,
+            'admin/query_inspector/query/job.html', {
+                'admin_site': self.admin_site,
+                'title': _('Background query'),
+                'opts': opts,
+                'app_label': opts.app_label,
+                'original': obj,
+                'has_view_permission': self.has_view_permission(request, obj),
+                'has_change_permission': self.has_change_permission(request, obj),
+                'job': job,
+                'elapsed': '%.2f' % job.elapsed if job.elapsed is not None else '',
+                'recordset': recordset,
+                'page': page,
+                'num_pages': num_pages,
+                'previous_page': page - 1 if page > 1 else None,
+                'next_page': page + 1 if page < num_pages else None,
+                'xlsxwriter_available': _xlsx_available(),
+            }
+        )
+
     def preview(self, request, object_id):
 
         modeladmin = self
@@ -153,8 +319,19 @@ class QueryAdmin(admin.ModelAdmin):
             sql_limit = 0
 
         recordset = []
+        truncated = False
         elapsed = None
-        if request.method == 'POST':
+        cached_at = None
+        timeout = obj.get_timeout()
+        if request.method == 'POST' and 'btn-invalidate-cache' in request.POST:
+            invalidate_query_results(obj)
+            messages.info(request, _('Cached results have been discarded'))
+        elif request.method == 'POST':
+
+            # Used by the "Cancel" button to identify the running statement
+            token = request.POST.get('cancel_token', '')
+            if not _cancel_token_re.match(token):
+                token = None
 
             try:
                 start = time.perf_counter()
@@ -163,20 +340,56 @@ class QueryAdmin(admin.ModelAdmin):
                 if sql_limit > 0:
                     sql += ' limit %d' % sql_limit
 
-                recordset = perform_query(sql, params, log=True, validate=True)
-                if 'btn-export-csv' in request.POST:
-                    filename = normalized_export_filename(obj.slug, "csv")
-                    response = export_any_dataset(request, "*", queryset=recordset, filename=filename)
-                    return response
-                elif 'btn-export-jsonl' in request.POST:
-                    filename = normalized_export_filename(obj.slug, "jsonl")
-                    response = export_any_dataset(request, "*", queryset=recordset, filename=filename)
+                # Long-running queries can be executed by a background worker
+                if 'btn-run-background' in request.POST:
+                    job = submit_query(obj, params, sql_limit=sql_limit)
+                    obj.default_parameters = params
+                    obj.save(update_fields=['default_parameters', ])
+                    info = self.model._meta.app_label, self.model._meta.model_name
+                    return HttpResponseRedirect(reverse('admin:%s_%s_job' % info, args=(obj.id, job.id)))
+
+                # Exports reuse the cached result, if any; otherwise, rows are
+                # streamed from the db, so that large results are never held in memory all together
+                if 'btn-export-csv' in request.POST or 'btn-export-jsonl' in request.POST:
+                    filename = normalized_export_filename(obj.slug, "csv" if 'btn-export-csv' in request.POST else "jsonl")
+                    rows, cached_at = get_cached_result(obj, sql, params)
+                    if rows is None:
+                        # The statement is executed here, so that errors are reported
+                        # as messages rather than while the response is being sent
+                        rows = perform_query(
+                            sql, params, log=True, validate=True, stream=True, timeout=timeout, token=token
+                        ).start()
+                    response = stream_any_dataset(request, rows, filename=filename)
                     return response
                 elif 'btn-export-xlsx' in request.POST:
                     filename = normalized_export_filename(obj.slug, "xlsx")
+                    recordset, cached_at = get_cached_result(obj, sql, params)
+                    if recordset is None:
+                        recordset = perform_query(sql, params, log=True, validate=True, compact=True, timeout=timeout, token=token)
                     response = export_any_dataset(request, "*", queryset=recordset, filename=filename)
                     return response
 
+                # Only the first QUERY_PREVIEW_MAX_ROWS rows are displayed
+                if obj.get_cache_ttl():
+                    recordset, cached_at = execute_stored_query(
+                        obj, params, sql_limit, log=True, validate=True, timeout=timeout, token=token
+                    )
+                    # (a result too large to be cached is truncated)
+                    truncated = len(recordset) > QUERY_CACHE_MAX_ROWS
+                else:
+                    rows = perform_query(
+                        sql, params, log=True, validate=True, stream=True, compact=True, timeout=timeout, token=token
+                    ).start()
+                    try:
+                        recordset = Recordset(rows.columns, [
+                            row.as_tuple() for row in itertools.islice(rows, QUERY_PREVIEW_MAX_ROWS + 1)
+                        ])
+                    finally:
+                        rows.close()
+                if len(recordset) > QUERY_PREVIEW_MAX_ROWS:
+                    recordset = recordset[:QUERY_PREVIEW_MAX_ROWS]
+                    truncated = True
+
                 # Save default parameters
                 obj.default_parameters = params
                 obj.save(update_fields=['default_parameters', ])
@@ -188,12 +401,6 @@ class QueryAdmin(admin.ModelAdmin):
                 elapsed = ''
                 messages.error(request, str(e))
 
-        try:
-            import xlsxwriter
-            xlsxwriter_available = True
-        except ModuleNotFoundError as e:
-            xlsxwriter_available = False
-
         return render(
             request,
             'admin/query_inspector/query/preview.html', {
@@ -210,7 +417,13 @@ class QueryAdmin(admin.ModelAdmin):
                 # 'extra_qs': extra_qs,
                 'recordset': recordset,
                 'elapsed': elapsed,
+                'truncated': truncated,
+                'timeout': timeout,
+                'cache_ttl': obj.get_cache_ttl(),
+                'cached_at': datetime.datetime.fromtimestamp(cached_at, tz=datetime.timezone.utc) if cached_at else None,
+                'cancel_token': uuid.uuid4().hex,
+                'jobs': list_jobs(query_id=obj.id),
                 'sql_limit': sql_limit,
-                'xlsxwriter_available': xlsxwriter_available,
+                'xlsxwriter_available': _xlsx_available(),
             }
         )
@@ -0,0 +1,175 @@
+"""
+In-process aggregation of query statistics across requests, per endpoint.
+
+Memory is bounded: at most MAX_ENDPOINTS endpoints are tracked, DB time
+percentiles are computed from the most recent samples, and only the most
+frequent fingerprints (and the heaviest call stacks, when profiling)
+of each endpoint are retained.
+
+Note that each server process keeps its own store.
+"""
+import threading
+from collections import Counter, deque, OrderedDict
+
+
+# Upper bounds of the query count histogram buckets
+HISTOGRAM_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, None)
+
+
+def histogram_bucket_label(index):
+    upper = HISTOGRAM_BUCKETS[index]
+    lower = HISTOGRAM_BUCKETS[index - 1] + 1 if index > 0 else 0
+    if upper is None:
+        return '>%d' % (lower - 1)
+    if upper == lower:
+        return str(upper)
+    return '%d-%d' % (lower, upper)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))
+    return sorted_values[index]
+
+
+class EndpointStats(object):
+
+    def __init__(self, name, view, max_samples, max_fingerprints, max_stacks=200):
+        self.name = name
+        self.view = view
+        self.max_fingerprints = max_fingerprints
+        self.max_stacks = max_stacks
+        self.count = 0
+        self.total_queries = 0
+        self.total_db_time = 0.0
+        self.total_time = 0.0
+        self.db_times = deque(maxlen=max_samples)
+        self.histogram = [0, ] * len(HISTOGRAM_BUCKETS)
+        self.fingerprints = Counter()
+        self.stacks = Counter()
+        self.stack_timings = Counter()
+        self.budget_violations = 0
+
+    def record(self, num_queries, db_time, elapsed, queries, over_budget=False, stacks=None, stack_timings=None):
+        self.count += 1
+        if over_budget:
+            self.budget_violations += 1
+        self.total_queries += num_queries
+        self.total_db_time += db_time
+        self.total_time += elapsed
+        self.db_times.append(db_time)
+
+        for index, upper in enumerate(HISTOGRAM_BUCKETS):
+            if upper is None or num_queries <= upper:
+                self.histogram[index] += 1
+                break
+
+        self.fingerprints.update(queries)
+        # Keep only the most frequent fingerprints
+        if len(self.fingerprints) > 2 * self.max_fingerprints:
+            self.fingerprints = Counter(dict(self.fingerprints.most_common(self.max_fingerprints)))
+
+        if stacks:
+            self.stacks.update(stacks)
+            self.stack_timings.update(stack_timings)
+            # Keep only the heaviest call stacks
+            if len(self.stack_timings) > 2 * self.max_stacks:
+                self.stack_timings = Counter(dict(self.stack_timings.most_common(self.max_stacks)))
+                self.stacks = Counter({stack: self.stacks[stack] for stack in self.stack_timings})
+
+    def as_dict(self):
+        db_times = sorted(self.db_times)
+        return OrderedDict([
+            ('endpoint', self.name),
+            ('view', self.view),
+            ('requests', self.count),
+            ('queries', self.total_queries),
+            ('avg_queries', round(self.total_queries / self.count, 1) if self.count else 0),
+            ('db_time', round(self.total_db_time, 4)),
+            ('avg_db_time', round(self.total_db_time / self.count, 4) if self.count else 0),
+            ('p50_db_time', round(percentile(db_times, 50), 4)),
+            ('p95_db_time', round(percentile(db_times, 95), 4)),
+            ('p99_db_time', round(percentile(db_times, 99), 4)),
+            ('avg_time', round(self.total_time / self.count, 4) if self.count else 0),
+            ('over_budget', self.budget_violations),
+            ('histogram', ' '.join(
+                '%s:%d' % (histogram_bucket_label(index), n)
+                for index, n in enumerate(self.histogram) if n
+            )),
+        ])
+
+    def top_fingerprints(self, n=10):
+        return self.fingerprints.most_common(n)
+
+    @property
+    def has_profile(self):
+        return bool(self.stacks)
+
+
+class AggregationStore(object):
+
+    def __init__(self, max_endpoints=500, max_samples=1000, max_fingerprints=20, max_stacks=200):
+        self.max_endpoints = max_endpoints
+        self.max_samples = max_samples
+        self.max_fingerprints = max_fingerprints
+        self.max_stacks = max_stacks
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = OrderedDict()
+
+    def record(self, name, view, collector):
+        """
+        Account for a request, given its collector
+        """
+        num_queries = collector.total
+        with self._lock:
+            stats = self._endpoints.pop(name, None)
+            if stats is None:
+                stats = EndpointStats(name, view, self.max_samples, self.max_fingerprints, self.max_stacks)
+            # Least recently used endpoints are discarded first
+            self._endpoints[name] = stats
+            if len(self._endpoints) > self.max_endpoints:
+                self._endpoints.popitem(last=False)
+            stats.record(num_queries, collector.db_time, collector.elapsed, collector.queries,
+                         over_budget=bool(getattr(collector, 'budget_violations', None)),
+                         stacks=collector.stacks, stack_timings=collector.stack_timings)
+
+    def get(self, name):
+        return self._endpoints.get(name)
+
+    def top_fingerprints(self, name, n=10):
+        """
+        The most frequent fingerprints of an endpoint (None if unknown);
+        the live Counter is updated by the request threads, so it is only read under the lock
+        """
+        with self._lock:
+            stats = self._endpoints.get(name)
+            return None if stats is None else stats.top_fingerprints(n)
+
+    def profile(self, name):
+        """
+        Copies of the stacks and stack_timings Counters of an endpoint,
+        taken under the lock (None if the endpoint is unknown or has no profile)
+        """
+        with self._lock:
+            stats = self._endpoints.get(name)
+            if stats is None or not stats.has_profile:
+                return None
+            return stats.stacks.copy(), stats.stack_timings.copy()
+
+    def snapshot(self, order_by='db_time'):
+        """
+        Returns the stats of all endpoints as a list of dictionaries,
+        heaviest DB consumers first
+        """
+        with self._lock:
+            rows = [stats.as_dict() for stats in self._endpoints.values()]
+        rows.sort(key=lambda row: row[order_by], reverse=True)
+        return rows
+
+
+aggregation_store = AggregationStore()
@@ -0,0 +1,239 @@
+"""
+Offline analysis of recorded query logs.
+
+Two formats are understood, even mixed in the same file:
+
+- the JSON records written by QueryCountMiddleware (see reporting.JSONLinesSink)
+- the output of Django's SQL debug logger ("django.db.backends"), i.e.:
+
+    (0.002) SELECT ... FROM "app_track" WHERE "app_track"."id" = 1; args=(1,)
+
+  Since these lines are not tied to a request, the queries preceding each
+  runserver's request line ('"GET /tracks/ HTTP/1.1" 200 1234') are
+  attributed to that request.
+
+Files (optionally gzip compressed) are read line by line, so their size is not an issue;
+multiple files are analyzed in parallel by a pool of processes, and the results merged.
+"""
+import gzip
+import json
+import multiprocessing
+import re
+from collections import OrderedDict
+
+from .fingerprint import fingerprint
+
+
+_debug_line_re = re.compile(r'\((\d+(?:\.\d+)?)\) (.+?); args=(.*?)(?:; alias=(\w+))?\s*$')
+_request_line_re = re.compile(r'"(?:GET|POST|PUT|PATCH|DELETE|HEAD|OPTIONS) ([^\s?]+)\S* HTTP/[\d.]+"')
+
+
+class LogAnalysis(object):
+    """
+    Mergeable aggregates of one or more query logs
+    """
+
+    def __init__(self, nplusone_threshold=5):
+        self.nplusone_threshold = nplusone_threshold
+        self.files = 0
+        self.lines = 0
+        self.errors = 0
+        self.requests = 0
+        # endpoint -> [requests, queries, db_time]
+        self.endpoints = {}
+        # fingerprint -> [count, time, max_time]
+        self.fingerprints = {}
+        # (endpoint, fingerprint) -> [requests, max_count]
+        self.nplusone = {}
+        # fingerprint -> execution plan (the first one found)
+        self.plans = {}
+
+    def add_request(self, endpoint, queries):
+        """
+        Account for a request;
+        <queries> is a list of tuples (fingerprint, count, time, max_time)
+        """
+        self.requests += 1
+        endpoint = endpoint or '<unknown>'
+        stats = self.endpoints.setdefault(endpoint, [0, 0, 0.0])
+        stats[0] += 1
+        for key, count, time, max_time in queries:
+            stats[1] += count
+            stats[2] += time
+            item = self.fingerprints.setdefault(key, [0, 0.0, 0.0])
+            item[0] += count
+            item[1] += time
+            item[2] = max(item[2], max_time)
+            if count > self.nplusone_threshold:
+                suspect = self.nplusone.setdefault((endpoint, key), [0, 0])
+                suspect[0] += 1
+                suspect[1] = max(suspect[1], count)
+
+    def merge(self, other):
+        self.files += other.files
+        self.lines += other.lines
+        self.errors += other.errors
+        self.requests += other.requests
+        for endpoint, (requests, queries, db_time) in other.endpoints.items():
+            stats = self.endpoints.setdefault(endpoint, [0, 0, 0.0])
+            stats[0] += requests
+            stats[1] += queries
+            stats[2] += db_time
+        for key, (count, time, max_time) in other.fingerprints.items():
+            item = self.fingerprints.setdefault(key, [0, 0.0, 0.0])
+            item[0] += count
+            item[1] += time
+            item[2] = max(item[2], max_time)
+        for key, (requests, max_count) in other.nplusone.items():
+            suspect = self.nplusone.setdefault(key, [0, 0])
+            suspect[0] += requests
+            suspect[1] = max(suspect[1], max_count)
+        for key, plan in other.plans.items():
+            self.plans.setdefault(key, plan)
+        return self
+
+    def top_endpoints(self, n=10):
+        """
+        Endpoints by total DB time
+        """
+        rows = [
+            OrderedDict([
+                ('endpoint', endpoint),
+                ('requests', requests),
+                ('queries', queries),
+                ('avg_queries', round(queries / requests, 1)),
+                ('db_time', round(db_time, 4)),
+                ('avg_db_time', round(db_time / requests, 4)),
+            ])
+            for endpoint, (requests, queries, db_time) in self.endpoints.items()
+        ]
+        rows.sort(key=lambda row: row['db_time'], reverse=True)
+        return rows[:n]
+
+    def top_fingerprints(self, n=10):
+        """
+        Fingerprints by frequency x average latency
+        """
+        rows = [
+            OrderedDict([
+                ('fingerprint', key),
+                ('count', count),
+                ('avg_time', round(time / count, 6)),
+                ('max_time', round(max_time, 6)),
+                ('impact', round(time, 4)),
+            ])
+            for key, (count, time, max_time) in self.fingerprints.items()
+        ]
+        rows.sort(key=lambda row: row['impact'], reverse=True)
+        return rows[:n]
+
+    def top_nplusone(self, n=10):
+        """
+        Query shapes executed more than <nplusone_threshold> times in the same request
+        """
+        rows = [
+            OrderedDict([
+                ('endpoint', endpoint),
+                ('fingerprint', key),
+                ('requests', requests),
+                ('max_count', max_count),
+            ])
+            for (endpoint, key), (requests, max_count) in self.nplusone.items()
+        ]
+        rows.sort(key=lambda row: (row['requests'] * row['max_count'], row['max_count']), reverse=True)
+        return rows[:n]
+
+
+def open_log(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8', errors='replace')
+    return open(filename, 'r', encoding='utf-8', errors='replace')
+
+
+def _queries_from_record(record):
+    queries = record.get('queries')
+    if queries is None:
+        return []
+    return [
+        (item['fingerprint'], item['count'], item['time'], item.get('max_time', item['time']))
+        for item in queries
+    ]
+
+
+def _group_queries(pending):
+    """
+    Groups a list of (fingerprint, duration) by fingerprint
+    """
+    grouped = OrderedDict()
+    for key, duration in pending:
+        item = grouped.get(key)
+        if item is None:
+            grouped[key] = [1, duration, duration]
+        else:
+            item[0] += 1
+            item[1] += duration
+            item[2] = max(item[2], duration)
+    return [(key, count, time, max_time) for key, (count, time, max_time) in grouped.items()]
+
+
+def analyze_lines(lines, analysis):
+    """
+    Feeds the given lines into <analysis>
+    """
+    # Queries from the SQL debug logger, waiting for the next request line
+    pending = []
+    for line in lines:
+        analysis.lines += 1
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                record = json.loads(line)
+                analysis.add_request(record.get('endpoint') or record.get('path'), _queries_from_record(record))
+                for item in record.get('queries') or []:
+                    if item.get('plan'):
+                        analysis.plans.setdefault(item['fingerprint'], item['plan'])
+            except (ValueError, KeyError, TypeError):
+                analysis.errors += 1
+            continue
+        match = _debug_line_re.search(line)
+        if match is not None:
+            pending.append((fingerprint(match.group(2)), float(match.group(1))))
+            continue
+        match = _request_line_re.search(line)
+        if match is not None:
+            analysis.add_request(match.group(1), _group_queries(pending))
+            pending = []
+    if pending:
+        analysis.add_request(None, _group_queries(pending))
+    return analysis
+
+
+def analyze_file(filename, nplusone_threshold=5):
+    analysis = LogAnalysis(nplusone_threshold=nplusone_threshold)
+    analysis.files = 1
+    with open_log(filename) as f:
+        analyze_lines(f, analysis)
+    return analysis
+
+
+def _analyze_file(args):
+    return analyze_file(*args)
+
+
+def analyze_files(filenames, nplusone_threshold=5, processes=None):
+    """
+    Analyzes the given files, in parallel when more than one,
+    and returns the merged LogAnalysis
+    """
+    result = LogAnalysis(nplusone_threshold=nplusone_threshold)
+    tasks = [(filename, nplusone_threshold) for filename in filenames]
+    if len(tasks) <= 1 or processes == 1:
+        for analysis in map(_analyze_file, tasks):
+            result.merge(analysis)
+    else:
+        with multiprocessing.Pool(processes=min(processes or multiprocessing.cpu_count(), len(tasks))) as pool:
+            for analysis in pool.imap_unordered(_analyze_file, tasks):
+                result.merge(analysis)
+    return result
@@ -2,9 +2,23 @@ from django.conf import settings
 
 QUERY_SUPERUSER_ONLY = getattr(settings, 'QUERY_INSPECTOR_QUERY_SUPERUSER_ONLY', True)
 QUERY_DEFAULT_LIMIT = getattr(settings, 'QUERY_INSPECTOR_QUERY_DEFAULT_LIMIT', '0')
+QUERY_STREAM_BATCH_SIZE = getattr(settings, 'QUERY_INSPECTOR_QUERY_STREAM_BATCH_SIZE', 2000)
+QUERY_PREVIEW_MAX_ROWS = getattr(settings, 'QUERY_INSPECTOR_QUERY_PREVIEW_MAX_ROWS', 1000)
+QUERY_TIMEOUT = getattr(settings, 'QUERY_INSPECTOR_QUERY_TIMEOUT', 0)
+QUERY_BACKGROUND_WORKERS = getattr(settings, 'QUERY_INSPECTOR_QUERY_BACKGROUND_WORKERS', 2)
+QUERY_BACKGROUND_TIMEOUT = getattr(settings, 'QUERY_INSPECTOR_QUERY_BACKGROUND_TIMEOUT', 0)
+QUERY_SPOOL_FOLDER = getattr(settings, 'QUERY_INSPECTOR_QUERY_SPOOL_FOLDER', None)
+QUERY_SPOOL_MAX_AGE = getattr(settings, 'QUERY_INSPECTOR_QUERY_SPOOL_MAX_AGE', 24 * 60 * 60)
+QUERY_CACHE = getattr(settings, 'QUERY_INSPECTOR_QUERY_CACHE', 'default')
+QUERY_CACHE_TTL = getattr(settings, 'QUERY_INSPECTOR_QUERY_CACHE_TTL', 0)
+QUERY_CACHE_MAX_ROWS = getattr(settings, 'QUERY_INSPECTOR_QUERY_CACHE_MAX_ROWS', 10000)
 QUERY_STOCK_QUERIES = getattr(settings, 'QUERY_INSPECTOR_QUERY_STOCK_QUERIES', [])
 QUERY_STOCK_VIEWS = getattr(settings, 'QUERY_INSPECTOR_QUERY_STOCK_VIEWS', None)
 DEFAULT_CSV_FIELD_DELIMITER = getattr(settings, 'QUERY_INSPECTOR_DEFAULT_CSV_FIELD_DELIMITER', ';')
+FINGERPRINT_CACHE_SIZE = getattr(settings, 'QUERY_INSPECTOR_FINGERPRINT_CACHE_SIZE', 4096)
+FORMATTED_SQL_CACHE_SIZE = getattr(settings, 'QUERY_INSPECTOR_FORMATTED_SQL_CACHE_SIZE', 512)
+SLOW_QUERY_LOG_SIZE = getattr(settings, 'QUERY_INSPECTOR_SLOW_QUERY_LOG_SIZE', 100)
+EXPLAIN_CACHE_SIZE = getattr(settings, 'QUERY_INSPECTOR_EXPLAIN_CACHE_SIZE', 1000)
 
 
 SQL_BLACKLIST = getattr(
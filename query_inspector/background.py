@@ -0,0 +1,325 @@
+"""
+Background execution of long-running stored queries.
+
+Jobs are run by a local thread pool (no external broker is required);
+rows are spooled to a file as JSON lines (the column names first, then one
+array of values per row), so that results of any size can be paged through
+and downloaded when the job is done.
+
+The state of each job is kept in a small JSON file next to the results,
+so it can be polled from any server process sharing the spool folder;
+cancellation relies on cancel_query(), hence it works across processes
+on PostgreSQL only.
+
+Sample usage:
+
+    job = submit_query(query, params)
+    ...
+    job = BackgroundJob.load(job.id)
+    if job.status == 'done':
+        recordset = job.read_rows(offset=0, limit=100)
+"""
+import itertools
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.forms import ValidationError
+from . import app_settings
+from .recordset import Recordset, RowView, unique_columns
+from .sql import cancel_query, passes_blacklist, statement_timeout, stream_cursor, QueryCancelled
+
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED, )
+
+_executor = None
+_executor_lock = threading.Lock()
+_jobs_lock = threading.Lock()
+
+
+def get_spool_folder():
+    """
+    The folder where results are spooled; since they might be sensitive,
+    it must belong to the current user, and the default one is private to it
+    (each user gets its own "query_inspector-<uid>" temporary folder)
+    """
+    folder = app_settings.QUERY_SPOOL_FOLDER
+    if not folder:
+        name = 'query_inspector-%d' % os.getuid() if hasattr(os, 'getuid') else 'query_inspector'
+        folder = os.path.join(tempfile.gettempdir(), name)
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        info = os.stat(folder)
+        if info.st_uid != os.getuid():
+            raise ImproperlyConfigured('Spool folder "%s" is not owned by the current user' % folder)
+        if not app_settings.QUERY_SPOOL_FOLDER and info.st_mode & 0o077:
+            os.chmod(folder, 0o700)
+    return folder
+
+
+def _open_private(filename):
+    """
+    Opens a file for writing, readable by the current user only
+    """
+    return os.fdopen(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app_settings.QUERY_BACKGROUND_WORKERS,
+                thread_name_prefix='query_inspector.BackgroundJob',
+            )
+        return _executor
+
+
+class BackgroundJob(object):
+    """
+    The state of a background query; job ids are also used
+    as cancellation tokens (see statement_timeout())
+    """
+
+    fields = (
+        'id', 'query_id', 'title', 'sql', 'params', 'using', 'timeout',
+        'status', 'rows', 'columns', 'error', 'created', 'started', 'finished',
+        'host', 'pid',
+    )
+
+    def __init__(self, **kwargs):
+        self.id = uuid.uuid4().hex
+        self.query_id = None
+        self.title = ''
+        self.sql = ''
+        self.params = {}
+        self.using = DEFAULT_DB_ALIAS
+        self.timeout = None
+        self.status = STATUS_PENDING
+        self.rows = 0
+        self.columns = []
+        self.error = ''
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # The server process which runs the job
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '<BackgroundJob %s: %s, %d rows>' % (self.id, self.status, self.rows)
+
+    @staticmethod
+    def is_valid_id(job_id):
+        return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+    @classmethod
+    def load(cls, job_id):
+        """
+        Returns the job with the given id, or None
+        """
+        if not cls.is_valid_id(job_id):
+            return None
+        try:
+            with open(os.path.join(get_spool_folder(), job_id + '.json')) as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def status_filename(self):
+        return os.path.join(get_spool_folder(), self.id + '.json')
+
+    @property
+    def data_filename(self):
+        return os.path.join(get_spool_folder(), self.id + '.jsonl')
+
+    @property
+    def is_finished(self):
+        return self.status in FINAL_STATUSES
+
+    @property
+    def is_orphaned(self):
+        """
+        True when the job is not finished, but the server process running it
+        has terminated; this can be detected on the same host only
+        """
+        if self.is_finished or self.pid is None or os.name != 'posix' or self.host != socket.gethostname():
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            # i.e. PermissionError: the process exists
+            pass
+        return False
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def save(self):
+        # Written to a temporary file first, so that readers never see a partial file
+        filename = self.status_filename
+        with _open_private(filename + '.tmp') as f:
+            json.dump({name: getattr(self, name) for name in self.fields}, f, cls=DjangoJSONEncoder)
+        os.replace(filename + '.tmp', filename)
+
+    def delete(self):
+        for filename in (self.status_filename, self.data_filename, ):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def iter_rows(self, offset=0, limit=None):
+        """
+        Yields the spooled rows as RowViews
+        """
+        with open(self.data_filename) as f:
+            columns = json.loads(f.readline())
+            index = {name: position for position, name in enumerate(columns)}
+            stop = None if limit is None else offset + limit
+            for line in itertools.islice(f, offset, stop):
+                yield RowView(index, json.loads(line))
+
+    def read_rows(self, offset=0, limit=None):
+        """
+        Returns (a page of) the spooled rows as a Recordset
+        """
+        return Recordset(self.columns, [row.as_tuple() for row in self.iter_rows(offset, limit)])
+
+    def cancel(self):
+        with _jobs_lock:
+            job = BackgroundJob.load(self.id)
+            if job is not None and job.status == STATUS_PENDING:
+                job.status = STATUS_CANCELLED
+                job.finished = time.time()
+                job.save()
+                return True
+        return cancel_query(self.id, using=self.using)
+
+
+def run_job(job, batch_size=None):
+    """
+    Executes the statement of the job, spooling the resulting rows;
+    the job status is saved after each batch of rows
+    """
+    batch_size = batch_size or app_settings.QUERY_STREAM_BATCH_SIZE
+    with _jobs_lock:
+        # The job might have been cancelled while waiting in the queue
+        current = BackgroundJob.load(job.id)
+        if current is not None and current.status != STATUS_PENDING:
+            return current
+        job.status = STATUS_RUNNING
+        job.started = time.time()
+        job.save()
+
+    try:
+        with _open_private(job.data_filename) as f:
+            with statement_timeout(job.timeout, job.id, job.using) as deadline:
+                with stream_cursor(job.using) as cursor:
+                    cursor.execute(job.sql, job.params)
+                    rows = cursor.fetchmany(batch_size)
+                    job.columns = unique_columns(col[0] for col in cursor.description)
+                    f.write(json.dumps(job.columns) + '\n')
+                    while rows:
+                        for row in rows:
+                            f.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+                        job.rows += len(rows)
+                        job.save()
+                        deadline.restart()
+                        rows = cursor.fetchmany(batch_size)
+        job.status = STATUS_DONE
+    except Exception as e:
+        job.status = STATUS_CANCELLED if isinstance(e, QueryCancelled) else STATUS_FAILED
+        job.error = str(e) or repr(e)
+    finally:
+        job.finished = time.time()
+        job.save()
+    return job
+
+
+def _run_in_worker(job):
+    try:
+        return run_job(job)
+    finally:
+        # Connections are per thread; don't keep them open in idle workers
+        connections[job.using].close()
+
+
+def submit_query(query, params, sql_limit=0, using=DEFAULT_DB_ALIAS):
+    """
+    Schedules the execution of a Query in the background,
+    and returns the new BackgroundJob
+    """
+    sql = query.sql
+    if sql_limit > 0:
+        sql += ' limit %d' % sql_limit
+    passed_blacklist, failing_words = passes_blacklist(sql)
+    if not passed_blacklist:
+        raise ValidationError("Query failed the SQL blacklist: %s" % ', '.join(failing_words), code="InvalidSql")
+
+    cleanup_jobs()
+    job = BackgroundJob(
+        query_id=query.id,
+        title=str(query),
+        sql=sql,
+        params=params,
+        using=using,
+        timeout=app_settings.QUERY_BACKGROUND_TIMEOUT,
+    )
+    job.save()
+    get_executor().submit(_run_in_worker, job)
+    return job
+
+
+def list_jobs(query_id=None):
+    """
+    Returns the known jobs (optionally, for the given query), most recent first;
+    the jobs left pending or running by a terminated server process are marked as failed
+    """
+    jobs = []
+    for filename in os.listdir(get_spool_folder()):
+        name, extension = os.path.splitext(filename)
+        if extension == '.json':
+            job = BackgroundJob.load(name)
+            if job is not None and (query_id is None or job.query_id == query_id):
+                if job.is_orphaned:
+                    job.status = STATUS_FAILED
+                    job.error = 'The server process running the job has terminated'
+                    job.finished = time.time()
+                    job.save()
+                jobs.append(job)
+    return sorted(jobs, key=lambda job: job.created, reverse=True)
+
+
+def cleanup_jobs(max_age=None):
+    """
+    Deletes the finished jobs older than <max_age> seconds
+    (default: QUERY_INSPECTOR_QUERY_SPOOL_MAX_AGE)
+    """
+    max_age = app_settings.QUERY_SPOOL_MAX_AGE if max_age is None else max_age
+    n = 0
+    for job in list_jobs():
+        if job.is_finished and job.finished < time.time() - max_age:
+            job.delete()
+            n += 1
+    return n
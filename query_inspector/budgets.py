@@ -0,0 +1,112 @@
+"""
+Per-view query budgets, enforced by QueryCountMiddleware.
+
+Budgets can be declared in settings, by url name or by view path:
+
+    QUERYCOUNT = {
+        ...
+        'BUDGETS': {
+            'track-list': {'MAX_QUERIES': 10, 'MAX_DB_TIME': 0.05, 'MAX_DUPLICATES': 2},
+            'app.views.album_detail': {'MAX_QUERIES': 5},
+        },
+        'BUDGET_MODE': 'log',
+    }
+
+or with a decorator:
+
+    from query_inspector.budgets import query_budget
+
+    @query_budget(max_queries=10, max_duplicates=2)
+    def track_list(request):
+        ...
+
+When both are given, settings win.
+"""
+import logging
+from collections import namedtuple
+
+from django.dispatch import Signal
+
+
+logger = logging.getLogger('query_inspector')
+
+QueryBudget = namedtuple('QueryBudget', [
+    'max_queries',
+    'max_db_time',
+    'max_duplicates',
+])
+
+BudgetViolation = namedtuple('BudgetViolation', [
+    'metric',
+    'limit',
+    'value',
+])
+
+# Sent whenever a request exceeds its budget, in all modes;
+# connect your metrics client here. Arguments: request, endpoint, violations
+query_budget_exceeded = Signal()
+
+BUDGET_MODES = ('log', 'raise', 'metric', )
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(max_queries=None, max_db_time=None, max_duplicates=None):
+    """
+    Declares the query budget of a view (function or class-based)
+    """
+    budget = QueryBudget(max_queries, max_db_time, max_duplicates)
+
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def budget_from_settings(values):
+    return QueryBudget(
+        values.get('MAX_QUERIES'),
+        values.get('MAX_DB_TIME'),
+        values.get('MAX_DUPLICATES'),
+    )
+
+
+def get_budget(resolver_match, budgets):
+    """
+    Returns the QueryBudget for the resolved view, or None;
+    <budgets> is the BUDGETS setting
+    """
+    if resolver_match is None:
+        return None
+    for key in (resolver_match.view_name, resolver_match._func_path):
+        if key in budgets:
+            return budget_from_settings(budgets[key])
+    func = resolver_match.func
+    budget = getattr(func, 'query_budget', None)
+    if budget is None:
+        budget = getattr(getattr(func, 'view_class', None), 'query_budget', None)
+    return budget
+
+
+def check_budget(budget, collector):
+    """
+    Returns the list of BudgetViolation for the given collector
+    """
+    violations = []
+    if budget.max_queries is not None and collector.total > budget.max_queries:
+        violations.append(BudgetViolation('queries', budget.max_queries, collector.total))
+    if budget.max_db_time is not None and collector.db_time > budget.max_db_time:
+        violations.append(BudgetViolation('db_time', budget.max_db_time, round(collector.db_time, 6)))
+    if budget.max_duplicates is not None:
+        duplicates = max([stats['duplicates'] for stats in collector.stats.values()] or [0])
+        if duplicates > budget.max_duplicates:
+            violations.append(BudgetViolation('duplicates', budget.max_duplicates, duplicates))
+    return violations
+
+
+def describe_violations(endpoint, violations):
+    return 'Query budget exceeded by %s: %s' % (endpoint, ', '.join(
+        '%s=%s (max %s)' % (v.metric, v.value, v.limit) for v in violations
+    ))
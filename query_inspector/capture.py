@@ -0,0 +1,401 @@
+"""
+Low-level query capture, built on Django's database instrumentation hooks.
+
+See: https://docs.djangoproject.com/en/3.2/topics/db/instrumentation/
+
+Unlike scanning `connection.queries`, this works with DEBUG disabled,
+and records each statement once, as it is executed.
+
+Connections are thread-local, and under ASGI the ORM runs in a thread
+different from the one serving the request (see sync_to_async());
+for this reason, a single dispatcher is installed as execute wrapper on every
+connection, and forwards each statement to the collector bound to the
+current context (contextvars are propagated by sync_to_async()).
+"""
+import datetime
+import re
+import threading
+import timeit
+import traceback
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .app_settings import SLOW_QUERY_LOG_SIZE
+from .fingerprint import fingerprint
+from .stack import find_callsite, find_project_stack
+
+
+READ_QUERY_REGEX = re.compile("SELECT .*")
+
+CapturedQuery = namedtuple('CapturedQuery', [
+    'alias',
+    'fingerprint',
+    'duration',
+    'rowcount',
+    'many',
+])
+
+SlowQuery = namedtuple('SlowQuery', [
+    'timestamp',
+    'alias',
+    'sql',
+    'params',
+    'duration',
+    'rowcount',
+    'stack',
+    'request_path',
+])
+
+# The most recent slow queries, from all requests (see QueryCollector.slow_query_threshold)
+slow_query_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+# The collectors active in the current thread or coroutine, if any
+# (innermost last); each statement is recorded by all of them
+_active_collectors = ContextVar('query_inspector_collectors', default=())
+
+
+def get_current_collector():
+    """
+    Returns the innermost QueryCollector active in the current context, or None
+    """
+    collectors = _active_collectors.get()
+    return collectors[-1] if collectors else None
+
+
+@contextmanager
+def suspend_capture():
+    """
+    Statements executed in this block are not recorded by the active collectors
+    (i.e. the EXPLAIN statements issued by the collectors themselves)
+    """
+    token = _active_collectors.set(())
+    try:
+        yield
+    finally:
+        _active_collectors.reset(token)
+
+
+def dispatch_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on all connections;
+    when no collector is active, it just runs the statement.
+    """
+    collectors = _active_collectors.get()
+    if not collectors:
+        return execute(sql, params, many, context)
+
+    callsite = None
+    if any(c.capture_callsite for c in collectors):
+        callsite = find_callsite()
+    stack = None
+    if any(c.capture_stack for c in collectors):
+        stack = find_project_stack()
+
+    start = timeit.default_timer()
+    succeeded = False
+    try:
+        result = execute(sql, params, many, context)
+        succeeded = True
+        return result
+    finally:
+        duration = timeit.default_timer() - start
+        connection = context['connection']
+        rowcount = _get_rowcount(context)
+        executed_sql = None
+        if any(c.ignore_executed_sql is not None for c in collectors):
+            executed_sql = _get_executed_sql(context, sql, params, many)
+        for collector in collectors:
+            collector.record(connection.alias, sql, duration, callsite, params=params, rowcount=rowcount, many=many,
+                             stack=stack, connection=connection if succeeded else None, executed_sql=executed_sql)
+
+
+def _get_rowcount(context):
+    try:
+        return context['cursor'].rowcount
+    except Exception:
+        return None
+
+
+def _get_executed_sql(context, sql, params, many):
+    """
+    The statement with the params interpolated, as found in connection.queries
+    """
+    if many:
+        return sql
+    try:
+        return context['connection'].ops.last_executed_query(context['cursor'], sql, params)
+    except Exception:
+        return sql
+
+
+def install_dispatcher(connection, **kwargs):
+    # The connection might be opened inside a "with connection.execute_wrapper(...)" block,
+    # which pops the last wrapper on exit: keep the dispatcher at the bottom of the stack
+    if dispatch_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, dispatch_query)
+
+
+def install_dispatcher_on_all_connections():
+    """
+    Install the dispatcher on the connections of the current thread;
+    connections opened later (from any thread) will receive it
+    from the connection_created signal
+    """
+    for connection in connections.all():
+        install_dispatcher(connection)
+
+
+connection_created.connect(install_dispatcher, dispatch_uid='query_inspector_install_dispatcher')
+
+
+class QueryCollector(object):
+    """
+    Collects the SQL statements executed on one or more db connections.
+
+    Sample usage:
+
+        with QueryCollector() as collector:
+            ... do your stuff ...
+
+        print(collector.total)
+        for sql, count in collector.queries.most_common(5):
+            ...
+
+    stats: per-alias counters; i.e.:
+        {'default': {'reads': 3, 'writes': 1, 'total': 4, 'duplicates': 2}, ...}
+    queries: a Counter of all (not ignored) sql statements, grouped by fingerprint
+    samples: the first sql statement seen for each fingerprint
+    callsites: a Counter of (fingerprint, callsite) pairs, where callsite
+               is a tuple (filename, lineno, function); collected
+               only when <capture_callsite> is set
+    timings: the total duration of all statements, grouped by fingerprint
+    stacks: a Counter of the project's call stacks which executed the statements,
+            as tuples of frame labels (outermost first); collected only when <capture_stack> is set
+    stack_timings: the total duration of the statements, grouped by call stack
+    plans: the execution plans of the slow or repeated statements, by fingerprint;
+           collected only when <explain_threshold> or <explain_duplicates> is set
+    log: the list of all statements, as CapturedQuery tuples, in execution order
+    slow_queries: the statements which took longer than <slow_query_threshold>,
+                  as SlowQuery tuples; these are also appended to the
+                  (bounded) global slow_query_log
+
+    "duplicates" is the number of executions of the most common query shape
+    """
+
+    def __init__(self, aliases=None, ignore_sql=None, read_query_regex=READ_QUERY_REGEX, fingerprint_sql=fingerprint,
+                 capture_callsite=False, slow_query_threshold=None, capture_stack=False,
+                 explain_threshold=None, explain_duplicates=None, explain_analyze=False, ignore_executed_sql=None):
+        """
+        <aliases>: the db connections to be observed (default: all)
+        <ignore_sql>: an optional callable; when it returns True for a given sql,
+                      the statement is not recorded
+        <fingerprint_sql>: the callable used to group statements having the same shape;
+                           None = group by raw sql
+        <capture_callsite>: attribute each statement to the project's code which executed it
+                            (see stack.find_callsite())
+        <slow_query_threshold>: keep sql, params and stack trace of the statements
+                                lasting longer than this (in seconds); None = disabled
+        <capture_stack>: collect the project's call stack of each statement
+                         (see stack.find_project_stack() and profiler.QueryProfiler)
+        <explain_threshold>: explain the statements lasting longer than this (in seconds); None = disabled
+        <explain_duplicates>: explain the query shapes executed at least this many times; None = disabled
+        <explain_analyze>: use EXPLAIN ANALYZE, which actually runs the statement again
+                           (see explain.py)
+        <ignore_executed_sql>: like <ignore_sql>, but receives the statement as executed,
+                               with the params interpolated (as in connection.queries)
+        """
+        if aliases is None:
+            aliases = list(connections)
+        self.aliases = list(aliases)
+        self.ignore_sql = ignore_sql
+        self.ignore_executed_sql = ignore_executed_sql
+        self.read_query_regex = read_query_regex
+        self.fingerprint_sql = fingerprint_sql
+        self.capture_callsite = capture_callsite
+        self.slow_query_threshold = slow_query_threshold
+        self.capture_stack = capture_stack
+        self.explain_threshold = explain_threshold
+        self.explain_duplicates = explain_duplicates
+        self.explain_analyze = explain_analyze
+        self._token = None
+        # Statements can be recorded from multiple threads (see sync_to_async())
+        self._lock = threading.Lock()
+        self.start_time = None
+        self.end_time = None
+        # Optional request info (see QueryCountMiddleware)
+        self.host = None
+        self.request_path = None
+        self.endpoint = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        for alias in self.aliases:
+            self._init_alias(alias)
+        self.queries = Counter()
+        self.samples = {}
+        self.callsites = Counter()
+        self.timings = Counter()
+        self.stacks = Counter()
+        self.stack_timings = Counter()
+        self.plans = {}
+        self.log = []
+        self.slow_queries = []
+        self._alias_queries = {}
+        self.db_time = 0.0
+
+    def _init_alias(self, alias):
+        stats = {'writes': 0, 'reads': 0, 'total': 0, 'duplicates': 0, 'time': 0.0}
+        self.stats[alias] = stats
+        return stats
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        Execute wrapper; see BaseDatabaseWrapper.execute_wrapper().
+        Only required when installing the collector explicitly;
+        normally, statements are recorded via dispatch_query()
+        """
+        callsite = find_callsite() if self.capture_callsite else None
+        stack = find_project_stack() if self.capture_stack else None
+        start = timeit.default_timer()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            executed_sql = None
+            if self.ignore_executed_sql is not None:
+                executed_sql = _get_executed_sql(context, sql, params, many)
+            self.record(context['connection'].alias, sql, timeit.default_timer() - start, callsite,
+                        params=params, rowcount=_get_rowcount(context), many=many, stack=stack,
+                        executed_sql=executed_sql)
+
+    def record(self, alias, sql, duration=0.0, callsite=None, params=None, rowcount=None, many=False, stack=None,
+               connection=None, executed_sql=None):
+        """
+        Account for a single executed statement; O(1)
+
+        When a <connection> is given, the statement can be explained
+        (see <explain_threshold> and <explain_duplicates>);
+        <executed_sql> is checked with <ignore_executed_sql>, when given
+        """
+        if alias not in self.aliases:
+            return
+        if self.ignore_sql is not None and self.ignore_sql(sql):
+            return
+        if self.ignore_executed_sql is not None and executed_sql is not None and self.ignore_executed_sql(executed_sql):
+            return
+
+        slow_query = None
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            slow_query = SlowQuery(
+                datetime.datetime.now(), alias, sql, params, duration, rowcount,
+                self._format_stack(), self.request_path,
+            )
+            slow_query_log.append(slow_query)
+
+        with self._lock:
+            key = self._record(alias, sql, duration, callsite, rowcount, many, stack)
+            if slow_query is not None:
+                self.slow_queries.append(slow_query)
+            explain = connection is not None and not many and key not in self.plans and (
+                (self.explain_threshold is not None and duration >= self.explain_threshold) or
+                (self.explain_duplicates is not None and self.queries[key] >= self.explain_duplicates)
+            )
+
+        if explain:
+            self._explain(connection, sql, params, key)
+
+    def _explain(self, connection, sql, params, key):
+        from .explain import get_plan
+        # (plans are cached by the default fingerprint, which might differ from <fingerprint_sql>)
+        plan = get_plan(connection, sql, params, analyze=self.explain_analyze)
+        if plan is not None:
+            with self._lock:
+                self.plans[key] = plan
+
+    @staticmethod
+    def _format_stack():
+        # Skip our own frames
+        stack = [frame for frame in traceback.extract_stack() if frame.filename != __file__]
+        return ''.join(traceback.format_list(stack))
+
+    def _record(self, alias, sql, duration, callsite, rowcount=None, many=False, stack=None):
+        stats = self.stats[alias]
+
+        if sql and self.read_query_regex.search(sql) is not None:
+            stats['reads'] += 1
+        else:
+            stats['writes'] += 1
+        stats['total'] += 1
+        stats['time'] += duration
+        self.db_time += duration
+
+        key = self.fingerprint_sql(sql) if self.fingerprint_sql is not None else sql
+        self.queries[key] += 1
+        self.timings[key] += duration
+        self.log.append(CapturedQuery(alias, key, duration, rowcount, many))
+        if key not in self.samples:
+            self.samples[key] = sql
+        if self.capture_callsite:
+            self.callsites[(key, callsite)] += 1
+        if self.capture_stack:
+            self.stacks[stack] += 1
+            self.stack_timings[stack] += duration
+
+        # Keep track of the worst offender on this connection;
+        # i.e. the query shape with the most duplicates
+        alias_queries = self._alias_queries.get(alias)
+        if alias_queries is None:
+            alias_queries = self._alias_queries[alias] = Counter()
+        alias_queries[key] += 1
+        if alias_queries[key] > stats['duplicates']:
+            stats['duplicates'] = alias_queries[key]
+        return key
+
+    def totals(self):
+        """
+        Returns a tuple (reads, writes, total) summed for all connections
+        """
+        reads = 0
+        writes = 0
+        for stats in self.stats.values():
+            reads += stats['reads']
+            writes += stats['writes']
+        return (reads, writes, reads + writes)
+
+    @property
+    def total(self):
+        return self.totals()[2]
+
+    @property
+    def elapsed(self):
+        """
+        Wall time (in seconds) between start() and stop()
+        """
+        if self.start_time is None:
+            return 0
+        end_time = self.end_time if self.end_time is not None else timeit.default_timer()
+        return end_time - self.start_time
+
+    def start(self):
+        assert self._token is None, 'QueryCollector already started'
+        install_dispatcher_on_all_connections()
+        self._token = _active_collectors.set(_active_collectors.get() + (self, ))
+        self.start_time = timeit.default_timer()
+        self.end_time = None
+
+    def stop(self):
+        if self._token is not None:
+            self.end_time = timeit.default_timer()
+            _active_collectors.reset(self._token)
+            self._token = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
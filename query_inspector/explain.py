@@ -0,0 +1,98 @@
+"""
+Capture of the execution plans of slow or repeated queries.
+
+The plan is obtained by running EXPLAIN (or, when <analyze> is set,
+"EXPLAIN (ANALYZE, BUFFERS)" on PostgreSQL, and "EXPLAIN ANALYZE" on MySQL)
+on a separate cursor; since EXPLAIN ANALYZE actually executes the statement,
+only SELECT statements are explained.
+
+Plans are cached by database alias and fingerprint, so each query shape
+is explained at most once per process.
+"""
+import threading
+
+from django.db import transaction
+
+from .app_settings import EXPLAIN_CACHE_SIZE
+from .capture import suspend_capture
+from .fingerprint import fingerprint
+
+
+# (alias, fingerprint) -> plan text (or None, when the query couldn't be explained)
+_plan_cache = {}
+_plan_cache_lock = threading.Lock()
+
+
+def explain_prefix(connection, analyze=False):
+    """
+    Returns the EXPLAIN clause supported by the connection's backend
+    """
+    options = {}
+    if analyze:
+        if connection.vendor == 'postgresql':
+            options = {'analyze': True, 'buffers': True}
+        elif connection.vendor == 'mysql' and connection.features.supports_explain_analyze:
+            options = {'analyze': True}
+    return connection.ops.explain_query_prefix(**options)
+
+
+def can_explain(connection, sql):
+    return (
+        connection.features.supports_explaining_query_execution and
+        sql.lstrip().upper().startswith('SELECT')
+    )
+
+
+def explain_query(connection, sql, params=None, analyze=False):
+    """
+    Runs EXPLAIN for the given statement, and returns the plan as text.
+
+    The statement is explained in a savepoint, so that a failure doesn't break
+    the current transaction; the EXPLAIN itself is not captured
+    """
+    with suspend_capture():
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(explain_prefix(connection, analyze) + ' ' + sql, params)
+                rows = cursor.fetchall()
+    return '\n'.join(
+        str(row[0]) if len(row) == 1 else ' '.join(str(value) for value in row)
+        for row in rows
+    )
+
+
+def get_plan(connection, sql, params=None, key=None, analyze=False):
+    """
+    Returns the plan of the given statement, explaining it only the first time
+    its fingerprint (<key>) is seen; returns None when the statement can't be explained
+    """
+    if key is None:
+        key = fingerprint(sql)
+    cache_key = (connection.alias, key)
+    with _plan_cache_lock:
+        if cache_key in _plan_cache:
+            return _plan_cache[cache_key]
+        if len(_plan_cache) >= EXPLAIN_CACHE_SIZE:
+            return None
+        # Reserve the slot, so that concurrent requests don't explain the same query
+        _plan_cache[cache_key] = None
+
+    plan = None
+    if can_explain(connection, sql):
+        try:
+            plan = explain_query(connection, sql, params, analyze=analyze)
+        except Exception:
+            plan = None
+
+    with _plan_cache_lock:
+        _plan_cache[cache_key] = plan
+    return plan
+
+
+def get_cached_plan(alias, key):
+    return _plan_cache.get((alias, key))
+
+
+def clear_plan_cache():
+    with _plan_cache_lock:
+        _plan_cache.clear()
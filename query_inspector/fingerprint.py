@@ -0,0 +1,52 @@
+"""
+SQL fingerprinting: reduce a statement to its "shape", so that
+
+    SELECT ... WHERE id = 1
+    SELECT ... WHERE id = 2
+    SELECT ... WHERE id IN (%s, %s, %s)
+    SELECT ... WHERE id IN (%s)
+
+are recognized as repetitions of the same query (i.e. the N+1 pattern).
+
+Fingerprints are cached by sql text, since the same statements tend to be
+executed over and over again.
+"""
+import re
+from functools import lru_cache
+
+from .app_settings import FINGERPRINT_CACHE_SIZE
+
+
+# String literals (with '' escapes)
+_string_re = re.compile(r"'(?:[^']|'')*'")
+# Numeric literals (but not digits inside identifiers, such as "T1" or "col_2")
+_number_re = re.compile(r"(?<![\w.\"$])\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+# Placeholders: %s, %(name)s, $1, ?
+_placeholder_re = re.compile(r"%\(\w+\)s|%s|\$\d+|\?")
+# IN-lists of any length
+_in_list_re = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+# Multi-row VALUES lists (bulk inserts)
+_values_re = re.compile(r"(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_whitespace_re = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=FINGERPRINT_CACHE_SIZE)
+def fingerprint(sql):
+    """
+    Returns the normalized "shape" of the given sql statement:
+
+        - string and numeric literals are replaced with "?"
+        - placeholders are replaced with "?"
+        - IN-lists are collapsed to "IN (...)"
+        - multi-row VALUES lists are collapsed to a single row
+        - whitespace is normalized
+    """
+    if not sql:
+        return ''
+    text = _string_re.sub('?', sql)
+    text = _number_re.sub('?', text)
+    text = _placeholder_re.sub('?', text)
+    text = _in_list_re.sub('IN (...)', text)
+    text = _values_re.sub(r'\1', text)
+    text = _whitespace_re.sub(' ', text)
+    return text.strip()
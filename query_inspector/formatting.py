@@ -0,0 +1,77 @@
+"""
+SQL prettifier shared by the middleware, the log handler and trace helpers.
+
+sqlparse and pygments (both optional) are imported only once, on first use;
+lexer and formatter instances are reused, and formatted results are
+memoized in a bounded LRU cache, since the same statements (or fingerprints)
+tend to be printed over and over again.
+"""
+import threading
+from functools import lru_cache
+
+# pygments' lazy loading of formatters is not thread-safe,
+# so all instances load the libraries one at a time
+_load_lock = threading.Lock()
+
+
+class SqlFormatter(object):
+
+    def __init__(self, style='monokai', cache_size=None):
+        """
+        <cache_size>: the size of the LRU cache of formatted statements
+                      (default: QUERY_INSPECTOR_FORMATTED_SQL_CACHE_SIZE)
+        """
+        if cache_size is None:
+            # (read here, so that importing the package does not require the settings)
+            from .app_settings import FORMATTED_SQL_CACHE_SIZE as cache_size
+        self.style = style
+        self._loaded = False
+        self.sqlparse = None
+        self.pygments = None
+        self.lexer = None
+        self.formatter = None
+        self.format = lru_cache(maxsize=cache_size)(self._format)
+
+    def _load(self):
+        with _load_lock:
+            if self._loaded:
+                return
+            # Check if sqlparse is available for indentation
+            try:
+                import sqlparse
+                self.sqlparse = sqlparse
+            except ImportError:
+                pass
+            # Check if Pygments is available for coloring
+            try:
+                import pygments
+                from pygments.lexers import SqlLexer
+                from pygments.formatters import TerminalTrueColorFormatter
+                self.pygments = pygments
+                self.lexer = SqlLexer()
+                self.formatter = TerminalTrueColorFormatter(style=self.style)
+            except ImportError:
+                pass
+            self._loaded = True
+
+    def _format(self, sql, prettify=True, reindent=True, colorize=True):
+        """
+        Returns sql indented (with sqlparse) and highlighted (with pygments),
+        when the respective library is available.
+        Use format(), which caches the results
+        """
+        if not self._loaded:
+            self._load()
+        if prettify and self.sqlparse is not None:
+            sql = self.sqlparse.format(sql, reindent=reindent)
+        if colorize and self.pygments is not None:
+            sql = self.pygments.highlight(sql, self.lexer, self.formatter)
+        return sql
+
+
+@lru_cache(maxsize=None)
+def get_sql_formatter(style='monokai'):
+    """
+    Returns the shared SqlFormatter for the given pygments style
+    """
+    return SqlFormatter(style=style)
@@ -0,0 +1,288 @@
+"""
+Index advisor: suggests the indexes which would speed up the recorded queries.
+
+For each query shape (see analyzer.LogAnalysis), the columns used in
+WHERE, JOIN ... ON and ORDER BY clauses are extracted; equality columns first,
+then the first range column (or the ORDER BY columns) make up a candidate
+composite index for each table.
+
+Candidates already covered by an existing index (read with Django's
+introspection) are discarded, and candidates which are a prefix of another one
+on the same table are folded into it; the others are ranked by the estimated
+time saved, which is the DB time spent by the queries which would use the index,
+weighted by what the execution plan (when recorded) tells about the table:
+
+    - the table is scanned sequentially: SEQ_SCAN_WEIGHT
+    - the table is already accessed via some index: INDEX_SCAN_WEIGHT
+    - no plan available: UNKNOWN_PLAN_WEIGHT
+
+This is a heuristic, and the suggestions are meant to be reviewed.
+"""
+import re
+from collections import OrderedDict
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from .models_index import model_label, models_by_table
+
+
+SEQ_SCAN_WEIGHT = 0.9
+INDEX_SCAN_WEIGHT = 0.2
+UNKNOWN_PLAN_WEIGHT = 0.5
+
+# Max number of columns of a suggested index
+MAX_COLUMNS = 3
+
+_identifier = r'[`"]?(\w+)[`"]?'
+_column = _identifier + r'\.' + _identifier
+_clause_re = re.compile(r'\b(SELECT|FROM|JOIN|ON|WHERE|GROUP BY|HAVING|ORDER BY|LIMIT|OFFSET|SET|UNION)\b', re.IGNORECASE)
+_table_re = re.compile(r'^\s*' + _identifier + r'(?:\s+(?:AS\s+)?' + _identifier + r')?', re.IGNORECASE)
+_predicate_re = re.compile(_column + r'\s*(=|<=|>=|<|>|\bIN\b|\bIS\b|\bLIKE\b|\bBETWEEN\b)', re.IGNORECASE)
+_join_re = re.compile(_column + r'\s*=\s*' + _column)
+_order_re = re.compile(_column)
+
+_EQUALITY_OPERATORS = ('=', 'IN', 'IS')
+_KEYWORDS = ('WHERE', 'ON', 'INNER', 'LEFT', 'RIGHT', 'OUTER', 'CROSS', 'JOIN', 'ORDER', 'GROUP', 'LIMIT')
+
+
+def _split_clauses(sql):
+    """
+    Returns a list of (keyword, text) for the top-level clauses of the statement
+    """
+    parts = _clause_re.split(sql)
+    clauses = []
+    for index in range(1, len(parts) - 1, 2):
+        clauses.append((' '.join(parts[index].upper().split()), parts[index + 1]))
+    return clauses
+
+
+def _append_unique(items, item):
+    if item not in items:
+        items.append(item)
+
+
+def extract_candidates(sql):
+    """
+    Returns the candidate indexes for the given statement, as a list of
+    (table, columns) tuples, where columns is a tuple of column names
+    """
+    clauses = _split_clauses(sql)
+
+    # Resolve table aliases (i.e. the "T3" of self-joins)
+    aliases = {}
+    for keyword, text in clauses:
+        if keyword in ('FROM', 'JOIN'):
+            match = _table_re.match(text)
+            if match is not None:
+                table, alias = match.groups()
+                aliases[table] = table
+                if alias and alias.upper() not in _KEYWORDS:
+                    aliases[alias] = table
+
+    # table -> ([equality columns], [range columns], [order by columns])
+    columns = OrderedDict()
+    joins = []
+
+    def table_columns(alias):
+        table = aliases.get(alias)
+        if table is None:
+            return None
+        if table not in columns:
+            columns[table] = ([], [], [])
+        return columns[table]
+
+    for keyword, text in clauses:
+        if keyword in ('WHERE', 'HAVING'):
+            for alias, column, operator in _predicate_re.findall(text):
+                item = table_columns(alias)
+                if item is not None:
+                    _append_unique(item[0] if operator.upper() in _EQUALITY_OPERATORS else item[1], column)
+        elif keyword == 'ON':
+            for left_alias, left_column, right_alias, right_column in _join_re.findall(text):
+                for alias, column in ((left_alias, left_column), (right_alias, right_column)):
+                    if aliases.get(alias) is not None:
+                        _append_unique(joins, (aliases[alias], (column, )))
+        elif keyword == 'ORDER BY':
+            for alias, column in _order_re.findall(text):
+                item = table_columns(alias)
+                if item is not None:
+                    _append_unique(item[2], column)
+
+    candidates = []
+    for table, (equality, ranges, order_by) in columns.items():
+        index = list(equality)
+        if ranges:
+            _append_unique(index, ranges[0])
+        else:
+            for column in order_by:
+                _append_unique(index, column)
+        if index:
+            candidates.append((table, tuple(index[:MAX_COLUMNS])))
+    for join in joins:
+        _append_unique(candidates, join)
+    return candidates
+
+
+def get_existing_indexes(connection, table):
+    """
+    Returns the columns of all indexes (including primary keys and unique constraints)
+    of the given table, or None when the table doesn't exist
+    """
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return None
+        constraints = connection.introspection.get_constraints(cursor, table)
+    return [
+        tuple(constraint['columns'])
+        for constraint in constraints.values()
+        if constraint['columns'] and (constraint['index'] or constraint['primary_key'] or constraint['unique'])
+    ]
+
+
+def is_covered(columns, existing_indexes):
+    """
+    An index is useless when some existing index starts with the same columns
+    """
+    return any(tuple(index[:len(columns)]) == tuple(columns) for index in existing_indexes)
+
+
+def plan_scans_table(plan, table):
+    """
+    Returns True when the plan shows a sequential scan of the table,
+    False when the table is accessed via an index, and None when unknown
+    """
+    if not plan:
+        return None
+    for line in plan.splitlines():
+        words = line.replace('"', ' ').replace('`', ' ').split()
+        if table not in words:
+            continue
+        upper = line.upper()
+        # PostgreSQL: "Seq Scan on ..."
+        if 'SEQ SCAN' in upper:
+            return True
+        # "Index Scan", "Bitmap Heap Scan", sqlite's "SEARCH ..." or "SCAN ... USING COVERING INDEX"
+        if 'INDEX' in upper or 'BITMAP' in upper or 'SEARCH' in upper.split():
+            return False
+        # sqlite: "SCAN [TABLE] ..."; MySQL: access type "ALL"
+        if 'SCAN' in upper.split() or 'ALL' in line.split():
+            return True
+    return None
+
+
+class IndexAdvisor(object):
+    """
+    Sample usage:
+
+        analysis = analyze_files(['/var/log/queries.jsonl'])
+        advisor = IndexAdvisor(analysis.fingerprints, analysis.plans)
+        for row in advisor.suggestions():
+            ...
+        print(advisor.meta_indexes())
+    """
+
+    def __init__(self, fingerprints, plans=None, using=DEFAULT_DB_ALIAS):
+        """
+        <fingerprints>: fingerprint -> [count, time, max_time] (see analyzer.LogAnalysis)
+        <plans>: fingerprint -> execution plan, if available
+        """
+        self.fingerprints = fingerprints
+        self.plans = plans or {}
+        self.connection = connections[using]
+        self._existing_indexes = {}
+
+    def existing_indexes(self, table):
+        if table not in self._existing_indexes:
+            self._existing_indexes[table] = get_existing_indexes(self.connection, table)
+        return self._existing_indexes[table]
+
+    def weight(self, key, table):
+        scans = plan_scans_table(self.plans.get(key), table)
+        if scans is None:
+            return UNKNOWN_PLAN_WEIGHT
+        return SEQ_SCAN_WEIGHT if scans else INDEX_SCAN_WEIGHT
+
+    def suggestions(self, n=None, min_time=0.0):
+        """
+        Returns the suggested indexes, largest estimated time saved first
+        """
+        # (table, columns) -> [saved time, query shapes, executions, seq scan]
+        candidates = {}
+        for key, (count, time, max_time) in self.fingerprints.items():
+            for table, columns in extract_candidates(key):
+                existing = self.existing_indexes(table)
+                if existing is None or is_covered(columns, existing):
+                    continue
+                item = candidates.setdefault((table, columns), [0.0, 0, 0, False])
+                item[0] += time * self.weight(key, table)
+                item[1] += 1
+                item[2] += count
+                item[3] = item[3] or bool(plan_scans_table(self.plans.get(key), table))
+
+        # An index on (a, b) serves the queries which would use an index on (a) as well
+        for table, columns in sorted(candidates, key=lambda candidate: len(candidate[1])):
+            extensions = [
+                (other_columns, item) for (other_table, other_columns), item in candidates.items()
+                if other_table == table and len(other_columns) > len(columns) and other_columns[:len(columns)] == columns
+            ]
+            if extensions:
+                item = candidates.pop((table, columns))
+                other_columns, other = max(extensions, key=lambda extension: extension[1][0])
+                other[0] += item[0]
+                other[1] += item[1]
+                other[2] += item[2]
+                other[3] = other[3] or item[3]
+
+        models = models_by_table()
+        rows = []
+        for (table, columns), (saved_time, shapes, executions, seq_scan) in candidates.items():
+            if saved_time < min_time:
+                continue
+            model = models.get(table)
+            rows.append(OrderedDict([
+                ('model', model_label(model) if model is not None else ''),
+                ('table', table),
+                ('fields', ', '.join(self._field_names(model, columns))),
+                ('saved_time', round(saved_time, 4)),
+                ('queries', shapes),
+                ('executions', executions),
+                ('seq_scan', seq_scan),
+            ]))
+        rows.sort(key=lambda row: row['saved_time'], reverse=True)
+        return rows[:n] if n is not None else rows
+
+    @staticmethod
+    def _field_names(model, columns):
+        """
+        Maps column names to model field names (i.e. "author_id" -> "author")
+        """
+        if model is None:
+            return list(columns)
+        fields = {field.column: field.name for field in model._meta.concrete_fields}
+        return [fields.get(column, column) for column in columns]
+
+    def meta_indexes(self, n=None, min_time=0.0):
+        """
+        Returns the suggested indexes as Meta.indexes snippets, grouped by model
+        """
+        by_model = OrderedDict()
+        for row in self.suggestions(n, min_time):
+            if row['model']:
+                by_model.setdefault(row['model'], []).append(row)
+
+        snippets = []
+        for model, rows in by_model.items():
+            lines = [
+                '# %s: ~%.4fs saved' % (model, sum(row['saved_time'] for row in rows)),
+                'class Meta:',
+                '    indexes = [',
+            ]
+            for row in rows:
+                lines.append('        models.Index(fields=[%s]),  # %.4fs, %d queries, %d executions%s' % (
+                    ', '.join("'%s'" % field for field in row['fields'].split(', ')),
+                    row['saved_time'], row['queries'], row['executions'],
+                    ', seq scan' if row['seq_scan'] else '',
+                ))
+            lines.append('    ]')
+            snippets.append('\n'.join(lines))
+        return '\n\n'.join(snippets)
@@ -0,0 +1,60 @@
+import signal
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from query_inspector.analyzer import analyze_files
+from query_inspector.index_advisor import IndexAdvisor
+from query_inspector.templatetags.query_inspector_tags import (
+    render_queryset_as_csv,
+    render_queryset_as_text,
+)
+
+
+RENDERERS = {
+    'text': render_queryset_as_text,
+    'csv': render_queryset_as_csv,
+}
+
+
+class Command(BaseCommand):
+    help = 'Suggest indexes for the queries recorded by QueryCountMiddleware (JSON lines) or by the SQL debug logger'
+
+    def __init__(self, logger=None, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(0))
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='+', metavar='filename', help='Log files (optionally .gz)')
+        parser.add_argument('--top', '-n', type=int, default=20, help='Number of suggestions (default: 20)')
+        parser.add_argument(
+            '--min-time', type=float, default=0.0,
+            help='Skip the indexes saving less than this (in seconds; default: 0)',
+        )
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='The database whose existing indexes are inspected (default: "%s")' % DEFAULT_DB_ALIAS,
+        )
+        parser.add_argument(
+            '--format', choices=sorted(RENDERERS.keys()), default='text',
+            help='Output format of the ranking (default: text)',
+        )
+        parser.add_argument('--processes', type=int, default=None, help='Size of the process pool (default: n. of CPUs)')
+
+    def handle(self, *args, **options):
+        try:
+            analysis = analyze_files(options['filenames'], processes=options['processes'])
+        except OSError as e:
+            raise CommandError(str(e))
+
+        if options['verbosity'] >= 1:
+            self.stderr.write('%d files, %d requests, %d query shapes, %d execution plans' % (
+                analysis.files, analysis.requests, len(analysis.fingerprints), len(analysis.plans)))
+
+        advisor = IndexAdvisor(analysis.fingerprints, analysis.plans, using=options['database'])
+        rows = advisor.suggestions(options['top'], options['min_time'])
+
+        self.stdout.write('\n# Candidate indexes by estimated time saved\n')
+        if rows:
+            self.stdout.write(RENDERERS[options['format']](*rows[0].keys(), queryset=rows))
+            self.stdout.write('\n# Meta.indexes\n')
+            self.stdout.write(advisor.meta_indexes(options['top'], options['min_time']))
@@ -0,0 +1,79 @@
+import signal
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from query_inspector.analyzer import analyze_files
+from query_inspector.templatetags.query_inspector_tags import (
+    render_queryset_as_csv,
+    render_queryset_as_table,
+    render_queryset_as_text,
+)
+
+
+REPORTS = (
+    ('endpoints', 'Endpoints by DB time', 'top_endpoints'),
+    ('fingerprints', 'Queries by frequency x latency', 'top_fingerprints'),
+    ('nplusone', 'N+1 suspects', 'top_nplusone'),
+)
+
+RENDERERS = {
+    'text': render_queryset_as_text,
+    'csv': render_queryset_as_csv,
+    'table': render_queryset_as_table,
+}
+
+
+class Command(BaseCommand):
+    help = 'Analyze query logs recorded by QueryCountMiddleware (JSON lines) or by the SQL debug logger'
+
+    def __init__(self, logger=None, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(0))
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='+', metavar='filename', help='Log files (optionally .gz)')
+        parser.add_argument('--top', '-n', type=int, default=10, help='Number of rows per report (default: 10)')
+        parser.add_argument(
+            '--nplusone-threshold', type=int, default=5,
+            help='Report query shapes executed more than this many times in the same request (default: 5)',
+        )
+        parser.add_argument(
+            '--report', choices=[report[0] for report in REPORTS], action='append',
+            help='Report(s) to be produced (default: all)',
+        )
+        parser.add_argument(
+            '--format', choices=sorted(RENDERERS.keys()), default='text',
+            help='Output format; "table" renders an HTML table with render_queryset_as_table (default: text)',
+        )
+        parser.add_argument('--processes', type=int, default=None, help='Size of the process pool (default: n. of CPUs)')
+
+    def handle(self, *args, **options):
+        try:
+            analysis = analyze_files(
+                options['filenames'],
+                nplusone_threshold=options['nplusone_threshold'],
+                processes=options['processes'],
+            )
+        except OSError as e:
+            raise CommandError(str(e))
+
+        render = RENDERERS[options['format']]
+        selected = options['report'] or [report[0] for report in REPORTS]
+
+        if options['verbosity'] >= 1:
+            self.stderr.write('%d files, %d lines, %d requests, %d unreadable records' % (
+                analysis.files, analysis.lines, analysis.requests, analysis.errors))
+
+        for name, title, method in REPORTS:
+            if name not in selected:
+                continue
+            rows = getattr(analysis, method)(options['top'])
+            if options['format'] == 'table':
+                self.stdout.write('<h2>%s</h2>' % title)
+                self.stdout.write('<table class="simpletable">%s</table>' % (render(*self.fields(rows), queryset=rows) if rows else ''))
+            else:
+                self.stdout.write('\n# %s\n' % title)
+                if rows:
+                    self.stdout.write(render(*self.fields(rows), queryset=rows))
+
+    def fields(self, rows):
+        return list(rows[0].keys())
@@ -1,20 +1,39 @@
+import asyncio
 import re
-import sys
 import timeit
-from collections import Counter
+from functools import lru_cache
 from textwrap import wrap
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db import connections
 from django.utils import termcolors
 
+from .aggregation import aggregation_store
+from .budgets import (
+    BUDGET_MODES, check_budget, describe_violations, get_budget, logger as budget_logger,
+    query_budget_exceeded, QueryBudgetExceeded,
+)
+from .capture import QueryCollector, READ_QUERY_REGEX
+from .formatting import get_sql_formatter
+from .nplusone import detect_nplusone, NPlusOneDetected
+from .profiler import build_profile, render_profile_as_text
+from .reporting import build_sinks, Report, ReportWriter
+from .sampling import RequestSampler
+
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     MiddlewareMixin = object
 
+# Optional
+try:
+    from constance import config as constance_config
+except ImportError:
+    constance_config = None
+
 
-ACTUAL_QUERYCOUNT_SETTINGS = getattr(settings, 'QUERYCOUNT', {
+DEFAULT_QUERYCOUNT_SETTINGS = {
     'IGNORE_ALL_REQUESTS': False,
     'IGNORE_REQUEST_PATTERNS': [],
     'IGNORE_SQL_PATTERNS': [],
@@ -29,170 +48,381 @@ ACTUAL_QUERYCOUNT_SETTINGS = getattr(settings, 'QUERYCOUNT', {
     'COLOR_FORMATTER_STYLE': 'monokai',
     'RESPONSE_HEADER': 'X-DjangoQueryCount-Count',
     'DISPLAY_DUPLICATES': 0,
-})
+    'REQUIRE_DEBUG': True,
+    'NPLUSONE_THRESHOLD': None,
+    'NPLUSONE_RAISE': False,
+    'SAMPLE_RATE': 1.0,
+    'SAMPLE_SLOW_PERCENTILE': None,
+    'AGGREGATE': True,
+    'SLOW_QUERY_THRESHOLD': None,
+    'PROFILE': False,
+    'EXPLAIN_THRESHOLD': None,
+    'EXPLAIN_DUPLICATES': None,
+    'EXPLAIN_ANALYZE': False,
+    'SERVER_TIMING': False,
+    'REPORT_ASYNC': True,
+    'REPORT_QUEUE_SIZE': 1000,
+    'REPORT_SINKS': [
+        {'class': 'query_inspector.reporting.StreamSink'},
+    ],
+    'BUDGETS': {},
+    'BUDGET_MODE': 'log',
+}
+
+# Missing keys in the project's settings fall back to the defaults
+ACTUAL_QUERYCOUNT_SETTINGS = dict(DEFAULT_QUERYCOUNT_SETTINGS, **getattr(settings, 'QUERYCOUNT', {}))
+
+
+_server_timing_token_re = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+
+def _server_timing_quote(text, max_length=100):
+    """
+    Formats text as a quoted-string suitable for an HTTP header
+    """
+    text = ' '.join(text.split())
+    if len(text) > max_length:
+        text = text[:max_length - 3] + '...'
+    text = text.encode('ascii', 'replace').decode('ascii')
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
 
 
-def format_query(sql):
+def compile_patterns(patterns):
+    """
+    Combines a list of regexp patterns into a single compiled regexp
+    (or None when the list is empty)
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{0})'.format(pattern) for pattern in patterns))
 
-    # Check if Pygments is available for coloring
-    try:
-        import pygments
-        from pygments.lexers import SqlLexer
-        from pygments.formatters import TerminalTrueColorFormatter
-    except ImportError:
-        pygments = None
-    # Check if sqlparse is available for indentation
-    try:
-        import sqlparse
-    except ImportError:
-        sqlparse = None
-    # Remove leading and trailing whitespaces
-    if sqlparse:
-        # Indent the SQL query
-        sql = sqlparse.format(sql, reindent=True)
-    if pygments:
-        # Highlight the SQL query
-        sql = pygments.highlight(
-            sql,
-            SqlLexer(),
-            TerminalTrueColorFormatter(style=ACTUAL_QUERYCOUNT_SETTINGS['COLOR_FORMATTER_STYLE'])
-            #TerminalTrueColorFormatter()
-        )
 
-    return sql
+def format_query(sql):
+    """
+    Indent and highlight the SQL query, when sqlparse and pygments are available
+    (see formatting.SqlFormatter)
+    """
+    return get_sql_formatter(ACTUAL_QUERYCOUNT_SETTINGS['COLOR_FORMATTER_STYLE']).format(sql)
 
 
 class QueryCountMiddleware(MiddlewareMixin):
     """This middleware prints the number of database queries for each http
     request and response. This code is adapted from: http://goo.gl/UUKN0r.
 
-    NOTE: This middleware is predominately written in the pre-Django 1.10 style,
-    and uses the MiddlewareMixin for compatibility:
-
-    https://docs.djangoproject.com/en/1.11/topics/http/middleware/#upgrading-pre-django-1-10-style-middleware
-
+    Queries are captured as they are executed with a QueryCollector
+    (see capture.py), so `connection.queries` and the DEBUG log are not required.
     """
 
-    READ_QUERY_REGEX = re.compile("SELECT .*")
+    READ_QUERY_REGEX = READ_QUERY_REGEX
+
+    # The middleware instance is shared by all threads (and coroutines)
+    # serving requests; for this reason, all per-request accounting is kept
+    # in a QueryCollector created for each request, and the middleware
+    # itself is stateless.
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, *args, **kwargs):
         # Call super first, so the MiddlewareMixin's __init__ does its thing.
         super(QueryCountMiddleware, self).__init__(*args, **kwargs)
 
-        if settings.DEBUG:
-            self.request_path = None
-            self.stats = {"request": {}, "response": {}}
-            self.dbs = [c.alias for c in connections.all()]
-            self.queries = Counter()
-            self._reset_stats()
-
-            self._start_time = None
-            self._end_time = None
-            self.host = None  # The HTTP_HOST pulled from the request
-
-            # colorizing methods
-            self.white = termcolors.make_style(opts=('bold',), fg='white')
-            self.red = termcolors.make_style(opts=('bold',), fg='red')
-            self.yellow = termcolors.make_style(opts=('bold',), fg='yellow')
-            self.green = termcolors.make_style(fg='green')
-
-            # query type detection regex
-            # TODO: make stats classification regex more robust
-            self.threshold = ACTUAL_QUERYCOUNT_SETTINGS['THRESHOLDS']
-
-    def _reset_stats(self):
-        self.stats = {"request": {}, "response": {}}
-        for alias in self.dbs:
-            self.stats["request"][alias] = {'writes': 0, 'reads': 0, 'total': 0}
-            self.stats["response"][alias] = {'writes': 0, 'reads': 0, 'total': 0}
-        self.queries = Counter()
-
-    def _count_queries(self, which):
-        for c in connections.all():
-            for q in c.queries:
-                if not self._ignore_sql(q):
-                    if q.get('sql') and self.READ_QUERY_REGEX.search(q['sql']) is not None:
-                        self.stats[which][c.alias]['reads'] += 1
-                    else:
-                        self.stats[which][c.alias]['writes'] += 1
-                    self.stats[which][c.alias]['total'] += 1
-                    self.queries[q['sql']] += 1
-
-            # We'll show the worst offender; i.e. the query with the most duplicates
-            duplicates = self.queries.most_common(1)
-            if duplicates:
-                sql, count = duplicates[0]
-                self.stats[which][c.alias]['duplicates'] = count
-            else:
-                self.stats[which][c.alias]['duplicates'] = 0
+        if ACTUAL_QUERYCOUNT_SETTINGS['BUDGET_MODE'] not in BUDGET_MODES:
+            raise ImproperlyConfigured('Invalid QUERYCOUNT BUDGET_MODE "%s"; choices are: %s' % (
+                ACTUAL_QUERYCOUNT_SETTINGS['BUDGET_MODE'], ', '.join(BUDGET_MODES)))
+
+        self.dbs = [c.alias for c in connections.all()]
+        self.sampler = RequestSampler(
+            rate=ACTUAL_QUERYCOUNT_SETTINGS['SAMPLE_RATE'],
+            slow_percentile=ACTUAL_QUERYCOUNT_SETTINGS['SAMPLE_SLOW_PERCENTILE'],
+        )
+        # Reports are written from a background thread (see reporting.py)
+        self.report_writer = ReportWriter(
+            build_sinks(ACTUAL_QUERYCOUNT_SETTINGS['REPORT_SINKS']),
+            asynchronous=ACTUAL_QUERYCOUNT_SETTINGS['REPORT_ASYNC'],
+            queue_size=ACTUAL_QUERYCOUNT_SETTINGS['REPORT_QUEUE_SIZE'],
+        )
+
+        # colorizing methods
+        self.white = termcolors.make_style(opts=('bold',), fg='white')
+        self.red = termcolors.make_style(opts=('bold',), fg='red')
+        self.yellow = termcolors.make_style(opts=('bold',), fg='yellow')
+        self.green = termcolors.make_style(fg='green')
+
+        self.threshold = ACTUAL_QUERYCOUNT_SETTINGS['THRESHOLDS']
+
+        # Ignore rules are compiled once, and their results cached
+        # per path and per sql statement
+        self._ignore_request_regex = compile_patterns(ACTUAL_QUERYCOUNT_SETTINGS['IGNORE_REQUEST_PATTERNS'])
+        self._ignore_sql_regex = compile_patterns(ACTUAL_QUERYCOUNT_SETTINGS['IGNORE_SQL_PATTERNS'])
+        self._ignore_path = lru_cache(maxsize=1024)(self._ignore_path)
+        self._ignore_sql = lru_cache(maxsize=1024)(self._ignore_sql)
+
+    def _enabled(self):
+        """
+        Query capture doesn't rely on the DEBUG log, so it can optionally
+        run in production as well (set 'REQUIRE_DEBUG' to False)
+        """
+        return settings.DEBUG or not ACTUAL_QUERYCOUNT_SETTINGS['REQUIRE_DEBUG']
+
+    def _new_collector(self, request):
+        collector = QueryCollector(
+            aliases=self.dbs,
+            ignore_sql=self._ignore_sql if self._ignore_sql_regex is not None else None,
+            ignore_executed_sql=self._ignore_executed_sql if self._ignore_sql_regex is not None else None,
+            read_query_regex=self.READ_QUERY_REGEX,
+            capture_callsite=ACTUAL_QUERYCOUNT_SETTINGS['NPLUSONE_THRESHOLD'] is not None,
+            slow_query_threshold=ACTUAL_QUERYCOUNT_SETTINGS['SLOW_QUERY_THRESHOLD'],
+            capture_stack=ACTUAL_QUERYCOUNT_SETTINGS['PROFILE'],
+            explain_threshold=ACTUAL_QUERYCOUNT_SETTINGS['EXPLAIN_THRESHOLD'],
+            explain_duplicates=ACTUAL_QUERYCOUNT_SETTINGS['EXPLAIN_DUPLICATES'],
+            explain_analyze=ACTUAL_QUERYCOUNT_SETTINGS['EXPLAIN_ANALYZE'],
+        )
+        # Make the collector available to the view (and to the test client)
+        request.query_collector = collector
+        collector.host = request.META.get('HTTP_HOST', None)
+        collector.request_path = request.path
+        return collector
+
+    def _ignore_all_requests(self):
+        if constance_config is not None:
+            try:
+                return constance_config.QUERYCOUNT_IGNORE_ALL_REQUESTS
+            except Exception:
+                pass
+        return ACTUAL_QUERYCOUNT_SETTINGS['IGNORE_ALL_REQUESTS']
 
     def _ignore_request(self, path):
         """Check to see if we should ignore the request."""
-        try:
-            from constance import config
-            IGNORE_ALL_REQUESTS = config.QUERYCOUNT_IGNORE_ALL_REQUESTS
-        except:
-            IGNORE_ALL_REQUESTS = ACTUAL_QUERYCOUNT_SETTINGS['IGNORE_ALL_REQUESTS']
-        if IGNORE_ALL_REQUESTS:
+        if self._ignore_all_requests():
             return True
-        return any([
-            re.match(pattern, path) for pattern in ACTUAL_QUERYCOUNT_SETTINGS['IGNORE_REQUEST_PATTERNS']
-        ])
+        return self._ignore_path(path)
+
+    def _ignore_path(self, path):
+        # (cached; see __init__())
+        return self._ignore_request_regex is not None and self._ignore_request_regex.match(path) is not None
 
-    def _ignore_sql(self, query):
+    def _ignore_sql(self, sql):
         """Check to see if we should ignore the sql query."""
-        return any([
-            re.search(pattern, query.get('sql')) for pattern in ACTUAL_QUERYCOUNT_SETTINGS['IGNORE_SQL_PATTERNS']
-        ])
-
-    def process_request(self, request):
-        if settings.DEBUG and not self._ignore_request(request.path):
-            self.host = request.META.get('HTTP_HOST', None)
-            self.request_path = request.path
-            self._start_time = timeit.default_timer()
-            self._count_queries("request")
-
-    def process_response(self, request, response):
-        if settings.DEBUG and not self._ignore_request(request.path):
-            self.request_path = request.path
-            self._end_time = timeit.default_timer()
-            self._count_queries("response")
-
-            # Add query count header, if enabled
-            if ACTUAL_QUERYCOUNT_SETTINGS['RESPONSE_HEADER'] is not None:
-                response[ACTUAL_QUERYCOUNT_SETTINGS['RESPONSE_HEADER']] = self._calculate_num_queries()
-
-            self.print_num_queries()
-            self._reset_stats()
+        # (cached; see __init__())
+        return self._ignore_sql_regex is not None and self._ignore_sql_regex.search(sql) is not None
+
+    def _ignore_executed_sql(self, sql):
+        """
+        Patterns are also matched against the statement with its params interpolated
+        (not cached, since params vary), so that they can refer to literal values
+        """
+        return self._ignore_sql_regex is not None and self._ignore_sql_regex.search(sql) is not None
+
+    def __call__(self, request):
+        # Exit out to async mode, if needed
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        if not self._enabled() or self._ignore_request(request.path):
+            return self.get_response(request)
+
+        if not self.sampler.should_sample(request.path):
+            if not self.sampler.observing:
+                return self.get_response(request)
+            start = timeit.default_timer()
+            response = self.get_response(request)
+            self.sampler.observe(request.path, timeit.default_timer() - start)
+            return response
+
+        # The collector is bound to the current context while active,
+        # and can be retrieved with capture.get_current_collector()
+        with self._new_collector(request) as collector:
+            response = self.get_response(request)
+        self.sampler.observe(request.path, collector.elapsed)
+        return self.process_collected(request, response, collector)
+
+    async def __acall__(self, request):
+        """
+        Native async path, swapped in by __call__() under ASGI.
+
+        ORM calls wrapped in sync_to_async() inherit the current context,
+        so their queries are still accounted to this request's collector
+        """
+        if not self._enabled() or self._ignore_request(request.path):
+            return await self.get_response(request)
+
+        if not self.sampler.should_sample(request.path):
+            if not self.sampler.observing:
+                return await self.get_response(request)
+            start = timeit.default_timer()
+            response = await self.get_response(request)
+            self.sampler.observe(request.path, timeit.default_timer() - start)
+            return response
+
+        with self._new_collector(request) as collector:
+            response = await self.get_response(request)
+        self.sampler.observe(request.path, collector.elapsed)
+        return self.process_collected(request, response, collector)
+
+    def process_collected(self, request, response, collector):
+        # Add query count header, if enabled
+        if ACTUAL_QUERYCOUNT_SETTINGS['RESPONSE_HEADER'] is not None:
+            response[ACTUAL_QUERYCOUNT_SETTINGS['RESPONSE_HEADER']] = self._calculate_num_queries(collector)
+
+        # Add Server-Timing header, if enabled
+        if ACTUAL_QUERYCOUNT_SETTINGS['SERVER_TIMING']:
+            server_timing = self._server_timing(collector)
+            if response.has_header('Server-Timing'):
+                server_timing = response['Server-Timing'] + ', ' + server_timing
+            response['Server-Timing'] = server_timing
+
+        name, view = self._endpoint(request)
+        collector.endpoint = name
+
+        # Check the view's query budget, if any
+        violations = self._check_budget(request, collector)
+
+        # Accumulate per-endpoint statistics, if enabled
+        if ACTUAL_QUERYCOUNT_SETTINGS['AGGREGATE']:
+            aggregation_store.record(name, view, collector)
+
+        # Detect N+1 queries, if enabled
+        findings = []
+        if collector.capture_callsite:
+            findings = detect_nplusone(collector, ACTUAL_QUERYCOUNT_SETTINGS['NPLUSONE_THRESHOLD'])
+            collector.nplusone_findings = findings
+
+        self.print_num_queries(collector)
+
+        if findings and ACTUAL_QUERYCOUNT_SETTINGS['NPLUSONE_RAISE']:
+            raise NPlusOneDetected('%d N+1 queries detected in %s' % (len(findings), collector.request_path))
+
+        if violations and ACTUAL_QUERYCOUNT_SETTINGS['BUDGET_MODE'] == 'raise':
+            raise QueryBudgetExceeded(describe_violations(collector.endpoint, violations))
 
         return response
 
-    def _host_string(self):
-        if self.host:
-            host_string = 'http://{0}{1}'.format(self.host, self.request_path)
+    def _check_budget(self, request, collector):
+        """
+        Compares the collected queries with the budget declared for the view;
+        the violations (if any) are logged (unless in 'metric' mode),
+        and notified with the query_budget_exceeded signal
+        """
+        budget = get_budget(getattr(request, 'resolver_match', None), ACTUAL_QUERYCOUNT_SETTINGS['BUDGETS'])
+        if budget is None:
+            return []
+        violations = check_budget(budget, collector)
+        collector.budget_violations = violations
+        if violations:
+            if ACTUAL_QUERYCOUNT_SETTINGS['BUDGET_MODE'] == 'log':
+                budget_logger.warning(describe_violations(collector.endpoint, violations))
+            query_budget_exceeded.send(
+                sender=self.__class__, request=request, endpoint=collector.endpoint, violations=violations)
+        return violations
+
+    def _server_timing(self, collector):
+        """
+        Builds the value of the Server-Timing header
+        (see https://www.w3.org/TR/server-timing/); durations are in milliseconds:
+
+            db;dur=12.1;desc="5 queries",
+            db-default;dur=12.1;desc="4 reads, 1 writes",
+            db-slowest;dur=8.0;desc="SELECT ... WHERE ... = ?"
+
+        The shape of the slowest query is disclosed only when settings.DEBUG is on.
+        """
+        def metric(name, duration, description):
+            return '{0};dur={1:.1f};desc={2}'.format(
+                _server_timing_token_re.sub('-', name),
+                duration * 1000,
+                _server_timing_quote(description),
+            )
+
+        metrics = [metric('db', collector.db_time, '{0} queries'.format(collector.total))]
+        for alias, stats in collector.stats.items():
+            if stats['total'] > 0:
+                metrics.append(metric(
+                    'db-' + alias, stats['time'],
+                    '{0} reads, {1} writes'.format(stats['reads'], stats['writes'])
+                ))
+        slowest = collector.timings.most_common(1)
+        if slowest:
+            sql, duration = slowest[0]
+            metrics.append(metric('db-slowest', duration, sql if settings.DEBUG else 'slowest query'))
+        return ', '.join(metrics)
+
+    def _endpoint(self, request):
+        """
+        Returns the (url name, view) resolved for the request
+        """
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return ('<unresolved>', '')
+        return (match.view_name, match._func_path)
+
+    def _host_string(self, collector):
+        if collector.host:
+            host_string = 'http://{0}{1}'.format(collector.host, collector.request_path)
         else:
-            host_string = self.request_path
+            host_string = collector.request_path
         return host_string
 
-    def _stats_table(self, which, path='', output=None):
+    def _stats_table(self, collector, which='response', output=None):
         if output is None:
-            output = self.white('\n> {0} (summary)\n'.format(self._host_string()))
-            output += "|------|-----------|----------|----------|----------|------------|\n"
-            output += "| Type | Database  |   Reads  |  Writes  |  Totals  | Duplicates |\n"
-            output += "|------|-----------|----------|----------|----------|------------|\n"
+            output = self.white('\n> {0} (summary)\n'.format(self._host_string(collector)))
+            output += "|------|-----------|----------|----------|----------|------------|------------|\n"
+            output += "| Type | Database  |   Reads  |  Writes  |  Totals  | Duplicates |  DB time   |\n"
+            output += "|------|-----------|----------|----------|----------|------------|------------|\n"
 
-        for db, stats in self.stats[which].items():
+        for db, stats in collector.stats.items():
             if stats['total'] > 0:
-                line = "|{w}|{db}|{reads}|{writes}|{total}|{duplicates}|\n".format(
+                line = "|{w}|{db}|{reads}|{writes}|{total}|{duplicates}|{time}|\n".format(
                     w=which.upper()[:4].center(6),
                     db=db.center(11),
                     reads=str(stats['reads']).center(10),
                     writes=str(stats['writes']).center(10),
                     total=str(stats['total']).center(10),
-                    duplicates=str(stats['duplicates']).center(12)
+                    duplicates=str(stats['duplicates']).center(12),
+                    time='{0:.4f}s'.format(stats['time']).center(12),
                 )
                 output += self._colorize(line, stats['total'])
-                output += "|------|-----------|----------|----------|----------|------------|\n"
+                output += "|------|-----------|----------|----------|----------|------------|------------|\n"
+        return output
+
+    def _slow_queries(self, collector, output):
+        """Appends the slow queries, with params and stack trace, to the given output."""
+        for query in collector.slow_queries:
+            output += self.red('\nSlow query: {0:.4f}s on "{1}" (rows: {2})\n'.format(
+                query.duration, query.alias, query.rowcount))
+            output += format_query(query.sql) if ACTUAL_QUERYCOUNT_SETTINGS['DISPLAY_PRETTIFIED'] else query.sql + '\n'
+            output += 'params: {0}\n'.format(query.params)
+            output += self._plan(collector, collector.fingerprint_sql(query.sql) if collector.fingerprint_sql else query.sql)
+            output += query.stack
+        return output
+
+    def _plan(self, collector, key):
+        """Returns the execution plan of the given query shape, if it has been explained."""
+        plan = collector.plans.get(key)
+        if plan is None:
+            return ''
+        return self.yellow('Plan:\n') + plan + '\n'
+
+    def _nplusone_table(self, collector, findings):
+        rows = [['#', 'Count', 'Model', 'Call site', 'Suggestion']]
+        for index, finding in enumerate(findings, start=1):
+            rows.append([
+                str(index),
+                str(finding.count),
+                finding.model or '',
+                '{0}:{1} in {2}()'.format(finding.filename, finding.lineno, finding.function) if finding.filename else '',
+                finding.suggestion,
+            ])
+        widths = [max(len(row[i]) for row in rows) + 2 for i in range(len(rows[0]))]
+        separator = "|" + "|".join("-" * w for w in widths) + "|\n"
+
+        output = self.white('\n> {0} (N+1 queries)\n'.format(self._host_string(collector)))
+        output += separator
+        for index, row in enumerate(rows):
+            line = "|" + "|".join(' ' + cell.ljust(w - 1) for cell, w in zip(row, widths)) + "|\n"
+            output += self.red(line) if index > 0 else line
+            output += separator
+        for index, finding in enumerate(findings, start=1):
+            output += self.white('#{0}: '.format(index)) + finding.fingerprint + '\n'
         return output
 
     # def _duplicate_queries(self, output):
@@ -205,22 +435,22 @@ class QueryCountMiddleware(MiddlewareMixin):
     #             output += self._colorize(lines, count)
     #     return output
 
-    def _duplicate_queries(self, output):
+    def _duplicate_queries(self, collector, output):
         """Appends the most common duplicate queries to the given output."""
 
         queries = []
         if ACTUAL_QUERYCOUNT_SETTINGS['DISPLAY_ALL']:
-            queries = self.queries.items()
+            queries = collector.queries.items()
         else:
             if ACTUAL_QUERYCOUNT_SETTINGS['DISPLAY_DUPLICATES']:
-                queries = self.queries.most_common(ACTUAL_QUERYCOUNT_SETTINGS['DISPLAY_DUPLICATES'])
+                queries = collector.queries.most_common(ACTUAL_QUERYCOUNT_SETTINGS['DISPLAY_DUPLICATES'])
 
         # Avoid “RuntimeError: dictionary changed size during iteration” error
         # see: https://stackoverflow.com/questions/11941817/how-to-avoid-runtimeerror-dictionary-changed-size-during-iteration-error#11941855
         queries = list(queries)
 
         for query, count in queries:
-            lines = ['\nRepeated {0} times.'.format(count), ]
+            lines = ['\nRepeated {0} times ({1:.4f}s).'.format(count, collector.timings[query]), ]
             if ACTUAL_QUERYCOUNT_SETTINGS['DISPLAY_PRETTIFIED']:
                 #lines += "\n" + self._str_query(query) + "\n"
                 #lines += "\n" + format_query(query) + "\n"
@@ -229,6 +459,7 @@ class QueryCountMiddleware(MiddlewareMixin):
                 lines += wrap(query)
             lines = "\n".join(lines) + "\n"
             output += self._colorize(lines, count)
+            output += self._plan(collector, query)
 
         return output
 
@@ -264,14 +495,6 @@ class QueryCountMiddleware(MiddlewareMixin):
 
     #     return sql
 
-    def _totals(self, which):
-        reads = 0
-        writes = 0
-        for db, stats in self.stats[which].items():
-            reads += stats['reads']
-            writes += stats['writes']
-        return (reads, writes, reads + writes)
-
     def _colorize(self, output, metric):
         if metric > self.threshold['HIGH']:
             output = self.red(output)
@@ -281,39 +504,48 @@ class QueryCountMiddleware(MiddlewareMixin):
             output = self.green(output)
         return output
 
-    def print_num_queries(self):
-        # Request data
-        output = self._stats_table("request")
+    def print_num_queries(self, collector):
+        """
+        Hands the report to the report writer; the text is built (and formatted)
+        later, in the writer's thread, and only when it's going to be written
+        """
+        elapsed = collector.elapsed
+        count = self._calculate_num_queries(collector)
 
-        # Response data
-        output = self._stats_table("response", output=output)
+        if not getattr(collector, 'nplusone_findings', None):
+            if count <= 0:
+                return
+            if elapsed < self.threshold['MIN_TIME_TO_LOG'] or count < self.threshold['MIN_QUERY_COUNT_TO_LOG']:
+                return
 
-        # Summary of both
-        if self._end_time and self._start_time:
-            elapsed = self._end_time - self._start_time
-        else:
-            elapsed = 0
+        self.report_writer.submit(Report(collector, self._render_report))
 
-        count = self._calculate_num_queries()
+    def _render_report(self, collector):
+        output = ''
+        count = self._calculate_num_queries(collector)
         if count > 0:
+            summary = self._stats_table(collector)
+            summary += self.white('Total queries: {0} in {1:.4f}s (DB time: {2:.4f}s) \n\n'.format(
+                count, collector.elapsed, collector.db_time))
+            summary = self._colorize(summary, count)
+
+            output = self.white('\n> {0} (sql log)\n'.format(self._host_string(collector)))
+            output = self._duplicate_queries(collector, output)
+            output = self._slow_queries(collector, output)
+            output += summary
+
+        if collector.stacks:
+            output += self.white('\n> {0} (query profile)\n'.format(self._host_string(collector)))
+            output += render_profile_as_text(build_profile(collector.stacks, collector.stack_timings)) + '\n'
+
+        findings = getattr(collector, 'nplusone_findings', None)
+        if findings:
+            output += self._nplusone_table(collector, findings)
+        return output
 
-            output += self.white('Total queries: {0} in {1:.4f}s \n\n'.format(count, elapsed))
-            output = self._colorize(output, count)
-
-            sum_output = self.white('\n> {0} (sql log)\n'.format(self._host_string()))
-            sum_output = self._duplicate_queries(sum_output)
-
-            # runserver just prints its output to sys.stderr, so we'll do that too.
-            if elapsed >= self.threshold['MIN_TIME_TO_LOG'] and count >= self.threshold['MIN_QUERY_COUNT_TO_LOG']:
-                sys.stderr.write(sum_output)
-                sys.stderr.write(output)
-
-    def _calculate_num_queries(self):
+    def _calculate_num_queries(self, collector):
         """
-        Calculate the total number of request and response queries.
+        Calculate the total number of queries.
         Used for count header and count table.
         """
-        request_totals = self._totals("request")
-        response_totals = self._totals("response")
-
-        return request_totals[2] + response_totals[2]  # sum total queries
+        return collector.total
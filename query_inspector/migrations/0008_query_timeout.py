@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("query_inspector", "0007_query_enabled_alter_query_slug"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="query",
+            name="timeout",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Statement timeout in seconds (0 = no limit); leave blank to use the default value",
+                null=True,
+            ),
+        ),
+    ]
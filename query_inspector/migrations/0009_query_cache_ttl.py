@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("query_inspector", "0008_query_timeout"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="query",
+            name="cache_ttl",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Cache results for this many seconds (0 = no cache); leave blank to use the default value",
+                null=True,
+            ),
+        ),
+    ]
@@ -3,7 +3,8 @@ from django.db import models
 from django.core.exceptions import PermissionDenied
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
-from .app_settings import QUERY_SUPERUSER_ONLY
+from . import app_settings
+from .app_settings import QUERY_SUPERUSER_ONLY, QUERY_CACHE_TTL
 
 
 _named_parameters_postgresql_re = re.compile(r"\%\(([^\)]+)\)s")
@@ -43,6 +44,14 @@ class Query(models.Model):
     sql = models.TextField(null=False, blank=True)
     default_parameters = models.JSONField(null=False, default=dict, blank=True)
     notes = models.TextField(null=False, blank=True)
+    timeout = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text=_('Statement timeout in seconds (0 = no limit); leave blank to use the default value'),
+    )
+    cache_ttl = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text=_('Cache results for this many seconds (0 = no cache); leave blank to use the default value'),
+    )
     stock = models.BooleanField(null=False, default=False, editable=False)
     from_view = models.BooleanField(null=False, default=False, editable=False)
     from_materialized_view = models.BooleanField(null=False, default=False, editable=False)
@@ -69,6 +78,20 @@ class Query(models.Model):
             return True
         return False
 
+    def get_timeout(self):
+        """
+        The statement timeout of this query (in seconds), falling back to
+        QUERY_INSPECTOR_QUERY_TIMEOUT; 0 means no limit
+        """
+        return app_settings.QUERY_TIMEOUT if self.timeout is None else self.timeout
+
+    def get_cache_ttl(self):
+        """
+        How long the results of this query are cached (in seconds), falling back to
+        QUERY_INSPECTOR_QUERY_CACHE_TTL; 0 means no cache
+        """
+        return QUERY_CACHE_TTL if self.cache_ttl is None else self.cache_ttl
+
     @property
     def is_duplicated(self):
         """
@@ -0,0 +1,26 @@
+"""
+Lookup of the installed models by database table, shared by the N+1 detector
+and the index advisor to map the tables found in sql statements to models.
+"""
+from functools import lru_cache
+
+from django.apps import apps
+
+
+@lru_cache(maxsize=None)
+def models_by_table():
+    """
+    Returns a dictionary {db_table: model} of all installed models,
+    including the auto-created m2m "through" models
+    """
+    return {
+        model._meta.db_table: model
+        for model in apps.get_models(include_auto_created=True)
+    }
+
+
+def model_label(model):
+    """
+    Returns "app_label.ModelName"
+    """
+    return '%s.%s' % (model._meta.app_label, model.__name__)
@@ -0,0 +1,150 @@
+"""
+N+1 queries detection.
+
+Queries are grouped by fingerprint and by the project's line of code
+which executed them; any query shape executed more than <threshold> times
+from the same line is reported, with a hint about how to fix it.
+
+Sample usage in a unit test:
+
+    from query_inspector.nplusone import NPlusOneDetector
+
+    def test_tracks_list(self):
+        with NPlusOneDetector(threshold=3) as detector:
+            self.client.get('/tracks/')
+        self.assertEqual(detector.findings, [])
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from .capture import QueryCollector
+from .models_index import model_label, models_by_table
+
+
+NPlusOneFinding = namedtuple('NPlusOneFinding', [
+    'fingerprint',
+    'count',
+    'model',
+    'filename',
+    'lineno',
+    'function',
+    'suggestion',
+])
+
+
+class NPlusOneDetected(AssertionError):
+    pass
+
+
+_where_column_re = re.compile(r'\bWHERE\s+[`"]?(\w+)[`"]?\.[`"]?(\w+)[`"]?\s*(?:=|IN\b)', re.IGNORECASE)
+_from_table_re = re.compile(r'\bFROM\s+[`"]?(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=256)
+def suggest_fix(fingerprint, source=None):
+    """
+    Given the fingerprint of a repeated query, returns a tuple (model, suggestion),
+    where model is the label of the queried model, and suggestion the
+    select_related() or prefetch_related() call which would avoid the repetition.
+
+    <source> is the fingerprint of the statement which preceded the first repetition
+    (i.e. the one which loaded the objects being looped over); it's required to suggest
+    a select_related()
+    """
+    match = _where_column_re.search(fingerprint)
+    if match is None:
+        return (None, '')
+    table, column = match.groups()
+    model = models_by_table().get(table)
+    if model is None:
+        return (None, '')
+
+    field = next((f for f in model._meta.concrete_fields if f.column == column), None)
+    if field is None:
+        return (model_label(model), '')
+
+    if field.primary_key:
+        # Lookup by pk: a forward ForeignKey or OneToOne of the source model accessed in a loop
+        match = _from_table_re.search(source) if source else None
+        source_model = models_by_table().get(match.group(1)) if match else None
+        if source_model is None:
+            return (model_label(model), '')
+        suggestions = [
+            "%s.objects.select_related('%s')" % (source_model.__name__, related.name)
+            for related in source_model._meta.fields
+            if related.is_relation and related.related_model is model and (related.many_to_one or related.one_to_one)
+        ]
+        return (model_label(model), ' or '.join(suggestions))
+
+    if not field.is_relation:
+        return (model_label(model), '')
+
+    if model._meta.auto_created:
+        # Lookup on a m2m "through" table
+        owner = model._meta.auto_created
+        m2m = next(f for f in owner._meta.many_to_many if f.remote_field.through is model)
+        if field.related_model is owner:
+            suggestion = "%s.objects.prefetch_related('%s')" % (owner.__name__, m2m.name)
+        else:
+            suggestion = "%s.objects.prefetch_related('%s')" % (
+                m2m.related_model.__name__, m2m.remote_field.get_accessor_name())
+        return (model_label(m2m.related_model), suggestion)
+
+    # Lookup by foreign key: a reverse relation accessed in a loop
+    suggestion = "%s.objects.prefetch_related('%s')" % (
+        field.related_model.__name__, field.remote_field.get_accessor_name())
+    return (model_label(model), suggestion)
+
+
+def detect_nplusone(collector, threshold):
+    """
+    Returns the list of NPlusOneFinding for all query shapes executed more
+    than <threshold> times from the same line of code, most frequent first.
+
+    Requires a collector created with capture_callsite=True
+    """
+    # The statement executed before the first occurrence of each query shape
+    sources = {}
+    previous = None
+    for query in collector.log:
+        if query.fingerprint not in sources:
+            sources[query.fingerprint] = previous
+        previous = query.fingerprint
+
+    findings = []
+    for (key, callsite), count in collector.callsites.most_common():
+        if count <= threshold:
+            break
+        model, suggestion = suggest_fix(key, sources.get(key))
+        filename, lineno, function = callsite if callsite is not None else (None, None, None)
+        findings.append(NPlusOneFinding(key, count, model, filename, lineno, function, suggestion))
+    return findings
+
+
+class NPlusOneDetector(QueryCollector):
+    """
+    A QueryCollector which detects N+1 queries;
+    when <raise_exception> is set, NPlusOneDetected is raised on exit
+    if anything has been found.
+    """
+
+    def __init__(self, threshold=1, raise_exception=False, **kwargs):
+        kwargs['capture_callsite'] = True
+        super().__init__(**kwargs)
+        self.threshold = threshold
+        self.raise_exception = raise_exception
+
+    @property
+    def findings(self):
+        return detect_nplusone(self, self.threshold)
+
+    def __exit__(self, type, value, traceback):
+        super().__exit__(type, value, traceback)
+        if type is None and self.raise_exception:
+            findings = self.findings
+            if findings:
+                raise NPlusOneDetected('\n'.join(
+                    '%s executed %d times from %s:%s' % (f.fingerprint, f.count, f.filename, f.lineno)
+                    for f in findings
+                ))
@@ -0,0 +1,172 @@
+"""
+Hierarchical query profiler.
+
+Each query is attributed to the project's call stack which executed it
+(see stack.find_project_stack()); stacks are then merged into a tree,
+where each node accounts for the number of queries and the DB time
+of all the queries executed below it.
+
+The profile can be exported as "collapsed stacks", one line per stack:
+
+    tests.views.book_list:12;app.services.load_books:40 1834
+
+which is the input format of flamegraph tools
+(i.e. https://github.com/brendangregg/FlameGraph or https://www.speedscope.app/).
+
+Sample usage:
+
+    from query_inspector.profiler import QueryProfiler
+
+    with QueryProfiler() as profiler:
+        self.client.get('/tracks/')
+
+    profiler.trace()
+    with open('tracks.folded', 'w') as f:
+        f.write(profiler.collapsed())
+"""
+from django.utils.html import format_html, format_html_join
+
+from .capture import QueryCollector
+from .trace import trace
+
+
+class ProfileNode(object):
+    """
+    A frame of the profile tree; <count> and <db_time> are inclusive
+    of all the queries executed by the frame's descendants
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.db_time = 0.0
+        self.children = {}
+
+    def add(self, stack, count, db_time):
+        node = self
+        node.count += count
+        node.db_time += db_time
+        for label in stack:
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = ProfileNode(label)
+            child.count += count
+            child.db_time += db_time
+            node = child
+
+    @property
+    def exclusive_count(self):
+        return self.count - sum(child.count for child in self.children.values())
+
+    @property
+    def exclusive_db_time(self):
+        return self.db_time - sum(child.db_time for child in self.children.values())
+
+    def sorted_children(self):
+        """
+        The children of this node, heaviest DB consumers first
+        """
+        return sorted(self.children.values(), key=lambda node: (node.db_time, node.count), reverse=True)
+
+    def walk(self, depth=0):
+        """
+        Yields (depth, node) for this node and all its descendants, depth first
+        """
+        yield (depth, self)
+        for child in self.sorted_children():
+            yield from child.walk(depth + 1)
+
+
+def build_profile(stacks, stack_timings, name='all'):
+    """
+    Merges the call stacks (a Counter of stacks, see QueryCollector.stacks)
+    into a tree, and returns its root ProfileNode
+    """
+    root = ProfileNode(name)
+    for stack, count in stacks.items():
+        root.add(stack, count, stack_timings.get(stack, 0.0))
+    return root
+
+
+def format_collapsed(stacks, stack_timings, weight='time', name='all'):
+    """
+    Returns the profile in the "collapsed stacks" format;
+    the weight of each stack is either its DB time in microseconds (weight='time')
+    or its number of queries (weight='count')
+    """
+    assert weight in ('time', 'count')
+    lines = []
+    for stack in sorted(stacks):
+        if weight == 'time':
+            value = int(round(stack_timings.get(stack, 0.0) * 1000000))
+        else:
+            value = stacks[stack]
+        lines.append('%s %d' % (';'.join((name, ) + tuple(stack)), value))
+    return ''.join(line + '\n' for line in lines)
+
+
+def render_profile_as_text(root):
+    total = root.db_time or 1.0
+    return '\n'.join(
+        '{indent}{db_time:.4f}s {percent:5.1f}% {count:5d} queries  {name}'.format(
+            indent='  ' * depth,
+            db_time=node.db_time,
+            percent=100.0 * node.db_time / total,
+            count=node.count,
+            name=node.name,
+        )
+        for depth, node in root.walk()
+    )
+
+
+def render_profile_as_html(root):
+    """
+    Renders the profile tree as nested lists; the branches can be
+    expanded or collapsed with <details> elements
+    """
+    total = root.db_time or 1.0
+
+    def render_node(node):
+        summary = format_html(
+            '<span class="numeric">{0}s</span> <span class="numeric">{1}%</span> '
+            '<span class="numeric">{2}</span> <span class="frame">{3}</span>',
+            '%.4f' % node.db_time, '%.1f' % (100.0 * node.db_time / total), node.count, node.name,
+        )
+        if not node.children:
+            return format_html('<li>{0}</li>', summary)
+        return format_html(
+            '<li><details open><summary>{0}</summary><ul>{1}</ul></details></li>',
+            summary,
+            format_html_join('', '{0}', ((render_node(child), ) for child in node.sorted_children())),
+        )
+
+    return format_html('<ul class="query-profile">{0}</ul>', render_node(root))
+
+
+class QueryProfiler(QueryCollector):
+    """
+    A QueryCollector which attributes each query to the project's call stack
+    """
+
+    def __init__(self, name='all', **kwargs):
+        kwargs['capture_stack'] = True
+        super().__init__(**kwargs)
+        self.name = name
+
+    @property
+    def profile(self):
+        with self._lock:
+            return build_profile(self.stacks, self.stack_timings, name=self.name)
+
+    def collapsed(self, weight='time'):
+        with self._lock:
+            return format_collapsed(self.stacks, self.stack_timings, weight=weight, name=self.name)
+
+    def as_text(self):
+        return render_profile_as_text(self.profile)
+
+    def as_html(self):
+        return render_profile_as_html(self.profile)
+
+    def trace(self):
+        trace(self.as_text(), color='white')
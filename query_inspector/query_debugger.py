@@ -3,36 +3,193 @@
 # by Goutom Roy
 # https://medium.com/better-programming/django-select-related-and-prefetch-related-f23043fd635d
 
-from django.db import connection, reset_queries
+import asyncio
 import time
 import functools
+from contextvars import ContextVar
 from .trace import trace
 
 
-def query_debugger(func):
+# The innermost QueryScope active in the current thread or coroutine
+_current_scope = ContextVar('query_inspector_scope', default=None)
 
-    @functools.wraps(func)
-    def inner_func(*args, **kwargs):
 
-        reset_queries()
+def get_current_scope():
+    return _current_scope.get()
 
-        start_queries = len(connection.queries)
 
-        start = time.perf_counter()
-        result = func(*args, **kwargs)
-        end = time.perf_counter()
+def _format_aliases(collector):
+    """
+    Returns the reads and writes of each database, i.e.:
+    "default: 3 reads, 1 writes; replica: 5 reads, 0 writes"
+    """
+    return '; '.join(
+        '{alias}: {reads} reads, {writes} writes'.format(alias=alias, **stats)
+        for alias, stats in collector.stats.items()
+        if stats['total'] > 0
+    )
 
-        end_queries = len(connection.queries)
 
-        trace(' {func}(): {num_queries} queries ({elapsed:.2f}s) '.format(
-            func=func.__qualname__,
-            num_queries=end_queries - start_queries,
-            elapsed=end - start,
-        ), color='white', on_color='on_blue', attrs=['bold'])
+class QueryScope(object):
+    """
+    Counts the queries executed (on all databases) while active.
 
-        # print(f"Function : {func.__name__}")
-        # print(f"Number of Queries : {end_queries - start_queries}")
-        # print(f"Finished in : {(end - start):.2f}s")
-        return result
+    Scopes can be nested; queries executed in a inner scope are accounted to
+    the enclosing scopes as well ("inclusive" counts), while "exclusive" counts
+    exclude the inner scopes. When the outermost scope exits, the whole tree is traced.
 
-    return inner_func
+    A QueryScope is used once; query_debugger() creates a new one for each call
+    of the decorated function.
+
+    When <profile> is set, queries are also attributed to the project's
+    call stack (see profiler.py), and the profile tree is traced as well
+    """
+
+    def __init__(self, name=None, report=True, profile=False):
+        self.name = name or 'query_debugger'
+        self.report = report
+        self.profile = profile
+        self.parent = None
+        self.children = []
+        # (imported here, so that importing the package does not require the settings)
+        from .capture import QueryCollector
+        self.collector = QueryCollector(fingerprint_sql=None, capture_stack=profile)
+        self.start_time = None
+        self.end_time = None
+        self._token = None
+
+    # Inclusive figures
+
+    @property
+    def num_queries(self):
+        return self.collector.total
+
+    @property
+    def db_time(self):
+        return self.collector.db_time
+
+    @property
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time if self.start_time is not None else 0
+
+    # Exclusive figures
+
+    @property
+    def exclusive_num_queries(self):
+        return self.num_queries - sum(child.num_queries for child in self.children)
+
+    @property
+    def exclusive_db_time(self):
+        return self.db_time - sum(child.db_time for child in self.children)
+
+    @property
+    def exclusive_elapsed(self):
+        return self.elapsed - sum(child.elapsed for child in self.children)
+
+    def get_profile(self):
+        """
+        Returns the root profiler.ProfileNode of the queries executed in this scope
+        (requires <profile>)
+        """
+        from .profiler import build_profile
+        return build_profile(self.collector.stacks, self.collector.stack_timings, name=self.name)
+
+    def walk(self, depth=0):
+        """
+        Yields (depth, scope) for this scope and all nested scopes, depth first
+        """
+        yield (depth, self)
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+    def __enter__(self):
+        self.parent = _current_scope.get()
+        self._token = _current_scope.set(self)
+        self.collector.start()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.end_time = time.perf_counter()
+        self.collector.stop()
+        _current_scope.reset(self._token)
+        self._token = None
+        if self.parent is not None:
+            self.parent.children.append(self)
+        elif self.report:
+            self.trace()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, type, value, traceback):
+        return self.__exit__(type, value, traceback)
+
+    def __call__(self, func):
+        """
+        Use as decorator of sync or async functions
+        """
+        name = self.name if self.name != 'query_debugger' else func.__qualname__ + '()'
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_inner_func(*args, **kwargs):
+                async with QueryScope(name, report=self.report, profile=self.profile):
+                    return await func(*args, **kwargs)
+            return async_inner_func
+
+        @functools.wraps(func)
+        def inner_func(*args, **kwargs):
+            with QueryScope(name, report=self.report, profile=self.profile):
+                return func(*args, **kwargs)
+        return inner_func
+
+    def trace(self):
+        for depth, scope in self.walk():
+            num_queries = scope.num_queries
+            text = ' {indent}{name}: {num_queries} queries ({elapsed:.2f}s){details}{exclusive} '.format(
+                indent='  ' * depth,
+                name=scope.name,
+                num_queries=num_queries,
+                elapsed=scope.elapsed,
+                details=' [%s]' % _format_aliases(scope.collector) if num_queries else '',
+                exclusive=', exclusive: {0} queries ({1:.2f}s)'.format(
+                    scope.exclusive_num_queries, scope.exclusive_elapsed) if scope.children else '',
+            )
+            if depth == 0:
+                trace(text, color='white', on_color='on_blue', attrs=['bold'])
+            else:
+                trace(text, color='white', on_color='on_cyan')
+        if self.profile and self.num_queries:
+            from .profiler import render_profile_as_text
+            trace(render_profile_as_text(self.get_profile()), color='white')
+
+
+def query_debugger(func=None, name=None, profile=False):
+    """
+    Counts the queries executed on all databases by a function (sync or async),
+    or by a block of code.
+
+    Queries are captured as they are executed (see capture.QueryCollector),
+    so connection.queries is neither required nor reset.
+
+    Sample usage:
+
+        @query_debugger
+        def tracks_list_view(request):
+            ...
+            with query_debugger('load albums'):
+                ...
+
+        @query_debugger
+        async def tracks_list_async_view(request):
+            ...
+
+        @query_debugger(profile=True)
+        def album_detail_view(request, pk):
+            ...
+    """
+    if callable(func):
+        return QueryScope(name, profile=profile)(func)
+    return QueryScope(func if func is not None else name, profile=profile)
@@ -0,0 +1,113 @@
+"""
+A compact representation of query results.
+
+Instead of one dictionary per row, a Recordset keeps a single list of column names
+and the rows as tuples (as returned by the db cursor); dictionary-like views
+of the rows (RowView) are created lazily, when required, and share the column index.
+
+Sample usage:
+
+    recordset = perform_query(sql, params, compact=True)
+
+    print(len(recordset), recordset.columns)
+    for row in recordset:
+        print(row['id'], row['name'])
+    names = recordset.column('name')
+"""
+from collections.abc import Mapping, Sequence
+
+
+def unique_columns(names):
+    """
+    Renames the duplicated column names ("id", "id" -> "id", "id_2"),
+    so that each value of a row can be addressed by name
+    """
+    columns = []
+    for name in names:
+        column = name
+        n = 1
+        while column in columns:
+            n += 1
+            column = '%s_%d' % (name, n)
+        columns.append(column)
+    return columns
+
+
+class RowView(Mapping):
+    """
+    A read-only, dictionary-like view of a row tuple
+    """
+
+    __slots__ = ('_index', '_values', )
+
+    def __init__(self, index, values):
+        # index: column name -> position
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def values(self):
+        return self._values
+
+    def as_tuple(self):
+        return self._values
+
+
+class Recordset(Sequence):
+    """
+    Query results, as a list of column names and a list of row tuples;
+    behaves as a list of (read-only) dictionaries
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = unique_columns(columns)
+        self.rows = rows if isinstance(rows, list) else list(rows)
+        self._index = {name: position for position, name in enumerate(self.columns)}
+
+    @classmethod
+    def from_cursor(cls, cursor):
+        return cls([col[0] for col in cursor.description], cursor.fetchall())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Recordset(self.columns, self.rows[index])
+        return RowView(self._index, self.rows[index])
+
+    def __iter__(self):
+        index = self._index
+        for values in self.rows:
+            yield RowView(index, values)
+
+    def __repr__(self):
+        return '<Recordset: %d columns, %d rows>' % (len(self.columns), len(self.rows))
+
+    def column(self, name):
+        """
+        Returns all the values of the given column, as a list
+        """
+        position = self._index[name]
+        return [values[position] for values in self.rows]
+
+    def as_columns(self):
+        """
+        Returns the data as column arrays: {column name: [values], ...}
+        """
+        arrays = list(zip(*self.rows)) if self.rows else [(), ] * len(self.columns)
+        return {name: list(values) for name, values in zip(self.columns, arrays)}
+
+    def as_dicts(self):
+        return [dict(zip(self.columns, values)) for values in self.rows]
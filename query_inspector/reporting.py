@@ -0,0 +1,350 @@
+"""
+Delivery of the middleware's reports, off the request thread.
+
+Reports are handed to a background thread through a bounded queue;
+when the queue is full (i.e. the sinks can't keep up), new reports are
+dropped and counted, so that slow terminals or log pipes never add to the
+response latency. The writer thread exits when idle, and is restarted on demand.
+
+Each report is delivered to one or more sinks:
+
+    StreamSink: the colored text report, written to sys.stderr (as runserver does)
+    JSONLinesSink: one JSON record per request, appended to a file
+    LoggingSink: one JSON record per request, sent to a Python logger
+    UnixSocketSink: one JSON record per request, sent to a UNIX socket
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import sys
+import threading
+
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger('query_inspector')
+
+
+def report_record(collector):
+    """
+    Returns the structured (JSON serializable) representation of a collector
+    """
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='microseconds'),
+        'host': collector.host,
+        'path': collector.request_path,
+        'endpoint': collector.endpoint,
+        'elapsed': round(collector.elapsed, 6),
+        'db_time': round(collector.db_time, 6),
+        'total': collector.total,
+        'databases': {
+            alias: dict(stats, time=round(stats['time'], 6))
+            for alias, stats in collector.stats.items()
+            if stats['total'] > 0
+        },
+        'queries': _query_records(collector),
+    }
+
+
+def _query_records(collector):
+    """
+    Groups the executed statements by database and fingerprint, in order of first execution;
+    the execution plan is included, when captured (see explain.py)
+    """
+    queries = {}
+    for query in collector.log:
+        key = (query.alias, query.fingerprint)
+        item = queries.get(key)
+        if item is None:
+            item = queries[key] = {'alias': query.alias, 'fingerprint': query.fingerprint,
+                                   'count': 0, 'time': 0.0, 'max_time': 0.0}
+        item['count'] += 1
+        item['time'] += query.duration
+        item['max_time'] = max(item['max_time'], query.duration)
+    for item in queries.values():
+        item['time'] = round(item['time'], 6)
+        item['max_time'] = round(item['max_time'], 6)
+        plan = collector.plans.get(item['fingerprint'])
+        if plan is not None:
+            item['plan'] = plan
+    return list(queries.values())
+
+
+class Report(object):
+    """
+    The report of a single request.
+
+    Both representations are built lazily, in the writer thread,
+    and only if required by some sink:
+
+    text: the human readable report, as returned by render(collector)
+    record: the structured report, as a dictionary
+    """
+
+    def __init__(self, collector, render=None):
+        self.collector = collector
+        self.render = render
+
+    @cached_property
+    def text(self):
+        return self.render(self.collector) if self.render is not None else ''
+
+    @cached_property
+    def record(self):
+        return report_record(self.collector)
+
+    @cached_property
+    def json(self):
+        return json.dumps(self.record, default=str)
+
+
+class StreamSink(object):
+
+    def __init__(self, stream=None):
+        # None = sys.stderr, as found when writing
+        self.stream = stream
+
+    def write(self, report):
+        text = report.text
+        if text:
+            stream = self.stream if self.stream is not None else sys.stderr
+            stream.write(text)
+            stream.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONLinesSink(object):
+    """
+    Appends one JSON record per report to <filename>.
+
+    When <max_bytes> is given, the file is rotated before exceeding this size,
+    and up to <backup_count> old files are kept (filename.1, filename.2, ...),
+    optionally gzip compressed (filename.1.gz, ...).
+
+    Like logging's RotatingFileHandler, rotation is not coordinated between
+    processes; use a different file for each process
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=5, compress=False):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._file = None
+
+    def write(self, report):
+        line = report.json + '\n'
+        if self._file is None:
+            self._file = open(self.filename, 'a', encoding='utf-8')
+        if self._should_rotate(line):
+            self.rotate()
+            self._file = open(self.filename, 'a', encoding='utf-8')
+        self._file.write(line)
+
+    def _should_rotate(self, line):
+        if not self.max_bytes:
+            return False
+        position = self._file.tell()
+        return position > 0 and position + len(line.encode('utf-8')) > self.max_bytes
+
+    def _backup_name(self, index):
+        return '%s.%d%s' % (self.filename, index, '.gz' if self.compress else '')
+
+    def rotate(self):
+        self.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = self._backup_name(index)
+                if os.path.exists(source):
+                    os.replace(source, self._backup_name(index + 1))
+            if os.path.exists(self.filename):
+                if self.compress:
+                    with open(self.filename, 'rb') as source, gzip.open(self._backup_name(1), 'wb') as target:
+                        shutil.copyfileobj(source, target)
+                    os.remove(self.filename)
+                else:
+                    os.replace(self.filename, self._backup_name(1))
+        elif os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LoggingSink(object):
+
+    def __init__(self, logger='query_inspector.reports', level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def write(self, report):
+        if self.logger.isEnabledFor(self.level):
+            # The record is also attached to the LogRecord, for structured formatters
+            self.logger.log(self.level, report.json, extra={'query_report': report.record})
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class UnixSocketSink(object):
+    """
+    Sends one JSON line per report to a stream socket;
+    when the listener is not available, reports are discarded,
+    and the connection is retried with the next one
+    """
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self._socket = None
+
+    def write(self, report):
+        data = (report.json + '\n').encode('utf-8')
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._socket.settimeout(self.timeout)
+                self._socket.connect(self.path)
+            self._socket.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+
+
+def build_sinks(config):
+    """
+    Instantiates the sinks from a list of dictionaries, in the same fashion
+    of Django's LOGGING handlers; i.e.:
+
+        [{'class': 'query_inspector.reporting.JSONLinesSink', 'filename': '/tmp/queries.jsonl'}, ]
+
+    Sink instances are accepted as well
+    """
+    sinks = []
+    for item in config:
+        if isinstance(item, dict):
+            kwargs = dict(item)
+            klass = kwargs.pop('class')
+            if isinstance(klass, str):
+                klass = import_string(klass)
+            item = klass(**kwargs)
+        sinks.append(item)
+    return sinks
+
+
+class ReportWriter(object):
+    """
+    Delivers the reports to the sinks, from a background thread when <asynchronous>;
+    otherwise, from the request threads, one report at a time (sinks are not thread-safe).
+
+    <queue_size>: the max number of pending reports; further reports are dropped
+    <idle_timeout>: the writer thread exits after being idle for this many seconds
+
+    dropped: the number of reports dropped because the queue was full
+    errors: the number of failed deliveries
+    """
+
+    def __init__(self, sinks, asynchronous=True, queue_size=1000, idle_timeout=5.0):
+        self.sinks = list(sinks)
+        self.asynchronous = asynchronous
+        self.idle_timeout = idle_timeout
+        self.dropped = 0
+        self.errors = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        # Serializes the calls to the sinks
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, report):
+        """
+        Hands the report to the writer; never blocks when asynchronous
+        """
+        if not self.sinks:
+            return
+        if not self.asynchronous:
+            with self._write_lock:
+                self._deliver(report)
+                for sink in self.sinks:
+                    sink.flush()
+            return
+        try:
+            self._queue.put_nowait(report)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='query_inspector.ReportWriter', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """
+        Waits until all pending reports have been delivered
+        """
+        self._queue.join()
+        with self._write_lock:
+            for sink in self.sinks:
+                sink.flush()
+
+    def _run(self):
+        while True:
+            try:
+                report = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._thread = None
+                        break
+                continue
+            try:
+                with self._write_lock:
+                    self._deliver(report)
+            finally:
+                self._queue.task_done()
+
+        with self._write_lock:
+            for sink in self.sinks:
+                try:
+                    sink.flush()
+                except Exception:
+                    pass
+
+    def _deliver(self, report):
+        for sink in self.sinks:
+            try:
+                sink.write(report)
+            except Exception:
+                self.errors += 1
+                logger.debug('Failed to deliver query report to %r', sink, exc_info=True)
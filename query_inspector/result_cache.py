@@ -0,0 +1,124 @@
+"""
+A cache of the results of stored queries, based on Django's cache framework
+(see QUERY_INSPECTOR_QUERY_CACHE).
+
+Results are keyed by the query slug, a hash of the sql statement and the
+normalized parameters, and expire after the query's cache_ttl (in seconds);
+all the results of a query can be invalidated at once, as each slug
+has its own version number embedded in the keys.
+
+Sample usage:
+
+    recordset, cached_at = execute_stored_query(query, params)
+    ...
+    invalidate_query_results(query)
+"""
+import hashlib
+import itertools
+import json
+import time
+from django.core.cache import caches
+from . import app_settings
+from .recordset import Recordset
+from .sql import perform_query
+
+
+def get_cache():
+    return caches[app_settings.QUERY_CACHE]
+
+
+def normalize_params(params):
+    """
+    A stable representation of the parameters (insensitive to the order of the keys)
+    """
+    return json.dumps(params or {}, sort_keys=True, default=str)
+
+
+def _version_key(slug):
+    return 'query_inspector:version:%s' % slug
+
+
+def result_cache_key(slug, sql, params):
+    version = get_cache().get(_version_key(slug), 0)
+    return 'query_inspector:result:%s:%d:%s:%s' % (
+        slug,
+        version,
+        hashlib.sha1(sql.encode('utf-8')).hexdigest(),
+        hashlib.sha1(normalize_params(params).encode('utf-8')).hexdigest(),
+    )
+
+
+def get_cached_result(query, sql, params):
+    """
+    Returns the cached result as (Recordset, timestamp), or (None, None)
+    """
+    if not query.get_cache_ttl():
+        return None, None
+    entry = get_cache().get(result_cache_key(query.slug, sql, params))
+    if entry is None:
+        return None, None
+    return Recordset(entry['columns'], entry['rows']), entry['created']
+
+
+def cache_result(query, sql, params, recordset):
+    """
+    Saves the result of the query, unless caching is disabled for it,
+    or the result is larger than QUERY_INSPECTOR_QUERY_CACHE_MAX_ROWS;
+    returns True when the result has been cached
+    """
+    ttl = query.get_cache_ttl()
+    if not ttl or len(recordset) > app_settings.QUERY_CACHE_MAX_ROWS:
+        return False
+    entry = {
+        'columns': recordset.columns,
+        'rows': [tuple(row) for row in recordset.rows],
+        'created': time.time(),
+    }
+    get_cache().set(result_cache_key(query.slug, sql, params), entry, ttl)
+    return True
+
+
+def invalidate_query_results(query):
+    """
+    Discards all the cached results of the query (whatever the parameters)
+    """
+    cache = get_cache()
+    key = _version_key(query.slug)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # the key has been evicted in the meantime
+        cache.set(key, 1, None)
+
+
+def execute_stored_query(query, params, sql_limit=0, **kwargs):
+    """
+    Executes a Query, and returns (recordset, cached_at), where <recordset>
+    is a Recordset and <cached_at> is the timestamp of the cached result used
+    (None when the query has been executed); <kwargs> are passed to perform_query()
+
+    At most QUERY_INSPECTOR_QUERY_CACHE_MAX_ROWS + 1 rows are fetched when the
+    query is cacheable; a larger result is not cached, and is returned truncated
+    (check len(recordset) against the limit if you need to know).
+    """
+    sql = query.sql
+    if sql_limit > 0:
+        sql += ' limit %d' % sql_limit
+
+    recordset, cached_at = get_cached_result(query, sql, params)
+    if recordset is not None:
+        return recordset, cached_at
+
+    if not query.get_cache_ttl():
+        return perform_query(sql, params, compact=True, **kwargs), None
+
+    # (the column names are known even when the result is empty)
+    stream = perform_query(sql, params, stream=True, compact=True, **kwargs).start()
+    try:
+        rows = list(itertools.islice(stream, app_settings.QUERY_CACHE_MAX_ROWS + 1))
+    finally:
+        stream.close()
+    recordset = Recordset(stream.columns, [row.as_tuple() for row in rows])
+    cache_result(query, sql, params, recordset)
+    return recordset, None
@@ -0,0 +1,87 @@
+"""
+Request sampling for QueryCountMiddleware.
+
+Only a fraction of the requests is fully instrumented; the others only pay
+for a random number, and (when sampling the slowest requests) a timer and
+a dictionary update.
+"""
+import random
+import threading
+from collections import deque, OrderedDict
+
+
+class RequestSampler(object):
+    """
+    Decides which requests should be instrumented:
+
+    <rate>: the fraction of requests to be sampled at random (1.0 = all)
+    <slow_percentile>: when given, also sample the requests for paths
+                       whose recent average response time is above this
+                       percentile of all recently observed response times
+                       (i.e. 95 = sample the slowest 5%)
+
+    Response times are tracked for at most <max_paths> paths (least recently
+    used are discarded), with an exponentially weighted moving average.
+    """
+
+    def __init__(self, rate=1.0, slow_percentile=None, window=1000, max_paths=1000, alpha=0.2, random=random.random):
+        self.rate = rate
+        self.slow_percentile = slow_percentile
+        self.window = window
+        self.max_paths = max_paths
+        self.alpha = alpha
+        self.random = random
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._averages = OrderedDict()
+        self._observed = 0
+        self.threshold = None
+
+    @property
+    def samples_all(self):
+        return self.rate >= 1.0
+
+    @property
+    def observing(self):
+        """
+        True when response times need to be observed for all requests
+        """
+        return self.slow_percentile is not None
+
+    def should_sample(self, path):
+        if self.samples_all:
+            return True
+        if self.rate > 0 and self.random() < self.rate:
+            return True
+        if self.threshold is not None:
+            average = self._averages.get(path)
+            if average is not None and average > self.threshold:
+                return True
+        return False
+
+    def observe(self, path, elapsed):
+        """
+        Record the response time of a request
+        """
+        if not self.observing:
+            return
+        with self._lock:
+            average = self._averages.pop(path, None)
+            if average is None:
+                average = elapsed
+            else:
+                average += self.alpha * (elapsed - average)
+            self._averages[path] = average
+            if len(self._averages) > self.max_paths:
+                self._averages.popitem(last=False)
+
+            self._latencies.append(elapsed)
+            self._observed += 1
+            # Refresh the threshold from time to time
+            if self._observed % max(1, self.window // 10) == 0 or self.threshold is None:
+                self._update_threshold()
+
+    def _update_threshold(self):
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.slow_percentile / 100.0))
+        self.threshold = latencies[index]
@@ -1,10 +1,13 @@
 import time
 import functools
 import re
-from django.db import connection
+import threading
+from contextlib import contextmanager
+from django.db import connections, transaction, DatabaseError, OperationalError, DEFAULT_DB_ALIAS
 from django.forms import ValidationError
 from query_inspector import prettyprint_queryset, prettyprint_query, trace, qsdump
 from . import app_settings
+from .recordset import Recordset, RowView, unique_columns
 
 
 def dictfetchall(cursor):
@@ -74,6 +77,8 @@ def reload_stock_queries():
         query.title = row.get('title', '')
         query.sql = row['sql']
         query.notes = row.get('notes', '')
+        query.timeout = row.get('timeout')
+        query.cache_ttl = row.get('cache_ttl')
         query.save()
         n += 1
 
@@ -99,7 +104,221 @@ def reload_stock_queries():
     return n
 
 
-def perform_query(sql, params, log=False, validate=True):
+class QueryTimeout(OperationalError):
+    pass
+
+
+class QueryCancelled(OperationalError):
+    pass
+
+
+# The statements run by statement_timeout() on PostgreSQL are tagged with this
+# application_name, so that cancel_query() can find them from any process
+APPLICATION_NAME_PREFIX = 'query_inspector:'
+
+# How often (in SQLite virtual machine instructions) the progress handler is invoked
+SQLITE_PROGRESS_STEPS = 1000
+
+# Cancellation flags of the statements running in this process, by token
+_running_queries = {}
+_running_queries_lock = threading.Lock()
+
+
+class Deadline(object):
+    """
+    When the running statement (or fetch) has to be stopped; see statement_timeout()
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.restart()
+
+    def restart(self):
+        self.expires = time.monotonic() + self.timeout if self.timeout else None
+
+    @property
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+
+@contextmanager
+def statement_timeout(timeout=None, token=None, using=DEFAULT_DB_ALIAS):
+    """
+    Stops the statements executed inside the block after <timeout> seconds
+    (None or 0 = no limit); when a <token> is given, they can also be stopped
+    with cancel_query(<token>).
+
+    - PostgreSQL: the block runs in a transaction, with SET LOCAL statement_timeout
+    - SQLite: a progress handler interrupts the running statement
+    - other backends: no limit is applied
+
+    Raises QueryTimeout or QueryCancelled accordingly.
+
+    The block receives a Deadline; as on PostgreSQL each fetch from a named cursor
+    is a statement on its own, call its restart() method before fetching the next batch
+    of rows, so that the time spent by the caller between fetches doesn't count.
+    """
+    deadline = Deadline(timeout)
+    if not timeout and not token:
+        yield deadline
+        return
+
+    connection = connections[using]
+    cancelled = threading.Event()
+    if token:
+        with _running_queries_lock:
+            _running_queries[token] = cancelled
+
+    try:
+        if connection.vendor == 'postgresql':
+            with transaction.atomic(using=using):
+                with connection.cursor() as cursor:
+                    if timeout:
+                        cursor.execute('SET LOCAL statement_timeout = %d' % max(1, int(timeout * 1000)))
+                    if token:
+                        cursor.execute("SELECT set_config('application_name', %s, true)", [APPLICATION_NAME_PREFIX + token])
+                yield deadline
+        elif connection.vendor == 'sqlite':
+
+            def progress_handler():
+                # A non-zero value interrupts the running statement
+                return cancelled.is_set() or deadline.expired
+
+            connection.ensure_connection()
+            connection.connection.set_progress_handler(progress_handler, SQLITE_PROGRESS_STEPS)
+            try:
+                yield deadline
+            finally:
+                connection.connection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+        else:
+            yield deadline
+    except DatabaseError as e:
+        if cancelled.is_set():
+            raise QueryCancelled('Query has been cancelled') from e
+        if deadline.expired:
+            raise QueryTimeout('Query has been stopped after %s seconds' % timeout) from e
+        raise
+    finally:
+        if token:
+            with _running_queries_lock:
+                _running_queries.pop(token, None)
+
+
+def cancel_query(token, using=DEFAULT_DB_ALIAS):
+    """
+    Stops the statement started by statement_timeout(token=<token>);
+    on PostgreSQL, the backend running it is cancelled even when it belongs
+    to another server process; on SQLite, only statements running in this process
+    can be reached.
+
+    Returns True if a running statement has been found.
+    """
+    with _running_queries_lock:
+        cancelled = _running_queries.get(token)
+    if cancelled is not None:
+        cancelled.set()
+
+    found = cancelled is not None
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_cancel_backend(pid) FROM pg_stat_activity WHERE application_name = %s AND pid <> pg_backend_pid()',
+                [APPLICATION_NAME_PREFIX + token]
+            )
+            found = any(row[0] for row in cursor.fetchall()) or found
+    return found
+
+
+def stream_cursor(using=DEFAULT_DB_ALIAS):
+    """
+    Returns a cursor suitable for iterating over large results:
+    a named (server-side) cursor on PostgreSQL, unless DISABLE_SERVER_SIDE_CURSORS
+    is set for the database; a regular cursor elsewhere
+    """
+    connection = connections[using]
+    if connection.settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+        return connection.cursor()
+    return connection.chunked_cursor()
+
+
+class QueryStream(object):
+    """
+    The rows of a statement, fetched in batches from a server-side cursor
+    (see perform_query(stream=True)).
+
+    The statement is executed by start(), or when the iteration begins;
+    call start() beforehand to have errors raised at once, and the column names
+    (see <columns>) available even for an empty result.
+    The cursor is kept open until the rows are exhausted, or close() is called.
+    """
+
+    def __init__(self, sql, params, batch_size, log, start, using, compact, timeout, token):
+        self.columns = None
+        self._started = False
+        self._rows = self._fetch(sql, params, batch_size, log, start, using, compact, timeout, token)
+
+    def _fetch(self, sql, params, batch_size, log, start, using, compact, timeout, token):
+        with statement_timeout(timeout, token, using) as deadline:
+            with stream_cursor(using) as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchmany(batch_size)
+                # (the description of a named cursor is available only after the first fetch)
+                self.columns = unique_columns(col[0] for col in cursor.description)
+                index = {name: position for position, name in enumerate(self.columns)}
+                # Tell start() that the statement has been executed
+                yield None
+                while rows:
+                    for row in rows:
+                        yield RowView(index, row) if compact else dict(zip(self.columns, row))
+                    # (the time spent by the consumer doesn't count)
+                    deadline.restart()
+                    rows = cursor.fetchmany(batch_size)
+
+        end = time.perf_counter()
+        if log:
+            trace(' query time: {elapsed:.2f}s '.format(
+                elapsed=end - start,
+            ), color='white', on_color='on_blue', attrs=['bold'])
+
+    def start(self):
+        """
+        Executes the statement and fetches the first batch of rows
+        """
+        if not self._started:
+            self._started = True
+            next(self._rows)
+        return self
+
+    def close(self):
+        self._rows.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.start()
+        return next(self._rows)
+
+
+def perform_query(sql, params, log=False, validate=True, stream=False, batch_size=None, using=DEFAULT_DB_ALIAS,
+                  compact=False, timeout=None, token=None):
+    """
+    Executes the given sql statement, and returns the resulting rows as a list of dicts.
+
+    When <compact> is set, a Recordset is returned instead: the column names
+    and the row tuples, with dictionary-like views of the rows created on demand
+    (see recordset.py); this takes far less memory for large or wide results.
+
+    When <stream> is set, a QueryStream (an iterator of dicts) is returned instead;
+    rows are fetched in batches of <batch_size> from a server-side cursor (see stream_cursor()),
+    so memory usage doesn't depend on the size of the result; note that the
+    statement is executed by QueryStream.start() or when the iteration begins, and the cursor
+    is kept open until the stream is exhausted or closed; with <compact>, rows are yielded as RowViews.
+
+    <timeout> (in seconds) and <token> are passed to statement_timeout(), to limit the
+    execution time and allow the cancellation of the statement.
+    """
     start = time.perf_counter()
     if log:
         print('')
@@ -117,9 +336,14 @@ def perform_query(sql, params, log=False, validate=True):
                 code="InvalidSql"
             )
 
-    with connection.cursor() as cursor:
-        cursor.execute(sql, params)
-        rows = dictfetchall(cursor)
+    if stream:
+        batch_size = batch_size or app_settings.QUERY_STREAM_BATCH_SIZE
+        return QueryStream(sql, params, batch_size, log, start, using, compact, timeout, token)
+
+    with statement_timeout(timeout, token, using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = Recordset.from_cursor(cursor) if compact else dictfetchall(cursor)
 
     end = time.perf_counter()
     if log:
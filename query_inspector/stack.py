@@ -0,0 +1,67 @@
+"""
+Helpers to attribute queries to the project's code, by walking the call stack
+and skipping the frames of Django, of the standard library, of installed
+packages and of query_inspector itself.
+"""
+import sys
+import sysconfig
+from functools import lru_cache
+
+
+LIBRARY_PATHS = tuple(set(
+    path for path in [
+        sysconfig.get_paths().get(name)
+        for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+    ] if path
+))
+
+LIBRARY_MODULES = ('django', 'asgiref', 'query_inspector', )
+
+
+@lru_cache(maxsize=1024)
+def is_project_code(filename, module):
+    # (but our own test suite is treated as project code)
+    if module.split('.', 1)[0] in LIBRARY_MODULES and not module.startswith('query_inspector.tests'):
+        return False
+    if filename.startswith('<'):
+        return False
+    return not filename.startswith(LIBRARY_PATHS)
+
+
+def is_project_frame(frame):
+    return is_project_code(frame.f_code.co_filename, frame.f_globals.get('__name__', ''))
+
+
+def find_callsite(frame=None):
+    """
+    Returns the innermost project's frame in the current call stack
+    as a tuple (filename, lineno, function), or None
+    """
+    if frame is None:
+        frame = sys._getframe(1)
+    while frame is not None:
+        if is_project_frame(frame):
+            return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+@lru_cache(maxsize=4096)
+def _frame_label(module, function, lineno):
+    return '%s.%s:%d' % (module, function, lineno)
+
+
+def find_project_stack(frame=None, limit=64):
+    """
+    Returns the project's frames in the current call stack, outermost first,
+    as a tuple of labels "module.function:lineno" (at most <limit>, innermost)
+    """
+    if frame is None:
+        frame = sys._getframe(1)
+    labels = []
+    while frame is not None and len(labels) < limit:
+        if is_project_frame(frame):
+            labels.append(_frame_label(frame.f_globals.get('__name__', '?'), frame.f_code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    labels.reverse()
+    return tuple(labels)
@@ -5,7 +5,7 @@ import datetime
 import io
 import csv
 import decimal
-from collections import OrderedDict
+from collections.abc import Mapping
 from django.urls.exceptions import NoReverseMatch
 from django import template
 from django.urls import reverse
@@ -21,6 +21,7 @@ from django.core import serializers
 from django.utils.encoding import is_protected_type
 from django.forms.models import model_to_dict
 from django.core.serializers.json import DjangoJSONEncoder
+from ..recordset import Recordset
 
 register = template.Library()
 
@@ -331,7 +332,7 @@ def render_queryset(*fields, queryset, mode, options):
         return current_value
 
     def get_cell_value(row, column):
-        if type(row) in [dict, OrderedDict, ]:
+        if isinstance(row, Mapping):
             value = row.get(column['name'])
         else:
             if '__' not in column['name']:
@@ -430,7 +431,7 @@ def render_queryset(*fields, queryset, mode, options):
 
     # Collect the rows from the queryset (or list of dictionaries);
     #rows = queryset if type(queryset) == list else queryset.all()
-    if type(queryset) == list:
+    if type(queryset) == list or isinstance(queryset, Recordset):
         rows = queryset
         num_rows = len(rows)
     else:
@@ -438,8 +439,10 @@ def render_queryset(*fields, queryset, mode, options):
         num_rows = rows.count()
 
     # Experimental: detect all fields
-    if '*' in fields and num_rows > 0:
-        if type(rows[0]) in [dict, OrderedDict, ]:
+    if '*' in fields and isinstance(rows, Recordset):
+        fields = tuple(rows.columns)
+    elif '*' in fields and num_rows > 0:
+        if isinstance(rows[0], Mapping):
             fields = tuple(rows[0].keys())
         else:
             fields = [f.name for f in rows[0]._meta.fields]
@@ -573,7 +576,7 @@ def render_queryset_as_table(*fields, queryset, options={}):
             {% render_queryset_as_table "id" "last_name|Cognome" "first_name|Nome" ... queryset=operatori %}
         </table>
 
-    queryset: a queryset of a list of dictionaries with data to rendered
+    queryset: a queryset, a list of dictionaries or a Recordset with data to rendered
 
     options:
         - max_rows: max n. of rows to be rendered (None=all)
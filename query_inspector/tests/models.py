@@ -8,3 +8,20 @@ class Sample(models.Model):
     class Meta:
         ordering = ('-created', )  # better choice for UI
         get_latest_by = "-created"
+
+
+class Author(models.Model):
+
+    name = models.CharField(max_length=100)
+
+
+class Tag(models.Model):
+
+    name = models.CharField(max_length=100)
+
+
+class Book(models.Model):
+
+    title = models.CharField(max_length=100)
+    author = models.ForeignKey(Author, on_delete=models.CASCADE)
+    tags = models.ManyToManyField(Tag, blank=True)
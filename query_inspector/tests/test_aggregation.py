@@ -0,0 +1,52 @@
+from django.test import TestCase, override_settings
+from query_inspector.aggregation import AggregationStore, aggregation_store
+from query_inspector.capture import QueryCollector
+
+
+class AggregationStoreTestCase(TestCase):
+
+    def collector(self, queries, db_time):
+        collector = QueryCollector(aliases=['default'])
+        for sql in queries:
+            collector.record('default', sql, db_time / len(queries) if queries else 0)
+        return collector
+
+    def test_record(self):
+        store = AggregationStore()
+        store.record('books', 'views.books', self.collector(['select 1'] * 3, 0.3))
+        store.record('books', 'views.books', self.collector(['select 1'] * 30, 0.9))
+        store.record('empty', 'views.empty', self.collector([], 0))
+
+        rows = store.snapshot()
+        self.assertEqual([row['endpoint'] for row in rows], ['books', 'empty'])
+        books = rows[0]
+        self.assertEqual(books['requests'], 2)
+        self.assertEqual(books['queries'], 33)
+        self.assertAlmostEqual(books['db_time'], 1.2)
+        self.assertAlmostEqual(books['p50_db_time'], 0.9)
+        self.assertEqual(books['histogram'], '2-5:1 26-50:1')
+        self.assertEqual(rows[1]['histogram'], '0:1')
+        self.assertEqual(store.get('books').top_fingerprints(), [('select ?', 33)])
+        self.assertEqual(store.top_fingerprints('books'), [('select ?', 33)])
+        self.assertIsNone(store.top_fingerprints('missing'))
+
+    def test_bounded(self):
+        store = AggregationStore(max_endpoints=5, max_samples=10, max_fingerprints=3)
+        for i in range(10):
+            store.record('endpoint%d' % i, '', self.collector(['select %d from t%d' % (i, j) for j in range(10)], 0.1))
+            store.record('endpoint9', '', self.collector(['select %d from t%d' % (i, j) for j in range(10)], 0.1))
+        self.assertEqual(len(store.snapshot()), 5)
+        stats = store.get('endpoint9')
+        self.assertEqual(len(stats.db_times), 10)
+        self.assertTrue(len(stats.fingerprints) <= 6)
+
+    @override_settings(ROOT_URLCONF='query_inspector.tests.urls', DEBUG=True)
+    def test_middleware(self):
+        aggregation_store.reset()
+        for i in range(3):
+            self.client.get("/count/")
+        row = aggregation_store.snapshot()[0]
+        self.assertEqual(row['endpoint'], 'count')
+        self.assertEqual(row['view'], 'query_inspector.tests.views.count_migrations')
+        self.assertEqual(row['requests'], 3)
+        self.assertEqual(row['queries'], 3)
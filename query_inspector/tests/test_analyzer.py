@@ -0,0 +1,89 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from django.core.management import call_command
+from django.test import TestCase
+from query_inspector.analyzer import analyze_files, analyze_lines, LogAnalysis
+from query_inspector.management.commands.analyze_query_logs import Command
+
+
+DEBUG_LOG = '''\
+(0.002) SELECT "app_album"."id" FROM "app_album"; args=()
+(0.001) SELECT "app_track"."id" FROM "app_track" WHERE "app_track"."album_id" = 1; args=(1,)
+(0.001) SELECT "app_track"."id" FROM "app_track" WHERE "app_track"."album_id" = 2; args=(2,)
+(0.003) SELECT "app_track"."id" FROM "app_track" WHERE "app_track"."album_id" = 3; args=(3,)
+[17/Oct/2026 09:12:01] "GET /albums/?page=2 HTTP/1.1" 200 1234
+(0.004) UPDATE "app_album" SET "title" = 'x' WHERE "app_album"."id" = 1; args=('x', 1); alias=default
+[17/Oct/2026 09:12:02] "POST /albums/1/ HTTP/1.1" 302 0
+'''
+
+TRACK_QUERY = 'SELECT "app_track"."id" FROM "app_track" WHERE "app_track"."album_id" = ?'
+
+
+def json_record(endpoint, count, time):
+    return json.dumps({
+        'endpoint': endpoint,
+        'path': '/' + endpoint + '/',
+        'queries': [{'alias': 'default', 'fingerprint': TRACK_QUERY, 'count': count, 'time': time, 'max_time': time}],
+    })
+
+
+class AnalyzerTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_debug_log(self):
+        analysis = analyze_lines(io.StringIO(DEBUG_LOG), LogAnalysis(nplusone_threshold=2))
+        self.assertEqual(analysis.requests, 2)
+        endpoints = analysis.top_endpoints()
+        self.assertEqual([row['endpoint'] for row in endpoints], ['/albums/', '/albums/1/'])
+        self.assertEqual(endpoints[0]['queries'], 4)
+        self.assertEqual(endpoints[0]['db_time'], 0.007)
+        fingerprints = analysis.top_fingerprints(1)
+        self.assertEqual(fingerprints[0]['fingerprint'], TRACK_QUERY)
+        self.assertEqual(fingerprints[0]['count'], 3)
+        self.assertEqual(fingerprints[0]['max_time'], 0.003)
+        nplusone = analysis.top_nplusone()
+        self.assertEqual(len(nplusone), 1)
+        self.assertEqual(nplusone[0]['max_count'], 3)
+
+    def test_files(self):
+        filenames = []
+        for i in range(3):
+            filename = os.path.join(self.folder, 'queries%d.jsonl.gz' % i)
+            with gzip.open(filename, 'wt') as f:
+                f.write(json_record('track-list', 10, 0.01) + '\n')
+                f.write(json_record('album-detail', 1, 0.001) + '\n')
+                f.write('{not json\n')
+            filenames.append(filename)
+        analysis = analyze_files(filenames, processes=2)
+        self.assertEqual(analysis.files, 3)
+        self.assertEqual(analysis.requests, 6)
+        self.assertEqual(analysis.errors, 3)
+        self.assertEqual(analysis.top_endpoints(1)[0]['endpoint'], 'track-list')
+        self.assertEqual(analysis.top_nplusone()[0]['requests'], 3)
+
+        # Same results without multiprocessing
+        sequential = analyze_files(filenames, processes=1)
+        self.assertEqual(sequential.top_endpoints(), analysis.top_endpoints())
+
+    def test_command(self):
+        filename = os.path.join(self.folder, 'debug.log')
+        with open(filename, 'w') as f:
+            f.write(DEBUG_LOG)
+        stdout = io.StringIO()
+        call_command(Command(), filename, report=['endpoints'], stdout=stdout, stderr=io.StringIO())
+        self.assertIn('# Endpoints by DB time', stdout.getvalue())
+        self.assertIn('/albums/1/', stdout.getvalue())
+        self.assertNotIn('N+1', stdout.getvalue())
+
+        stdout = io.StringIO()
+        call_command(Command(), filename, format='table', stdout=stdout, stderr=io.StringIO())
+        self.assertIn('<td class="field-endpoint">/albums/</td>', stdout.getvalue())
@@ -0,0 +1,109 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+from django.forms import ValidationError
+from django.test import TestCase
+from query_inspector import app_settings
+from query_inspector.background import BackgroundJob, cleanup_jobs, get_spool_folder, list_jobs, run_job, submit_query
+from query_inspector.models import Query
+from query_inspector.tests.models import Author
+
+
+SQL = 'SELECT id, name FROM tests_author ORDER BY id'
+
+
+class BackgroundJobTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        patcher = mock.patch.object(app_settings, 'QUERY_SPOOL_FOLDER', self.folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_run_job(self):
+        for i in range(25):
+            Author.objects.create(name='author %d' % i)
+        job = BackgroundJob(sql=SQL, params=None, query_id=1)
+        job.save()
+        run_job(job, batch_size=10)
+
+        job = BackgroundJob.load(job.id)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.rows, 25)
+        self.assertEqual(job.columns, ['id', 'name'])
+        self.assertIsNotNone(job.elapsed)
+
+        page = job.read_rows(offset=20, limit=10)
+        self.assertEqual(len(page), 5)
+        self.assertEqual(page[0]['name'], 'author 20')
+        self.assertEqual([row['name'] for row in job.iter_rows()][-1], 'author 24')
+        self.assertEqual([j.id for j in list_jobs(query_id=1)], [job.id])
+        self.assertEqual(list_jobs(query_id=2), [])
+
+        self.assertEqual(cleanup_jobs(), 0)
+        self.assertEqual(cleanup_jobs(max_age=-1), 1)
+        self.assertIsNone(BackgroundJob.load(job.id))
+
+    def test_private_files(self):
+        job = BackgroundJob(sql=SQL, params=None)
+        job.save()
+        run_job(job)
+        self.assertEqual(os.stat(job.status_filename).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(job.data_filename).st_mode & 0o777, 0o600)
+
+    def test_default_spool_folder(self):
+        with mock.patch.object(app_settings, 'QUERY_SPOOL_FOLDER', None), \
+                mock.patch.object(tempfile, 'tempdir', self.folder):
+            folder = get_spool_folder()
+        self.assertEqual(os.path.dirname(folder), self.folder)
+        if hasattr(os, 'getuid'):
+            self.assertEqual(os.path.basename(folder), 'query_inspector-%d' % os.getuid())
+
+    def test_orphaned_job(self):
+        # A job left running by a server process which has terminated
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        job = BackgroundJob(sql=SQL, params=None, status='running', pid=process.pid)
+        job.save()
+        running = BackgroundJob(sql=SQL, params=None, status='running')
+        running.save()
+
+        jobs = {j.id: j for j in list_jobs()}
+        if os.name == 'posix':
+            self.assertEqual(jobs[job.id].status, 'failed')
+            self.assertEqual(BackgroundJob.load(job.id).status, 'failed')
+        self.assertEqual(jobs[running.id].status, 'running')
+
+    def test_failed_job(self):
+        job = BackgroundJob(sql='SELECT * FROM missing_table', params=None)
+        job.save()
+        run_job(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('missing_table', BackgroundJob.load(job.id).error)
+
+    def test_cancel_pending_job(self):
+        job = BackgroundJob(sql=SQL, params=None)
+        job.save()
+        self.assertTrue(job.cancel())
+        self.assertEqual(run_job(job).status, 'cancelled')
+        self.assertFalse(BackgroundJob.load(job.id).cancel())
+        self.assertIsNone(BackgroundJob.load('../' + job.id[3:]))
+
+    def test_submit_query(self):
+        query = Query(slug='numbers', sql='SELECT 1 AS n UNION ALL SELECT 2')
+        job = submit_query(query, {})
+        for i in range(100):
+            job = BackgroundJob.load(job.id)
+            if job.is_finished:
+                break
+            time.sleep(0.05)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.read_rows().column('n'), [1, 2])
+
+        with self.assertRaises(ValidationError):
+            submit_query(Query(slug='delete', sql='DELETE FROM tests_author'), {})
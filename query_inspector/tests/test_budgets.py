@@ -0,0 +1,68 @@
+from unittest import mock
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from query_inspector.aggregation import aggregation_store
+from query_inspector.budgets import (
+    BudgetViolation, check_budget, query_budget_exceeded, QueryBudget, QueryBudgetExceeded,
+)
+from query_inspector.capture import QueryCollector
+from query_inspector.middleware import ACTUAL_QUERYCOUNT_SETTINGS, QueryCountMiddleware
+
+
+class CheckBudgetTestCase(TestCase):
+
+    def test_check_budget(self):
+        collector = QueryCollector(aliases=['default'])
+        for i in range(3):
+            collector.record('default', 'SELECT * FROM t WHERE id = %d' % i, 0.01)
+        self.assertEqual(check_budget(QueryBudget(3, 0.1, 3), collector), [])
+        self.assertEqual(check_budget(QueryBudget(2, 0.02, 2), collector), [
+            BudgetViolation('queries', 2, 3),
+            BudgetViolation('db_time', 0.02, 0.03),
+            BudgetViolation('duplicates', 2, 3),
+        ])
+        self.assertEqual(check_budget(QueryBudget(None, None, None), collector), [])
+
+
+@override_settings(ROOT_URLCONF='query_inspector.tests.urls')
+@override_settings(DEBUG=True)
+class QueryBudgetTestCase(TestCase):
+
+    def setUp(self):
+        self.received = []
+        query_budget_exceeded.connect(self.receiver)
+        aggregation_store.reset()
+
+    def tearDown(self):
+        query_budget_exceeded.disconnect(self.receiver)
+
+    def receiver(self, sender, request, endpoint, violations, **kwargs):
+        self.received.append((endpoint, violations))
+
+    def test_decorator(self):
+        with self.assertLogs('query_inspector', level='WARNING') as logs:
+            self.client.get('/count_twice/')
+        self.assertIn('Query budget exceeded by count_twice: queries=2 (max 1)', logs.output[0])
+        self.assertEqual(self.received, [('count_twice', [BudgetViolation('queries', 1, 2)])])
+        self.assertEqual(aggregation_store.get('count_twice').as_dict()['over_budget'], 1)
+
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'BUDGET_MODE': 'raise'}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/count_twice/')
+
+    def test_settings(self):
+        budgets = {
+            'count': {'MAX_QUERIES': 0},
+            # Settings win over the decorator
+            'query_inspector.tests.views.count_twice': {'MAX_QUERIES': 2},
+        }
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'BUDGETS': budgets, 'BUDGET_MODE': 'metric'}):
+            self.client.get('/count/')
+            self.client.get('/count_twice/')
+            self.client.get('/empty/')
+        self.assertEqual(self.received, [('count', [BudgetViolation('queries', 0, 1)])])
+
+    def test_invalid_mode(self):
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'BUDGET_MODE': 'raises'}):
+            with self.assertRaises(ImproperlyConfigured):
+                QueryCountMiddleware()
@@ -0,0 +1,79 @@
+from unittest import mock
+from django.db import connection
+from django.test import TestCase, override_settings
+from query_inspector.capture import QueryCollector
+from query_inspector.explain import clear_plan_cache, explain_prefix, get_cached_plan, get_plan
+from query_inspector.fingerprint import fingerprint
+from query_inspector.middleware import ACTUAL_QUERYCOUNT_SETTINGS
+from query_inspector.tests.models import Author, Book
+from query_inspector.trace import prettyprint_queryset
+
+
+SQL = "SELECT count(*) FROM django_migrations WHERE app = %s"
+
+
+class ExplainTestCase(TestCase):
+
+    def setUp(self):
+        clear_plan_cache()
+
+    def execute(self, n, sql=SQL):
+        with connection.cursor() as cursor:
+            for i in range(n):
+                cursor.execute(sql, ['app%d' % i])
+
+    def test_prefix(self):
+        # sqlite has no EXPLAIN ANALYZE
+        self.assertEqual(explain_prefix(connection), 'EXPLAIN QUERY PLAN')
+        self.assertEqual(explain_prefix(connection, analyze=True), 'EXPLAIN QUERY PLAN')
+
+    def test_duplicates(self):
+        with QueryCollector(explain_duplicates=3) as collector:
+            self.execute(2)
+            self.assertEqual(collector.plans, {})
+            self.execute(3)
+        key = fingerprint(SQL)
+        self.assertEqual(list(collector.plans), [key])
+        self.assertIn('django_migrations', collector.plans[key])
+        # The EXPLAIN statements are not captured
+        self.assertEqual(collector.total, 5)
+        self.assertEqual(get_cached_plan('default', key), collector.plans[key])
+
+    def test_threshold(self):
+        with QueryCollector(explain_threshold=0) as collector:
+            self.execute(1)
+            self.execute(1, "UPDATE django_migrations SET app = %s WHERE id = 0")
+        self.assertEqual(list(collector.plans), [fingerprint(SQL)])
+
+        with QueryCollector(explain_threshold=10) as collector:
+            self.execute(1)
+        self.assertEqual(collector.plans, {})
+
+    def test_cached(self):
+        with mock.patch('query_inspector.explain.explain_query', return_value='PLAN') as explain_query:
+            self.assertEqual(get_plan(connection, SQL, ['x']), 'PLAN')
+            self.assertEqual(get_plan(connection, SQL, ['y']), 'PLAN')
+        self.assertEqual(explain_query.call_count, 1)
+
+        # Statements which can't be explained are remembered as well
+        with mock.patch('query_inspector.explain.explain_query', side_effect=Exception) as explain_query:
+            self.assertIsNone(get_plan(connection, 'SELECT * FROM missing_table'))
+            self.assertIsNone(get_plan(connection, 'SELECT * FROM missing_table'))
+        self.assertEqual(explain_query.call_count, 1)
+
+    @mock.patch('query_inspector.trace.trace')
+    def test_prettyprint(self, trace):
+        with mock.patch('builtins.print'):
+            prettyprint_queryset(Book.objects.filter(author__name='x'), explain=True)
+        plan = trace.call_args[0][0]
+        self.assertIn('tests_book', plan)
+
+    @override_settings(ROOT_URLCONF='query_inspector.tests.urls', DEBUG=True)
+    def test_middleware(self):
+        for i in range(3):
+            Book.objects.create(title='book %d' % i, author=Author.objects.create(name='author %d' % i))
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'EXPLAIN_DUPLICATES': 2, 'REPORT_ASYNC': False}):
+            response = self.client.get('/books/')
+        collector = response.wsgi_request.query_collector
+        self.assertEqual(len(collector.plans), 1)
+        self.assertEqual(collector.total, 4)
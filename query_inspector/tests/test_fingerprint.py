@@ -0,0 +1,50 @@
+from django.db import connection
+from django.test import TestCase
+from query_inspector.capture import QueryCollector
+from query_inspector.fingerprint import fingerprint
+
+
+class FingerprintTestCase(TestCase):
+
+    def test_literals(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM \"t1\" WHERE id = 1 AND name = 'it''s'"),
+            'SELECT * FROM "t1" WHERE id = ? AND name = ?'
+        )
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE x = 1.5e3 - 2"),
+            fingerprint("SELECT * FROM t WHERE x = 7 - 8"),
+        )
+
+    def test_placeholders(self):
+        self.assertEqual(
+            fingerprint('SELECT "a"."col_2" FROM "a" WHERE "a"."id" = %s'),
+            'SELECT "a"."col_2" FROM "a" WHERE "a"."id" = ?'
+        )
+        self.assertEqual(fingerprint('SELECT x::text FROM t WHERE y = $1'), 'SELECT x::text FROM t WHERE y = ?')
+
+    def test_in_lists(self):
+        self.assertEqual(
+            fingerprint('SELECT * FROM a WHERE a.id IN (%s, %s,%s)'),
+            fingerprint('SELECT * FROM a WHERE a.id IN (%s)'),
+        )
+        self.assertEqual(
+            fingerprint('INSERT INTO x (a, b) VALUES (%s, %s), (%s, %s)'),
+            'INSERT INTO x (a, b) VALUES (?, ?)'
+        )
+
+    def test_whitespace(self):
+        self.assertEqual(fingerprint('  SELECT\n  *\tFROM   t '), 'SELECT * FROM t')
+
+    def test_duplicates(self):
+        # The N+1 pattern is reported as duplicates of the same query shape
+        with QueryCollector() as collector:
+            with connection.cursor() as cursor:
+                for i in range(5):
+                    cursor.execute("select count(*) from django_migrations where id > %d" % i)
+        self.assertEqual(len(collector.queries), 1)
+        self.assertEqual(collector.stats['default']['duplicates'], 5)
+        self.assertEqual(
+            collector.samples['select count(*) from django_migrations where id > ?'],
+            'select count(*) from django_migrations where id > 0'
+        )
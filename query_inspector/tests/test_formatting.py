@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+from unittest import mock
+from django.test import TestCase
+from query_inspector.formatting import SqlFormatter, get_sql_formatter
+
+
+class SqlFormatterTestCase(TestCase):
+
+    def test_format(self):
+        formatter = SqlFormatter()
+        text = formatter.format('select a, b from t where x = 1', colorize=False)
+        self.assertEqual(text, 'select a,\n       b\nfrom t\nwhere x = 1')
+        self.assertIn('\x1b[', formatter.format('select 1'))
+        self.assertEqual(formatter.format('select 1', prettify=False, colorize=False), 'select 1')
+
+    def test_cache(self):
+        formatter = SqlFormatter(cache_size=2)
+        with mock.patch.object(formatter, 'sqlparse', wraps=None) as sqlparse:
+            formatter._loaded = True
+            sqlparse.format.side_effect = lambda sql, reindent: sql.upper()
+            formatter.lexer = formatter.pygments = None
+            for i in range(3):
+                self.assertEqual(formatter.format('select 1'), 'SELECT 1')
+        self.assertEqual(sqlparse.format.call_count, 1)
+        self.assertEqual(formatter.format.cache_info().currsize, 1)
+
+    def test_shared(self):
+        self.assertIs(get_sql_formatter('monokai'), get_sql_formatter('monokai'))
+        self.assertIsNot(get_sql_formatter('monokai'), get_sql_formatter('default'))
+
+    def test_import_without_settings(self):
+        env = dict(os.environ)
+        env.pop('DJANGO_SETTINGS_MODULE', None)
+        result = subprocess.run(
+            [sys.executable, '-c', 'import query_inspector'],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            env=env, stderr=subprocess.PIPE,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
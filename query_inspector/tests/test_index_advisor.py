@@ -0,0 +1,78 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from django.core.management import call_command
+from django.test import TestCase
+from query_inspector.index_advisor import extract_candidates, IndexAdvisor, plan_scans_table
+from query_inspector.management.commands.advise_indexes import Command
+
+
+BY_TITLE = 'SELECT "tests_book"."id", "tests_book"."title" FROM "tests_book" WHERE "tests_book"."title" = ? ORDER BY "tests_book"."id" ASC'
+BY_AUTHOR = ('SELECT "tests_book"."id" FROM "tests_book" INNER JOIN "tests_author" ON ("tests_book"."author_id" = "tests_author"."id") '
+             'WHERE ("tests_author"."name" = ? AND "tests_book"."title" LIKE ?) ORDER BY "tests_book"."title" DESC')
+BY_PK = 'SELECT "tests_author"."id" FROM "tests_author" WHERE "tests_author"."id" = ? LIMIT ?'
+
+
+class IndexAdvisorTestCase(TestCase):
+
+    def test_extract_candidates(self):
+        self.assertEqual(extract_candidates(BY_TITLE), [('tests_book', ('title', 'id'))])
+        self.assertEqual(extract_candidates(BY_AUTHOR), [
+            ('tests_author', ('name', )),
+            ('tests_book', ('title', )),
+            ('tests_book', ('author_id', )),
+            ('tests_author', ('id', )),
+        ])
+        self.assertEqual(
+            extract_candidates('SELECT * FROM "t" U0 WHERE U0."a" = ? AND U0."b" > ? AND U0."c" = ? ORDER BY U0."d"'),
+            [('t', ('a', 'c', 'b'))],
+        )
+        self.assertEqual(extract_candidates('SELECT 1'), [])
+
+    def test_plan_scans_table(self):
+        self.assertTrue(plan_scans_table('Seq Scan on tests_book  (cost=0.00..1.05 rows=1 width=4)', 'tests_book'))
+        self.assertFalse(plan_scans_table('Index Scan using tests_book_pkey on tests_book', 'tests_book'))
+        self.assertTrue(plan_scans_table('2 0 0 SCAN tests_book', 'tests_book'))
+        self.assertFalse(plan_scans_table('2 0 0 SEARCH tests_book USING INTEGER PRIMARY KEY (rowid=?)', 'tests_book'))
+        self.assertIsNone(plan_scans_table('2 0 0 SCAN tests_author', 'tests_book'))
+        self.assertIsNone(plan_scans_table(None, 'tests_book'))
+
+    def test_suggestions(self):
+        advisor = IndexAdvisor(
+            {BY_TITLE: [100, 2.0, 0.1], BY_AUTHOR: [10, 1.0, 0.2], BY_PK: [1000, 5.0, 0.01]},
+            {BY_TITLE: '2 0 0 SCAN tests_book'},
+        )
+        rows = advisor.suggestions()
+        # Primary and foreign keys are already indexed,
+        # and the index on (title, id) serves the queries filtering by title as well
+        self.assertEqual([(row['model'], row['fields']) for row in rows], [
+            ('tests.Book', 'title, id'),
+            ('tests.Author', 'name'),
+        ])
+        self.assertEqual(rows[0]['saved_time'], 2.0 * 0.9 + 1.0 * 0.5)
+        self.assertEqual(rows[0]['queries'], 2)
+        self.assertEqual(rows[0]['executions'], 110)
+        self.assertTrue(rows[0]['seq_scan'])
+        self.assertEqual(advisor.suggestions(min_time=1.0), rows[:1])
+
+        snippets = advisor.meta_indexes()
+        self.assertIn('# tests.Book: ~2.3000s saved\nclass Meta:\n    indexes = [\n', snippets)
+        self.assertIn("        models.Index(fields=['title', 'id']),  # 2.3000s, 2 queries, 110 executions, seq scan\n", snippets)
+
+    def test_command(self):
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'queries.jsonl')
+            with open(filename, 'w') as f:
+                f.write(json.dumps({'endpoint': 'books', 'queries': [
+                    {'alias': 'default', 'fingerprint': BY_TITLE, 'count': 5, 'time': 0.5, 'max_time': 0.2,
+                     'plan': '2 0 0 SCAN tests_book'},
+                ]}) + '\n')
+            stdout = io.StringIO()
+            call_command(Command(), filename, stdout=stdout, stderr=io.StringIO())
+            self.assertIn('tests_book', stdout.getvalue())
+            self.assertIn("models.Index(fields=['title', 'id'])", stdout.getvalue())
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,76 @@
+from unittest import mock
+from django.test import TestCase, override_settings
+from query_inspector.middleware import ACTUAL_QUERYCOUNT_SETTINGS
+from query_inspector.nplusone import NPlusOneDetector, NPlusOneDetected, suggest_fix
+from query_inspector.tests.models import Author, Book, Tag
+
+
+class NPlusOneTestCase(TestCase):
+
+    def setUp(self):
+        tag = Tag.objects.create(name='tag')
+        for i in range(5):
+            author = Author.objects.create(name='author %d' % i)
+            book = Book.objects.create(title='book %d' % i, author=author)
+            book.tags.add(tag)
+
+    def test_select_related(self):
+        with NPlusOneDetector(threshold=3) as detector:
+            names = []
+            for book in Book.objects.all():
+                names.append(book.author.name)
+        self.assertEqual(len(names), 5)
+        findings = detector.findings
+        self.assertEqual(len(findings), 1)
+        finding = findings[0]
+        self.assertEqual(finding.count, 5)
+        self.assertEqual(finding.model, 'tests.Author')
+        self.assertEqual(finding.filename, __file__)
+        self.assertEqual(finding.function, 'test_select_related')
+        self.assertEqual(finding.suggestion, "Book.objects.select_related('author')")
+
+        with NPlusOneDetector(threshold=3) as detector:
+            names = [book.author.name for book in Book.objects.select_related('author')]
+        self.assertEqual(len(names), 5)
+        self.assertEqual(detector.findings, [])
+
+    def test_prefetch_related(self):
+        with NPlusOneDetector(threshold=3) as detector:
+            titles = [[book.title for book in author.book_set.all()] for author in Author.objects.all()]
+            tags = [[tag.name for tag in book.tags.all()] for book in Book.objects.all()]
+        self.assertEqual(titles[0], ['book 0'])
+        self.assertEqual(tags[0], ['tag'])
+        suggestions = sorted(f.suggestion for f in detector.findings)
+        self.assertEqual(suggestions, [
+            "Author.objects.prefetch_related('book_set')",
+            "Book.objects.prefetch_related('tags')",
+        ])
+
+    def test_raise_exception(self):
+        with self.assertRaises(NPlusOneDetected):
+            with NPlusOneDetector(threshold=3, raise_exception=True):
+                for book in Book.objects.all():
+                    book.author
+
+    def test_suggest_fix(self):
+        self.assertEqual(suggest_fix('SELECT 1'), (None, ''))
+
+        # select_related() is suggested on the model whose objects are looped over
+        author_by_pk = 'SELECT "tests_author"."id" FROM "tests_author" WHERE "tests_author"."id" = ? LIMIT ?'
+        self.assertEqual(
+            suggest_fix(author_by_pk, 'SELECT "tests_book"."id" FROM "tests_book"'),
+            ('tests.Author', "Book.objects.select_related('author')"),
+        )
+        self.assertEqual(suggest_fix(author_by_pk, 'SELECT "tests_tag"."id" FROM "tests_tag"'), ('tests.Author', ''))
+        self.assertEqual(suggest_fix(author_by_pk), ('tests.Author', ''))
+
+    @override_settings(ROOT_URLCONF='query_inspector.tests.urls', DEBUG=True)
+    def test_middleware(self):
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'NPLUSONE_THRESHOLD': 3}):
+            response = self.client.get('/books/')
+        findings = response.wsgi_request.query_collector.nplusone_findings
+        self.assertEqual([f.count for f in findings], [5])
+
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'NPLUSONE_THRESHOLD': 3, 'NPLUSONE_RAISE': True}):
+            with self.assertRaises(NPlusOneDetected):
+                self.client.get('/books/')
@@ -0,0 +1,94 @@
+from unittest import mock
+from django.db import connection
+from django.test import TestCase, override_settings
+from query_inspector import query_debugger
+from query_inspector.aggregation import aggregation_store
+from query_inspector.middleware import ACTUAL_QUERYCOUNT_SETTINGS
+from query_inspector.profiler import QueryProfiler, build_profile, format_collapsed, render_profile_as_html
+
+
+def run_queries(n):
+    with connection.cursor() as cursor:
+        for i in range(n):
+            cursor.execute("SELECT count(*) FROM django_migrations")
+
+
+def load_page():
+    run_queries(3)
+    run_queries(1)
+
+
+class QueryProfilerTestCase(TestCase):
+
+    def test_profile(self):
+        with QueryProfiler(name='request') as profiler:
+            load_page()
+            run_queries(2)
+
+        root = profiler.profile
+        self.assertEqual(root.name, 'request')
+        self.assertEqual(root.count, 6)
+        self.assertAlmostEqual(root.db_time, profiler.db_time)
+
+        # (test runner frames) -> test_profile:<line> -> load_page or run_queries;
+        # frames are labelled by line, so each call site is a distinct node
+        test_nodes = [node for depth, node in root.walk() if node.name.startswith(__name__ + '.test_profile:')]
+        self.assertEqual([node.count for node in test_nodes], [4, 2])
+        self.assertEqual(test_nodes[0].exclusive_count, 0)
+        load_page_nodes = test_nodes[0].sorted_children()
+        self.assertTrue(all(node.name.startswith(__name__ + '.load_page:') for node in load_page_nodes))
+        self.assertEqual(sorted(node.count for node in load_page_nodes), [1, 3])
+        self.assertEqual([depth for depth, node in root.walk()][:2], [0, 1])
+
+    def test_collapsed(self):
+        with QueryProfiler() as profiler:
+            load_page()
+        lines = profiler.collapsed(weight='count').splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(sorted(int(line.rsplit(' ', 1)[1]) for line in lines), [1, 3])
+        frames = lines[0].rsplit(' ', 1)[0].split(';')
+        self.assertEqual(frames[0], 'all')
+        self.assertTrue(frames[-3].startswith(__name__ + '.test_collapsed:'))
+        self.assertTrue(frames[-2].startswith(__name__ + '.load_page:'))
+        self.assertTrue(frames[-1].startswith(__name__ + '.run_queries:'))
+
+        # By DB time, in microseconds
+        total = sum(int(line.rsplit(' ', 1)[1]) for line in profiler.collapsed().splitlines())
+        self.assertAlmostEqual(total, profiler.db_time * 1000000, delta=2)
+
+    def test_html(self):
+        stacks = {('app.views.list:3', 'app.models.<listcomp>:9'): 2}
+        timings = {('app.views.list:3', 'app.models.<listcomp>:9'): 0.5}
+        html = render_profile_as_html(build_profile(stacks, timings))
+        self.assertIn('<ul class="query-profile">', html)
+        self.assertIn('app.models.&lt;listcomp&gt;:9', html)
+        self.assertEqual(html.count('<details open>'), 2)
+        self.assertEqual(format_collapsed(stacks, timings), 'all;app.views.list:3;app.models.<listcomp>:9 500000\n')
+
+    @mock.patch('query_inspector.query_debugger.trace')
+    def test_query_debugger(self, trace):
+
+        @query_debugger(profile=True)
+        def view():
+            load_page()
+
+        view()
+        lines = [call[0][0] for call in trace.call_args_list]
+        self.assertEqual(len(lines), 2)
+        self.assertIn('load_page', lines[1])
+        self.assertRegex(lines[1].splitlines()[0], r'^[0-9.]+s 100.0%     4 queries  ')
+
+    @override_settings(ROOT_URLCONF='query_inspector.tests.urls', DEBUG=True)
+    def test_middleware(self):
+        aggregation_store.reset()
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'PROFILE': True}):
+            response = self.client.get('/count/')
+        stacks = response.wsgi_request.query_collector.stacks
+        self.assertEqual(sum(stacks.values()), 1)
+        stack, = stacks
+        self.assertTrue(stack[-1].startswith('query_inspector.tests.views.count_migrations:'))
+        self.assertTrue(aggregation_store.get('count').has_profile)
+        stacks, stack_timings = aggregation_store.profile('count')
+        self.assertEqual(stacks, aggregation_store.get('count').stacks)
+        self.assertIsNot(stacks, aggregation_store.get('count').stacks)
+        self.assertIsNone(aggregation_store.profile('missing'))
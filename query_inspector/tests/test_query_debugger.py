@@ -0,0 +1,80 @@
+import asyncio
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.db import connection
+from django.test import TestCase, override_settings
+from query_inspector import query_debugger
+from query_inspector.query_debugger import get_current_scope
+
+
+@query_debugger
+def count_migrations(n):
+    with connection.cursor() as cursor:
+        for i in range(n):
+            cursor.execute("SELECT count(*) FROM django_migrations")
+        cursor.execute("UPDATE django_migrations SET app = app WHERE id = 0")
+
+
+class QueryDebuggerTestCase(TestCase):
+
+    @mock.patch('query_inspector.query_debugger.trace')
+    def test_query_debugger(self, trace):
+        count_migrations(3)
+        message = trace.call_args[0][0]
+        self.assertRegex(message, r'^ count_migrations\(\): 4 queries \([0-9.]+s\) \[default: 3 reads, 1 writes\] $')
+
+    @override_settings(DEBUG=True)
+    @mock.patch('query_inspector.query_debugger.trace')
+    def test_no_reset(self, trace):
+        # connection.queries is left untouched for other observers
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        before = len(connection.queries)
+        count_migrations(1)
+        self.assertEqual(len(connection.queries), before + 2)
+
+    @mock.patch('query_inspector.query_debugger.trace')
+    def test_nested(self, trace):
+
+        @query_debugger
+        def service():
+            count_migrations(2)
+            self.inner = get_current_scope()
+            with query_debugger('block') as block:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            self.block = block
+
+        with query_debugger('outer') as outer:
+            service()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        self.assertEqual(outer.num_queries, 5)
+        self.assertEqual(outer.exclusive_num_queries, 1)
+        service_scope = outer.children[0]
+        self.assertEqual(service_scope.name, 'QueryDebuggerTestCase.test_nested.<locals>.service()')
+        self.assertIs(service_scope, self.inner)
+        self.assertEqual(service_scope.num_queries, 4)
+        self.assertEqual(service_scope.exclusive_num_queries, 0)
+        self.assertEqual([(depth, scope.name) for depth, scope in outer.walk()][2:], [(2, 'count_migrations()'), (2, 'block')])
+        self.assertEqual(self.block.num_queries, 1)
+        self.assertGreaterEqual(outer.elapsed, outer.exclusive_elapsed)
+
+        # The whole tree is traced once, on exit from the outermost scope
+        lines = [call[0][0] for call in trace.call_args_list]
+        self.assertEqual(len(lines), 4)
+        self.assertRegex(lines[0], r'^ outer: 5 queries \([0-9.]+s\) \[default: 4 reads, 1 writes\], exclusive: 1 queries')
+        self.assertTrue(lines[3].startswith('     block: 1 queries'))
+        self.assertIsNone(get_current_scope())
+
+    @mock.patch('query_inspector.query_debugger.trace')
+    def test_async(self, trace):
+
+        @query_debugger
+        async def view(n):
+            await sync_to_async(count_migrations.__wrapped__)(n)
+            return n
+
+        self.assertEqual(asyncio.run(view(2)), 2)
+        self.assertRegex(trace.call_args[0][0], r'^ QueryDebuggerTestCase.test_async.<locals>.view\(\): 3 queries ')
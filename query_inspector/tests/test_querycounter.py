@@ -1,5 +1,13 @@
-from django.test import TestCase, modify_settings, override_settings
-from query_inspector.middleware import QueryCountMiddleware
+import asyncio
+import re
+import threading
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, AsyncRequestFactory, RequestFactory, modify_settings, override_settings
+from query_inspector.capture import QueryCollector, dispatch_query, get_current_collector, slow_query_log
+from query_inspector.middleware import QueryCountMiddleware, ACTUAL_QUERYCOUNT_SETTINGS, _server_timing_quote
 
 
 @override_settings(ROOT_URLCONF='query_inspector.tests.urls')
@@ -31,3 +39,219 @@ class QueryCountTestCase(TestCase):
         resp = self.client.get("/count/")
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(int(resp['X-DjangoQueryCount-Count']), 1)
+
+    def test_server_timing(self):
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'SERVER_TIMING': True}):
+            resp = self.client.get("/count/")
+        metrics = re.split(r', (?=[\w-]+;)', resp['Server-Timing'])
+        self.assertEqual(len(metrics), 3)
+        self.assertRegex(metrics[0], r'^db;dur=[0-9.]+;desc="1 queries"$')
+        self.assertRegex(metrics[1], r'^db-default;dur=[0-9.]+;desc="0 reads, 1 writes"$')
+        self.assertRegex(metrics[2], r'^db-slowest;dur=[0-9.]+;desc="select count\(\*\) from django_migrations"$')
+
+        # Disabled by default
+        resp = self.client.get("/count/")
+        self.assertFalse(resp.has_header('Server-Timing'))
+
+        # The query shape is not disclosed without DEBUG
+        with QueryCollector() as collector:
+            connection.cursor().execute('select count(*) from django_migrations')
+        with override_settings(DEBUG=False):
+            header = self.querycount._server_timing(collector)
+        self.assertNotIn('django_migrations', header)
+        self.assertRegex(header, r'db-slowest;dur=[0-9.]+;desc="slowest query"$')
+
+    def test_server_timing_quote(self):
+        self.assertEqual(_server_timing_quote('a "b"\n\\c'), '"a \\"b\\" \\\\c"')
+        self.assertEqual(len(_server_timing_quote('x' * 200)), 102)
+
+    @override_settings(DEBUG=False)
+    def test_require_debug(self):
+        # Without DEBUG, requests are not inspected by default ...
+        resp = self.client.get("/count/")
+        self.assertFalse(resp.has_header('X-DjangoQueryCount-Count'))
+
+        # ... unless explicitly required
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'REQUIRE_DEBUG': False}):
+            resp = self.client.get("/count/")
+        self.assertEqual(int(resp['X-DjangoQueryCount-Count']), 1)
+
+    def test_concurrent_requests(self):
+        # A single middleware instance serving interleaved requests
+        # from multiple threads must keep their counters apart
+        barrier = threading.Barrier(2)
+
+        def view(request):
+            n = int(request.GET['n'])
+            with connection.cursor() as cursor:
+                for i in range(n):
+                    cursor.execute("select count(*) from django_migrations")
+                    if i == 0:
+                        barrier.wait(timeout=5)
+            self.assertIsNotNone(get_current_collector())
+            return HttpResponse("")
+
+        middleware = QueryCountMiddleware(view)
+        results = {}
+
+        def run(n):
+            try:
+                response = middleware(RequestFactory().get('/count/', {'n': n}))
+                results[n] = int(response['X-DjangoQueryCount-Count'])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(n, )) for n in (2, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {2: 2, 5: 5})
+        self.assertIsNone(get_current_collector())
+
+    def test_async(self):
+        # Queries run from sync_to_async() in an async view are
+        # accounted to the request being served
+
+        def count_migrations():
+            with connection.cursor() as cursor:
+                for i in range(3):
+                    cursor.execute("select count(*) from django_migrations")
+
+        async def view(request):
+            await sync_to_async(count_migrations)()
+            return HttpResponse("")
+
+        middleware = QueryCountMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(AsyncRequestFactory().get('/count/'))
+        self.assertEqual(int(response['X-DjangoQueryCount-Count']), 3)
+
+
+class QueryCollectorTestCase(TestCase):
+
+    def test_collect(self):
+        with QueryCollector() as collector:
+            with connection.cursor() as cursor:
+                for i in range(3):
+                    cursor.execute("SELECT count(*) FROM django_migrations")
+                cursor.execute("UPDATE django_migrations SET app=app WHERE id < 0")
+
+        # Queries executed after stop() are not recorded
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM django_migrations")
+
+        self.assertEqual(collector.totals(), (3, 1, 4))
+        self.assertEqual(collector.stats['default']['duplicates'], 3)
+        self.assertEqual(collector.queries.most_common(1)[0][1], 3)
+
+    def test_ignore_sql(self):
+        with QueryCollector(ignore_sql=lambda sql: 'django_migrations' in sql) as collector:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM django_migrations")
+        self.assertEqual(collector.total, 0)
+
+    def test_timings(self):
+        with QueryCollector(slow_query_threshold=0) as collector:
+            with connection.cursor() as cursor:
+                cursor.execute("select count(*) from django_migrations where id > %s", [0])
+                cursor.execute("UPDATE django_migrations SET app=app WHERE id < 0")
+
+        self.assertEqual([q.alias for q in collector.log], ['default', 'default'])
+        self.assertEqual(collector.log[1].rowcount, 0)
+        self.assertAlmostEqual(collector.db_time, sum(q.duration for q in collector.log))
+        self.assertAlmostEqual(collector.stats['default']['time'], collector.db_time)
+        self.assertEqual(collector.timings['select count(*) from django_migrations where id > ?'], collector.log[0].duration)
+
+        # All queries are "slow" with a zero threshold
+        self.assertEqual(len(collector.slow_queries), 2)
+        slow_query = collector.slow_queries[0]
+        self.assertEqual(slow_query.params, [0])
+        self.assertIn('test_timings', slow_query.stack)
+        self.assertNotIn('capture.py', slow_query.stack)
+        self.assertIs(slow_query_log[-1], collector.slow_queries[-1])
+
+        with QueryCollector(slow_query_threshold=60) as collector:
+            with connection.cursor() as cursor:
+                cursor.execute("select count(*) from django_migrations")
+        self.assertEqual(collector.slow_queries, [])
+
+    def test_connection_opened_inside_wrapper(self):
+        # A new thread gets a new connection, which is opened inside
+        # the user's execute_wrapper() block
+        results = {}
+
+        def wrapper(execute, sql, params, many, context):
+            return execute(sql, params, many, context)
+
+        def run():
+            try:
+                with connection.execute_wrapper(wrapper):
+                    with connection.cursor() as cursor:
+                        cursor.execute("select 1")
+                results['wrappers'] = list(connection.execute_wrappers)
+                with QueryCollector() as collector:
+                    with connection.cursor() as cursor:
+                        cursor.execute("select 1")
+                results['total'] = collector.total
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, {'wrappers': [dispatch_query], 'total': 1})
+
+
+@override_settings(DEBUG=True)
+class IgnorePatternsTestCase(TestCase):
+
+    def view(self, request):
+        with connection.cursor() as cursor:
+            cursor.execute("select count(*) from django_migrations")
+            cursor.execute("select count(*) from django_content_type")
+        return HttpResponse("")
+
+    def middleware(self, **kwargs):
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, kwargs):
+            return QueryCountMiddleware(self.view)
+
+    def test_ignore_request(self):
+        middleware = self.middleware(IGNORE_REQUEST_PATTERNS=[r'^/admin/', r'.*/static/'])
+        self.assertTrue(middleware._ignore_request('/admin/login/'))
+        self.assertTrue(middleware._ignore_request('/app/static/x.css'))
+        self.assertFalse(middleware._ignore_request('/count/admin/'))
+        response = middleware(RequestFactory().get('/admin/'))
+        self.assertFalse(response.has_header('X-DjangoQueryCount-Count'))
+        response = middleware(RequestFactory().get('/count/'))
+        self.assertEqual(int(response['X-DjangoQueryCount-Count']), 2)
+
+    def test_ignore_all_requests(self):
+        middleware = self.middleware()
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'IGNORE_ALL_REQUESTS': True}):
+            response = middleware(RequestFactory().get('/count/'))
+        self.assertFalse(response.has_header('X-DjangoQueryCount-Count'))
+
+    def test_ignore_sql(self):
+        middleware = self.middleware(IGNORE_SQL_PATTERNS=[r'django_content_type', r'^never'])
+        response = middleware(RequestFactory().get('/count/'))
+        self.assertEqual(int(response['X-DjangoQueryCount-Count']), 1)
+
+        # Without patterns, no filtering is applied at all
+        middleware = self.middleware()
+        collector = middleware._new_collector(RequestFactory().get('/'))
+        self.assertIsNone(collector.ignore_sql)
+        self.assertIsNone(collector.ignore_executed_sql)
+
+    def test_ignore_sql_params(self):
+        # Patterns can refer to literal values passed as params
+        def view(request):
+            with connection.cursor() as cursor:
+                cursor.execute("select count(*) from django_migrations where id = %s", [1])
+                cursor.execute("select count(*) from django_migrations where id = %s", [2])
+            return HttpResponse("")
+
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'IGNORE_SQL_PATTERNS': [r'django_migrations where id = 1\b']}):
+            middleware = QueryCountMiddleware(view)
+        response = middleware(RequestFactory().get('/count/'))
+        self.assertEqual(int(response['X-DjangoQueryCount-Count']), 1)
@@ -0,0 +1,163 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+from django.test import TestCase, override_settings
+from query_inspector.capture import QueryCollector
+from query_inspector.middleware import ACTUAL_QUERYCOUNT_SETTINGS
+from query_inspector.reporting import build_sinks, JSONLinesSink, Report, ReportWriter, StreamSink
+
+
+class ListSink(object):
+
+    def __init__(self, block=None):
+        self.reports = []
+        self.block = block
+
+    def write(self, report):
+        if self.block is not None:
+            self.block.wait()
+        self.reports.append(report)
+
+    def flush(self):
+        pass
+
+
+class ReportWriterTestCase(TestCase):
+
+    def setUp(self):
+        self.collector = QueryCollector()
+        self.collector.request_path = '/test/'
+
+    def test_submit(self):
+        sink = ListSink()
+        writer = ReportWriter([sink])
+        writer.submit(Report(self.collector))
+        writer.flush()
+        self.assertEqual(len(sink.reports), 1)
+        self.assertEqual(writer.dropped, 0)
+
+    def test_overflow(self):
+        # While the sink is stuck, reports in excess of the queue size are dropped
+        block = threading.Event()
+        sink = ListSink(block)
+        writer = ReportWriter([sink], queue_size=2)
+        for i in range(5):
+            writer.submit(Report(self.collector))
+        self.assertGreaterEqual(writer.dropped, 2)
+        block.set()
+        writer.flush()
+        self.assertEqual(len(sink.reports) + writer.dropped, 5)
+
+    def test_sink_errors(self):
+        sink = ListSink()
+        sink.write = mock.Mock(side_effect=IOError)
+        writer = ReportWriter([sink], asynchronous=False)
+        writer.submit(Report(self.collector))
+        self.assertEqual(writer.errors, 1)
+
+    def test_synchronous_threads(self):
+        # Without a background thread, request threads take turns writing to the sinks
+        busy = threading.Lock()
+        overlaps = []
+
+        class SlowSink(ListSink):
+            def write(self, report):
+                if not busy.acquire(blocking=False):
+                    overlaps.append(report)
+                    return
+                time.sleep(0.001)
+                super().write(report)
+                busy.release()
+
+        sink = SlowSink()
+        writer = ReportWriter([sink], asynchronous=False)
+
+        def run():
+            for i in range(10):
+                writer.submit(Report(self.collector))
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [])
+        self.assertEqual(len(sink.reports), 40)
+
+    def test_lazy_text(self):
+        render = mock.Mock(return_value='report\n')
+        report = Report(self.collector, render)
+        stream = io.StringIO()
+        ReportWriter([StreamSink(stream)], asynchronous=False).submit(report)
+        ReportWriter([ListSink()], asynchronous=False).submit(Report(self.collector, render))
+        self.assertEqual(stream.getvalue(), 'report\n')
+        self.assertEqual(render.call_count, 1)
+
+    def test_build_sinks(self):
+        sink = ListSink()
+        sinks = build_sinks([{'class': 'query_inspector.reporting.StreamSink'}, sink])
+        self.assertIsInstance(sinks[0], StreamSink)
+        self.assertIs(sinks[1], sink)
+
+
+@override_settings(ROOT_URLCONF='query_inspector.tests.urls')
+@override_settings(DEBUG=True)
+class JSONLinesSinkTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'queries.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_middleware(self):
+        sinks = [{'class': JSONLinesSink, 'filename': self.filename}]
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'REPORT_SINKS': sinks, 'REPORT_ASYNC': False}):
+            self.client.get('/count/')
+            self.client.get('/count/')
+        with open(self.filename) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['path'], '/count/')
+        self.assertEqual(records[0]['total'], 1)
+        self.assertEqual(records[0]['databases']['default']['writes'], 1)
+        self.assertEqual(len(records[0]['queries']), 1)
+        query = records[0]['queries'][0]
+        self.assertEqual(query['alias'], 'default')
+        self.assertEqual(query['fingerprint'], 'select count(*) from django_migrations')
+        self.assertEqual(query['count'], 1)
+        self.assertGreaterEqual(query['time'], query['max_time'])
+
+    def _write(self, sink, n):
+        collector = QueryCollector()
+        for i in range(n):
+            sink.write(Report(collector))
+        sink.close()
+
+    def _line_size(self):
+        return len(Report(QueryCollector()).json) + 1
+
+    def test_rotation(self):
+        size = self._line_size()
+        sink = JSONLinesSink(self.filename, max_bytes=size * 2, backup_count=2)
+        self._write(sink, 7)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['queries.jsonl', 'queries.jsonl.1', 'queries.jsonl.2'])
+        for name in os.listdir(self.folder):
+            with open(os.path.join(self.folder, name)) as f:
+                self.assertLessEqual(len(f.read()), size * 2)
+
+    def test_rotation_compressed(self):
+        size = self._line_size()
+        sink = JSONLinesSink(self.filename, max_bytes=size * 2, backup_count=2, compress=True)
+        self._write(sink, 5)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['queries.jsonl', 'queries.jsonl.1.gz', 'queries.jsonl.2.gz'])
+        with gzip.open(self.filename + '.1.gz', 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
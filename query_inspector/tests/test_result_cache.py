@@ -0,0 +1,79 @@
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase
+from query_inspector import app_settings
+from query_inspector.capture import QueryCollector
+from query_inspector.models import Query
+from query_inspector.result_cache import (
+    execute_stored_query,
+    get_cached_result,
+    invalidate_query_results,
+    normalize_params,
+    result_cache_key,
+)
+from query_inspector.tests.models import Author
+
+
+SQL = 'SELECT id, name FROM tests_author WHERE name <> %s ORDER BY id'
+
+
+class ResultCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for i in range(5):
+            Author.objects.create(name='author %d' % i)
+        self.query = Query.objects.create(slug='authors', sql=SQL, cache_ttl=60)
+
+    def test_cache_key(self):
+        self.assertEqual(normalize_params({'b': 1, 'a': [1, 2]}), normalize_params({'a': [1, 2], 'b': 1}))
+        key = result_cache_key('authors', SQL, ['x'])
+        self.assertEqual(key, result_cache_key('authors', SQL, ['x']))
+        self.assertNotEqual(key, result_cache_key('authors', SQL, ['y']))
+        self.assertNotEqual(key, result_cache_key('authors', SQL + ' LIMIT 1', ['x']))
+        self.assertNotEqual(key, result_cache_key('others', SQL, ['x']))
+
+    def test_execute_stored_query(self):
+        with QueryCollector() as collector:
+            recordset, cached_at = execute_stored_query(self.query, ['author 0'])
+            self.assertIsNone(cached_at)
+            self.assertEqual(len(recordset), 4)
+            self.assertEqual(collector.total, 1)
+
+            recordset, cached_at = execute_stored_query(self.query, ['author 0'])
+            self.assertIsNotNone(cached_at)
+            self.assertEqual(recordset.columns, ['id', 'name'])
+            self.assertEqual(recordset[0]['name'], 'author 1')
+            self.assertEqual(collector.total, 1)
+
+            # Other parameters, or a different limit, give a different result
+            self.assertEqual(len(execute_stored_query(self.query, ['author 1'])[0]), 4)
+            self.assertEqual(len(execute_stored_query(self.query, ['author 1'], sql_limit=2)[0]), 2)
+            self.assertEqual(collector.total, 3)
+
+        invalidate_query_results(self.query)
+        self.assertEqual(get_cached_result(self.query, SQL, ['author 0']), (None, None))
+        self.assertIsNone(execute_stored_query(self.query, ['author 0'])[1])
+
+    def test_empty_result(self):
+        query = Query(slug='none', sql='SELECT id, name FROM tests_author WHERE id < 0', cache_ttl=60)
+        self.assertIsNone(execute_stored_query(query, [])[1])
+        recordset, cached_at = execute_stored_query(query, [])
+        self.assertIsNotNone(cached_at)
+        self.assertEqual(len(recordset), 0)
+        self.assertEqual(recordset.columns, ['id', 'name'])
+
+    def test_disabled(self):
+        self.query.cache_ttl = 0
+        with QueryCollector() as collector:
+            execute_stored_query(self.query, [''])
+            recordset, cached_at = execute_stored_query(self.query, [''])
+        self.assertIsNone(cached_at)
+        self.assertEqual(len(recordset), 5)
+        self.assertEqual(collector.total, 2)
+
+    def test_max_rows(self):
+        with mock.patch.object(app_settings, 'QUERY_CACHE_MAX_ROWS', 3):
+            recordset, cached_at = execute_stored_query(self.query, [''])
+            self.assertEqual(len(recordset), 4)
+            self.assertIsNone(execute_stored_query(self.query, [''])[1])
@@ -0,0 +1,55 @@
+from unittest import mock
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from query_inspector.middleware import QueryCountMiddleware, ACTUAL_QUERYCOUNT_SETTINGS
+from query_inspector.sampling import RequestSampler
+
+
+class RequestSamplerTestCase(TestCase):
+
+    def test_rate(self):
+        self.assertTrue(RequestSampler(rate=1.0).should_sample('/'))
+        self.assertFalse(RequestSampler(rate=0.0).should_sample('/'))
+        sampler = RequestSampler(rate=0.1, random=iter([0.05, 0.5]).__next__)
+        self.assertTrue(sampler.should_sample('/'))
+        self.assertFalse(sampler.should_sample('/'))
+
+    def test_slow_percentile(self):
+        sampler = RequestSampler(rate=0.0, slow_percentile=90, window=100)
+        for i in range(100):
+            sampler.observe('/fast/', 0.01)
+            if i % 10 == 0:
+                sampler.observe('/slow/', 1.0)
+        self.assertTrue(sampler.should_sample('/slow/'))
+        self.assertFalse(sampler.should_sample('/fast/'))
+        self.assertFalse(sampler.should_sample('/unknown/'))
+
+    def test_max_paths(self):
+        sampler = RequestSampler(rate=0.0, slow_percentile=90, max_paths=10)
+        for i in range(20):
+            sampler.observe('/%d/' % i, 0.01)
+        self.assertEqual(len(sampler._averages), 10)
+
+
+@override_settings(DEBUG=True)
+class SampledMiddlewareTestCase(TestCase):
+
+    def view(self, request):
+        with connection.cursor() as cursor:
+            cursor.execute("select count(*) from django_migrations")
+        return HttpResponse("")
+
+    def test_unsampled(self):
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'SAMPLE_RATE': 0.0}):
+            middleware = QueryCountMiddleware(self.view)
+        response = middleware(RequestFactory().get('/count/'))
+        self.assertFalse(response.has_header('X-DjangoQueryCount-Count'))
+
+    def test_sampled_slow(self):
+        with mock.patch.dict(ACTUAL_QUERYCOUNT_SETTINGS, {'SAMPLE_RATE': 0.0, 'SAMPLE_SLOW_PERCENTILE': 50}):
+            middleware = QueryCountMiddleware(self.view)
+        middleware.sampler.observe('/other/', 0.0)
+        middleware.sampler.observe('/count/', 10.0)
+        response = middleware(RequestFactory().get('/count/'))
+        self.assertEqual(int(response['X-DjangoQueryCount-Count']), 1)
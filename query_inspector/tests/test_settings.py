@@ -10,6 +10,7 @@ SECRET_KEY = 'fake-key'
 INSTALLED_APPS = [
     'django.contrib.auth',
     'django.contrib.contenttypes',
+    'query_inspector',
     "query_inspector.tests",
 ]
 
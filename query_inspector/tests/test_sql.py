@@ -0,0 +1,203 @@
+import json
+import threading
+import time
+import uuid
+from unittest import mock
+from django.db import DatabaseError
+from django.forms import ValidationError
+from django.test import RequestFactory, TestCase
+from query_inspector import app_settings
+from query_inspector.capture import QueryCollector
+from query_inspector.recordset import Recordset, RowView
+from query_inspector.models import Query
+from query_inspector.sql import cancel_query, perform_query, QueryCancelled, QueryStream, QueryTimeout
+from query_inspector.templatetags.query_inspector_tags import render_queryset_as_data, render_queryset_as_text
+from query_inspector.tests.models import Author
+from query_inspector.views import export_any_dataset, stream_any_dataset
+
+
+SQL = 'SELECT id, name FROM tests_author ORDER BY id'
+
+
+class PerformQueryTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(25):
+            Author.objects.create(name='author %d' % i)
+
+    def test_perform_query(self):
+        rows = perform_query(SQL, None)
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0]['name'], 'author 0')
+
+    def test_stream(self):
+        with QueryCollector() as collector:
+            rows = perform_query(SQL, None, stream=True, batch_size=10)
+            self.assertIsInstance(rows, QueryStream)
+            # The statement is executed when the iteration begins
+            self.assertEqual(collector.total, 0)
+            self.assertEqual(next(rows)['name'], 'author 0')
+            self.assertEqual(len(list(rows)), 24)
+        self.assertEqual(collector.total, 1)
+
+        self.assertEqual(list(perform_query(SQL + ' LIMIT 0', None, stream=True)), [])
+
+    def test_stream_start(self):
+        # start() executes the statement, so errors are raised at once
+        rows = perform_query('SELECT * FROM missing_table', None, stream=True)
+        with self.assertRaises(DatabaseError):
+            rows.start()
+
+        rows = perform_query(SQL + ' LIMIT 0', None, stream=True).start()
+        self.assertEqual(rows.columns, ['id', 'name'])
+        self.assertEqual(list(rows), [])
+
+        rows = perform_query(SQL, None, stream=True, batch_size=10).start()
+        self.assertEqual(len(list(rows)), 25)
+
+    def test_validate(self):
+        # Validation happens immediately, even when streaming
+        with self.assertRaises(ValidationError):
+            perform_query('DELETE FROM tests_author', None, stream=True)
+
+    def test_stream_export(self):
+        rows = perform_query(SQL, None, stream=True, batch_size=7)
+        response = stream_any_dataset(RequestFactory().get('/'), rows, filename='authors.jsonl')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[0]), ['id', 'name'])
+        self.assertEqual(len(lines), 26)
+        self.assertEqual(json.loads(lines[-1])[1], 'author 24')
+
+        rows = perform_query(SQL, None, stream=True)
+        response = stream_any_dataset(RequestFactory().get('/'), rows, filename='authors.csv', csv_field_delimiter=';')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id;name')
+        self.assertTrue(lines[1].endswith(';author 0'))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="authors.csv"')
+
+    def test_stream_export_empty(self):
+        rows = perform_query(SQL + ' LIMIT 0', None, stream=True)
+        response = stream_any_dataset(RequestFactory().get('/'), rows, filename='authors.csv')
+        self.assertEqual(b''.join(response.streaming_content), b'id;name\r\n')
+
+    def test_stream_export_formatting(self):
+        # Streamed exports match the non-streamed ones
+        sql = "SELECT id, name, NULL AS missing, 1.5 AS ratio, date('2021-09-02') AS day FROM tests_author ORDER BY id"
+        for filename in ['authors.csv', 'authors.jsonl', ]:
+            response = stream_any_dataset(
+                RequestFactory().get('/'), perform_query(sql, None, stream=True, batch_size=4), filename=filename,
+                batch_size=10,
+            )
+            expected = export_any_dataset(RequestFactory().get('/'), '*', queryset=perform_query(sql, None), filename=filename)
+            self.assertEqual(
+                b''.join(response.streaming_content),
+                b''.join(s.encode('utf-8') if isinstance(s, str) else s for s in expected.streaming_content),
+            )
+
+
+class RecordsetTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(5):
+            Author.objects.create(name='author %d' % i)
+
+    def test_compact(self):
+        recordset = perform_query(SQL, None, compact=True)
+        self.assertIsInstance(recordset, Recordset)
+        self.assertEqual(recordset.columns, ['id', 'name'])
+        self.assertEqual(len(recordset), 5)
+        self.assertIsInstance(recordset.rows[0], tuple)
+        row = recordset[1]
+        self.assertIsInstance(row, RowView)
+        self.assertEqual(row['name'], 'author 1')
+        self.assertEqual(row.get('missing'), None)
+        self.assertEqual(list(row.keys()), ['id', 'name'])
+        self.assertEqual(row, perform_query(SQL, None)[1])
+        self.assertEqual(recordset.as_dicts(), perform_query(SQL, None))
+        self.assertEqual(recordset.column('name')[-1], 'author 4')
+        self.assertEqual(recordset.as_columns()['name'], recordset.column('name'))
+        self.assertEqual(len(recordset[1:3]), 2)
+        self.assertEqual([r['name'] for r in recordset[3:]], ['author 3', 'author 4'])
+
+        empty = perform_query(SQL + ' LIMIT 0', None, compact=True)
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.as_columns(), {'id': [], 'name': []})
+
+    def test_duplicate_columns(self):
+        recordset = perform_query('SELECT 1 AS id, 2 AS id, 3 AS name', None, compact=True)
+        self.assertEqual(recordset.columns, ['id', 'id_2', 'name'])
+        self.assertEqual(list(recordset[0].keys()), ['id', 'id_2', 'name'])
+        self.assertEqual(list(recordset[0].values()), [1, 2, 3])
+
+        rows = perform_query('SELECT 1 AS id, 2 AS id, 3 AS name', None, stream=True)
+        response = stream_any_dataset(RequestFactory().get('/'), rows, filename='rows.csv')
+        self.assertEqual(b''.join(response.streaming_content), b'id;id 2;name\r\n1;2;3\r\n')
+
+    def test_stream_compact(self):
+        rows = list(perform_query(SQL, None, stream=True, batch_size=2, compact=True))
+        self.assertEqual(len(rows), 5)
+        self.assertIsInstance(rows[0], RowView)
+        self.assertEqual(rows[4]['name'], 'author 4')
+
+    def test_render(self):
+        recordset = perform_query(SQL, None, compact=True)
+        headers, rows = render_queryset_as_data('*', queryset=recordset)
+        self.assertEqual(headers, ['id', 'name'])
+        self.assertEqual(rows[2][1], 'author 2')
+        self.assertIn('author 4', render_queryset_as_text('name', queryset=recordset))
+
+        response = export_any_dataset(RequestFactory().get('/'), '*', queryset=recordset, filename='authors.jsonl')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[0]), ['id', 'name'])
+        self.assertEqual(len(lines), 6)
+
+
+# Counts forever, unless interrupted
+ENDLESS_SQL = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c'
+
+
+class StatementTimeoutTestCase(TestCase):
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(QueryTimeout):
+            perform_query(ENDLESS_SQL, None, timeout=0.2)
+        self.assertLess(time.monotonic() - start, 5)
+
+        with self.assertRaises(QueryTimeout):
+            list(perform_query(ENDLESS_SQL, None, stream=True, timeout=0.2))
+
+        # The connection is still usable, and no longer limited
+        self.assertEqual(perform_query('SELECT 1 AS one', None, timeout=0.2), [{'one': 1}])
+        self.assertEqual(perform_query('SELECT 1 AS one', None), [{'one': 1}])
+
+    def test_timeout_stream_consumer(self):
+        # The time spent by a slow consumer between fetches doesn't count
+        sql = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 3000) SELECT x FROM c'
+        rows = perform_query(sql, None, stream=True, batch_size=1000, timeout=0.2)
+        for n, row in enumerate(rows):
+            if n % 1000 == 999:
+                time.sleep(0.3)
+        self.assertEqual(n, 2999)
+
+    def test_cancel(self):
+        token = uuid.uuid4().hex
+        self.assertFalse(cancel_query(token))
+        timer = threading.Timer(0.2, cancel_query, [token])
+        timer.start()
+        try:
+            with self.assertRaises(QueryCancelled):
+                perform_query(ENDLESS_SQL, None, timeout=30, token=token)
+        finally:
+            timer.cancel()
+        self.assertFalse(cancel_query(token))
+
+    def test_query_timeout(self):
+        query = Query(slug='endless', sql=ENDLESS_SQL)
+        self.assertEqual(query.get_timeout(), 0)
+        with mock.patch.object(app_settings, 'QUERY_TIMEOUT', 0.2):
+            self.assertEqual(query.get_timeout(), 0.2)
+            with self.assertRaises(QueryTimeout):
+                perform_query(query.sql, None, timeout=query.get_timeout())
+            query.timeout = 10
+            self.assertEqual(query.get_timeout(), 10)
@@ -5,4 +5,6 @@ from . import views
 urlpatterns = [
     url(r'^empty/$', views.empty, name='empty'),
     url(r'^count/$', views.count_migrations, name='count'),
+    url(r'^books/$', views.list_books, name='books'),
+    url(r'^count_twice/$', views.count_twice, name='count_twice'),
 ]
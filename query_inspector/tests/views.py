@@ -1,5 +1,7 @@
 from django.db import connection
 from django.http import HttpResponse
+from query_inspector.budgets import query_budget
+from .models import Book
 
 
 def empty(request):
@@ -14,3 +16,21 @@ def count_migrations(request):
         cursor.execute("select count(*) from django_migrations")
         results = cursor.fetchone()[0]
     return HttpResponse(str(results), content_type="text/plain")
+
+
+def list_books(request):
+    # A view affected by the N+1 problem
+    text = '\n'.join([
+        '%s (%s)' % (book.title, book.author.name)
+        for book in Book.objects.all()
+    ])
+    return HttpResponse(text, content_type="text/plain")
+
+
+@query_budget(max_queries=1)
+def count_twice(request):
+    # A view exceeding its query budget
+    with connection.cursor() as cursor:
+        for i in range(2):
+            cursor.execute("select count(*) from django_migrations")
+    return HttpResponse("", content_type="text/plain")
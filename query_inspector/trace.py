@@ -2,18 +2,11 @@ import pprint
 import json
 import uuid
 from functools import partial
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.db.models.query import QuerySet
 from .templatetags.query_inspector_tags import render_queryset_as_text
 from .templatetags.query_inspector_tags import render_queryset_as_data
-
-# Check if sqlparse is available for indentation
-try:
-    import sqlparse
-except ImportError:
-    class sqlparse:
-        @staticmethod
-        def format(text, *args, **kwargs):
-            return text
+from .formatting import get_sql_formatter
 
 # Check if termcolor is available for coloring
 try:
@@ -22,15 +15,6 @@ except ImportError:
     termcolor = None
 
 
-# Check if Pygments is available for coloring
-try:
-    import pygments
-    from pygments.lexers import SqlLexer
-    from pygments.formatters import TerminalTrueColorFormatter
-except ImportError:
-    pygments = None
-
-
 # Check if tabulate is available for formatting
 try:
     import tabulate
@@ -53,7 +37,13 @@ def trace(message, color='yellow', on_color=None, attrs=None, prompt='', prettif
         print(text)
 
 
-def prettyprint_query(query, params=None, colorize=True, prettify=True, reindent=True):
+def prettyprint_query(query, params=None, colorize=True, prettify=True, reindent=True, explain=False, analyze=False,
+                      using=DEFAULT_DB_ALIAS):
+    """
+    Prints the query, indented and highlighted;
+    when <explain> is set, its execution plan on database <using> is printed as well
+    (see explain.get_plan())
+    """
 
     def _str_query(sql, params):
 
@@ -70,29 +60,28 @@ def prettyprint_query(query, params=None, colorize=True, prettify=True, reindent
 
         # Borrowed by morlandi from sant527
         # See: https://github.com/bradmontgomery/django-querycount/issues/22
-        if prettify:
-            sql = sqlparse.format(sql, reindent=reindent)
-
-        if colorize and pygments:
-            # Highlight the SQL query
-            sql = pygments.highlight(
-                sql,
-                SqlLexer(),
-                TerminalTrueColorFormatter(style='monokai')
-                #TerminalTrueColorFormatter()
-            )
-
-        return sql
+        # Indent (with sqlparse) and highlight (with pygments) the SQL query
+        return get_sql_formatter('monokai').format(sql, prettify=prettify, reindent=reindent, colorize=colorize)
 
     sql = _str_query(query.replace('\n', ' '), params).strip()
     print(sql)
     if params is not None:
         trace('params: ' + str(params), color='light_grey')
+    if explain:
+        from .explain import get_plan
+        plan = get_plan(connections[using], query, params, analyze=analyze)
+        trace(plan if plan is not None else 'Plan not available', color='yellow', prompt='plan')
     print("-" * 80)
 
 
-def prettyprint_queryset(qs, colorize=True, prettify=True, reindent=True):
-    prettyprint_query(str(qs.query), colorize=colorize, prettify=prettify, reindent=reindent)
+def prettyprint_queryset(qs, colorize=True, prettify=True, reindent=True, explain=False, analyze=False):
+    if explain:
+        # Explain the actual sql (with params), rather than its string representation
+        sql, params = qs.query.sql_with_params()
+        prettyprint_query(sql, params, colorize=colorize, prettify=prettify, reindent=reindent,
+                          explain=True, analyze=analyze, using=qs.db)
+    else:
+        prettyprint_query(str(qs.query), colorize=colorize, prettify=prettify, reindent=reindent)
 
 
 def trace_func(fn):
@@ -1,4 +1,5 @@
 import io
+import itertools
 import os
 import csv
 import json
@@ -8,6 +9,8 @@ from django.http import StreamingHttpResponse
 from .exporters import open_xlsx_file, SpreadsheetQuerysetExporter
 from .templatetags.query_inspector_tags import render_queryset_as_data
 from .app_settings import DEFAULT_CSV_FIELD_DELIMITER
+from .recordset import Recordset
+from .sql import QueryStream
 
 
 def normalized_export_filename(title, extension):
@@ -125,3 +128,80 @@ def export_any_dataset(request, *fields, queryset, filename, csv_field_delimiter
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
 
     return response
+
+
+class _Echo(object):
+    """
+    A file-like object which just returns what is written;
+    see "Streaming large CSV files" in Django's documentation
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_any_dataset(request, rows, filename, csv_field_delimiter=DEFAULT_CSV_FIELD_DELIMITER, columns=None,
+                       batch_size=500):
+    """
+    Export an iterable of dictionaries or RowViews (i.e. as returned by perform_query(stream=True))
+    as csv or jsonl, formatted as export_any_dataset() does; rows are rendered <batch_size>
+    at a time while the response is being sent, so they are never held in memory all together.
+
+    Column names are taken from <columns>, or from rows.columns (see QueryStream and Recordset),
+    or from the first row.
+    """
+
+    name, extension = os.path.splitext(filename)
+    file_format = extension[1:]
+
+    if file_format == 'csv':
+        content_type = 'text/csv'
+        writer = csv.writer(_Echo(), delimiter=csv_field_delimiter, quoting=csv.QUOTE_MINIMAL)
+        render_row = writer.writerow
+    elif file_format == 'jsonl':
+        content_type = 'application/jsonl'
+        render_row = lambda values: json.dumps(values) + '\n'
+    else:
+        raise Exception('Wrong export file format "%s"' % file_format)
+
+    def render_batch(names, batch):
+        # (the same rendering as export_any_dataset())
+        return render_queryset_as_data('*', queryset=Recordset(names, [
+            [row[name] for name in names] for row in batch
+        ]))
+
+    def lines():
+        try:
+            if isinstance(rows, QueryStream):
+                # the column names are known once the statement has been executed
+                rows.start()
+            iterator = iter(rows)
+            names = columns if columns is not None else getattr(rows, 'columns', None)
+            if names is None:
+                first = next(iterator, None)
+                if first is None:
+                    return
+                names = list(first.keys())
+                iterator = itertools.chain([first], iterator)
+            if not names:
+                return
+
+            batch = list(itertools.islice(iterator, batch_size))
+            headers, data = render_batch(names, batch)
+            yield render_row(headers)
+            while batch:
+                for values in data:
+                    yield render_row(values)
+                batch = list(itertools.islice(iterator, batch_size))
+                headers, data = render_batch(names, batch)
+        finally:
+            if isinstance(rows, QueryStream):
+                rows.close()
+
+    response = StreamingHttpResponse(
+        lines(),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+
+    return response